@@ -0,0 +1,104 @@
+import argparse, json, random, threading, time
+import urllib.request, urllib.error
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+# concurrent bookings against a running instance, i.e.
+#   python benchmarks/booking_contention.py --url http://localhost:8000 --threads 32 --bookings 2000 --mode same-nights
+# same-nights: every booking uses the same hotel and the same nights (worst case, all writers wait for the same day rows)
+# spread:      every booking uses the same hotel but a random stay within the next year (writers rarely share a night)
+# afterwards the availability of the hotel is checked, no night may have more used rooms than the hotel has
+
+
+def request(method : str, url : str, body : dict = None):
+    data = None if body is None else json.dumps(body).encode("utf-8")
+    req = urllib.request.Request(url, data=data, method=method, headers={ "Content-Type" : "application/json" })
+    try:
+        with urllib.request.urlopen(req, timeout=60) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read() or b"{}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Contention benchmark for the capacity check of PUT /api/booking")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--bookings", type=int, default=1000)
+    parser.add_argument("--mode", choices=["same-nights", "spread"], default="same-nights")
+    parser.add_argument("--hotelId", type=int, default=None, help="defaults to the first hotel")
+    parser.add_argument("--nights", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    url = args.url.rstrip("/")
+    status, hotels = request("GET", url + "/api/hotels")
+    if status != 200 or len(hotels) == 0:
+        raise RuntimeError("No hotels found, populate the database first (POST /api/setup)")
+    hotel = hotels[-1] if args.hotelId is None else next(h for h in hotels if h["hotelId"] == args.hotelId)
+    # every booking gets its own visitor, so the duplicate check never kicks in
+    visitorIds = []
+    cursor = ""
+    while len(visitorIds) < args.bookings:
+        status, page = request("GET", url + "/api/visitors?limit=1000" + ("&cursor=" + cursor if cursor else ""))
+        visitorIds.extend(v["visitorId"] for v in page["items"])
+        cursor = page["next"]
+        if cursor is None:
+            break
+
+    rng = random.Random(args.seed)
+    firstNight = date.today() + timedelta(days=400)
+    stays = []
+    for visitorId in visitorIds[:args.bookings]:
+        checkin = firstNight if args.mode == "same-nights" else firstNight + timedelta(days=rng.randrange(365))
+        stays.append({
+            "hotelId" : hotel["hotelId"],
+            "visitorId" : visitorId,
+            "checkin" : checkin.isoformat(),
+            "checkout" : (checkin + timedelta(days=args.nights)).isoformat(),
+            "adults" : 1
+        })
+
+    latencies = []
+    results = { "created" : 0, "rejected" : 0, "failed" : 0 }
+    createdIds = []
+    lock = threading.Lock()
+
+    def book(stay : dict):
+        start = time.perf_counter()
+        status, body = request("PUT", url + "/api/booking", stay)
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            if status == 200:
+                results["created"] += 1
+                createdIds.append(body["bookingId"])
+            elif "Not enough rooms available" in str(body.get("error", "")):
+                results["rejected"] += 1
+            else:
+                results["failed"] += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        list(executor.map(book, stays))
+    duration = time.perf_counter() - start
+
+    latencies.sort()
+    print("hotel:      " + str(hotel["hotelId"]) + " (" + str(hotel["totalRooms"]) + " rooms)")
+    print("mode:       " + args.mode + ", " + str(args.threads) + " threads, " + str(len(stays)) + " bookings")
+    print("throughput: " + str(round(len(stays) / duration, 1)) + " bookings/s")
+    print("latency:    p50 " + str(round(latencies[len(latencies) // 2] * 1000, 1)) + " ms, p99 " + str(round(latencies[int(len(latencies) * 0.99)] * 1000, 1)) + " ms")
+    print("results:    " + json.dumps(results))
+
+    lastNight = max(date.fromisoformat(s["checkout"]) for s in stays)
+    status, availability = request("GET", url + "/api/availability?hotelId=" + str(hotel["hotelId"]) + "&from=" + firstNight.isoformat() + "&until=" + lastNight.isoformat())
+    if status == 200:
+        print("overbooked: " + str(availability["minFreeRooms"] < 0))
+
+    # remove the benchmark bookings again
+    for bookingId in createdIds:
+        request("DELETE", url + "/api/booking?bookingId=" + str(bookingId))
+
+
+if __name__ == "__main__":
+    main()
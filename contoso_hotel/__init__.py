@@ -2,6 +2,9 @@ from flask import Flask  # Import the Flask class
 app = Flask(__name__)    # Create an instance of the class for our use
 app.config['MAX_CONTENT_LENGTH'] = 64 * 1000 * 1000
 
+from .jsonprovider import create_json_provider
+app.json = create_json_provider(app)   # orjson / msgspec when installed, see JSON_PROVIDER
+
 
 
 
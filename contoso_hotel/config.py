@@ -1,18 +1,73 @@
 import os
 import json
-from typing import Dict, Union
+import time
+import threading
+from typing import Dict, Tuple, Union
 
-def get_configuration(name : str) -> str:
-    name = str(name).strip().upper()
-    secretStoreFile = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'secrets-store', name)
-    if os.path.isfile(secretStoreFile):
+# how often (in seconds) a cached value is re-validated against the secrets store file / environment
+CONFIG_CHECK_INTERVAL_SECONDS = 2.0
+
+_secretStoreDir = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'secrets-store')
+# name -> (value, secret store file mtime or None when read from the environment, monotonic time of last check)
+_configurationCache : Dict[str, Tuple[str, Union[int, None], float]] = {}
+_configurationLock = threading.Lock()
+
+def _resolve_configuration(name : str) -> Tuple[str, Union[int, None]]:
+    secretStoreFile = os.path.join(_secretStoreDir, name)
+    try:
+        mtime = os.stat(secretStoreFile).st_mtime_ns
+    except OSError:
+        mtime = None
+    cached = _configurationCache.get(name)
+    if mtime is not None and cached is not None and cached[1] == mtime:
+        # file did not change since we read it the last time
+        return cached[0], mtime
+    if mtime is not None and os.path.isfile(secretStoreFile):
         #print("Reading from secrets store")
         with open(secretStoreFile, 'r') as file:
             value = file.read().strip()
     else:
         #print("Reading from environment variable")
+        mtime = None
         value = os.getenv(name, '')
-    return str(value)
+    return str(value), mtime
+
+def get_configuration(name : str) -> str:
+    # values are resolved once per process and only re-read when the secrets store file changes (key rotation)
+    name = str(name).strip().upper()
+    cached = _configurationCache.get(name)
+    now = time.monotonic()
+    if cached is not None and now - cached[2] < CONFIG_CHECK_INTERVAL_SECONDS:
+        return cached[0]
+    with _configurationLock:
+        cached = _configurationCache.get(name)
+        if cached is not None and now - cached[2] < CONFIG_CHECK_INTERVAL_SECONDS:
+            return cached[0]
+        value, mtime = _resolve_configuration(name)
+        _configurationCache[name] = (value, mtime, now)
+    return value
+
+def clear_configuration_cache():
+    with _configurationLock:
+        _configurationCache.clear()
+
+def get_int_configuration(name : str, defaultValue : int) -> int:
+    value = get_configuration(name).strip()
+    if value == '':
+        return defaultValue
+    return int(value)
+
+def get_float_configuration(name : str, defaultValue : float) -> float:
+    value = get_configuration(name).strip()
+    if value == '':
+        return defaultValue
+    return float(value)
+
+def get_bool_configuration(name : str, defaultValue : bool) -> bool:
+    value = get_configuration(name).strip().lower()
+    if value == '':
+        return defaultValue
+    return value in ['true', 't', '1', 'yes', 'y']
 
 class LayoutConfiguration:
     api_baseurl = ''
@@ -54,5 +109,14 @@ class LayoutConfiguration:
     def __iter__(self):
         return iter(self.getDict().items())
     
+_layoutConfiguration : Tuple[Tuple[str, ...], LayoutConfiguration] = None
+
 def get_layout_configuration() -> LayoutConfiguration:
-    return LayoutConfiguration()
\ No newline at end of file
+    # rendered on every page, so reuse the instance as long as none of its settings changed
+    global _layoutConfiguration
+    key = tuple(get_configuration(name) for name in ['API_BASEURL', 'CHATBOT_BASEURL', 'CHATBOT_KEY', 'CHATBOT_FRONTEND_USE_CHATBOT_BASEURL'])
+    cached = _layoutConfiguration
+    if cached is None or cached[0] != key:
+        cached = (key, LayoutConfiguration())
+        _layoutConfiguration = cached
+    return cached[1]
\ No newline at end of file
@@ -1,7 +1,13 @@
-import os, re
-from typing import Dict, List, Union, Iterable, Tuple
+import os, re, json, base64
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Union, Iterable, Iterator, Tuple
 from enum import Enum
-from datetime import datetime
+from datetime import date, datetime
+
+from ..config import get_configuration
+from .changehub import ChangeHub
+from .batch import BATCH_ACTIONS, BATCH_ENTITIES
+from .export import EXPORT_COLUMNS, EXPORT_FILTERS, EXPORT_FORMATS
 
 class SQLMode(Enum):
     INSERT = 1
@@ -22,15 +28,8 @@ def get_connection_string(name : str) -> str:
     name = str(name).strip().upper()
     if name != "MSSQL_CONNECTION_STRING" and name != "POSTGRES_CONNECTION_STRING":
         raise ValueError("Invalid database name (only 'MSSQL_CONNECTION_STRING' and 'POSTGRES_CONNECTION_STRING' are supported)")
-    connectionString = ""
-    secretStoreFile = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__)))), 'secrets-store', name)
-    if os.path.isfile(secretStoreFile):
-        #print("Reading connection string from secrets store")
-        with open(secretStoreFile, 'r') as file:
-            connectionString = file.read().strip()
-    else:
-        #print("Reading connection string from environment variable")
-        connectionString = os.getenv(name, '')
+    # resolved through the process wide configuration cache (secrets store file or environment variable)
+    connectionString = get_configuration(name)
     if not connectionString:
         raise ValueError("Connection string is empty")
     return connectionString
@@ -71,6 +70,14 @@ def parse_connection_string_to_dict(s : str, allowedArgs : Union[List[str], Dict
                 args[parts[0]] = parts[1]
     return args
 
+@lru_cache(maxsize=16)
+def _parse_connection_string_cached(s : str, allowedArgs : Tuple[Tuple[str, str], ...]) -> Dict[str, Union[int, str, float, bool]]:
+    return parse_connection_string_to_dict(s, dict(allowedArgs))
+
+def get_connection_parameters(s : str, allowedArgs : Dict[str, str]) -> Dict[str, Union[int, str, float, bool]]:
+    # parsed once per distinct connection string, a rotated connection string is simply a new cache key
+    return dict(_parse_connection_string_cached(s, tuple(sorted(allowedArgs.items()))))
+
 def split_string_with_escaping(s):
     pattern = r'(?<!\\);'
     result = re.split(pattern, s)
@@ -78,6 +85,70 @@ def split_string_with_escaping(s):
     return result
 
 
+# keyset pagination: the cursor is an opaque token that holds the sort key of the last row of the previous page
+DEFAULT_PAGE_LIMIT = 100
+MAX_PAGE_LIMIT = 1000
+
+def get_page_limit(limit : int = None, cursor : str = None) -> Union[int, None]:
+    # None keeps the legacy (unpaged) behaviour
+    if limit is None:
+        if cursor is None or cursor == "":
+            return None
+        return DEFAULT_PAGE_LIMIT
+    limit = int(limit)
+    if limit <= 0:
+        raise ValueError("limit must be greater than 0")
+    return min(limit, MAX_PAGE_LIMIT)
+
+def encode_cursor(kind : str, values : List[Any]) -> str:
+    # the rows hold the dates as they come from the database
+    values = [value.strftime('%Y-%m-%d') if isinstance(value, date) else value for value in values]
+    data = json.dumps({ "k" : kind, "v" : values }, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(data).decode("ascii").rstrip("=")
+
+def decode_cursor(kind : str, cursor : str, converters : List[Callable[[Any], Any]]) -> Union[List[Any], None]:
+    if cursor is None or cursor == "":
+        return None
+    try:
+        cursor = str(cursor).strip()
+        data = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8"))
+        if data["k"] != kind or len(data["v"]) != len(converters):
+            raise ValueError()
+        return [converter(value) for converter, value in zip(converters, data["v"])]
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+def cursor_date(value : str) -> str:
+    return datetime.strptime(str(value), '%Y-%m-%d').strftime('%Y-%m-%d')
+
+def build_page(rows : List[Dict[str, Any]], limit : int, kind : str, keyNames : List[str]) -> Dict[str, Any]:
+    # the backends fetch limit + 1 rows, the extra row tells us whether there is a next page
+    nextCursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        nextCursor = encode_cursor(kind, [rows[-1][k] for k in keyNames])
+    return { "items" : rows, "next" : nextCursor }
+
+def escape_like(value : str, escapeChar : str = "\\") -> str:
+    # makes user input safe to embed in a LIKE pattern (wildcards of both engines are matched literally)
+    value = str(value).replace(escapeChar, escapeChar + escapeChar)
+    for c in ["%", "_", "["]:
+        value = value.replace(c, escapeChar + c)
+    return value
+
+def chunked(rows : Iterable[Any], chunkSize : int) -> Iterator[List[Any]]:
+    # bulk loaders consume generated rows in fixed size chunks, so memory only ever holds one chunk
+    chunkSize = max(1, int(chunkSize))
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunkSize:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
 dbconnectionstring, dbconnectionstringname = get_defined_database()
 
 
@@ -102,6 +173,24 @@ def get_amenities():
         "bathroomEssentials" : "Premium toiletries, hair dryers, bathrobes, and slippers"
     }
 
+def parse_amenities(amenities : Union[str, Iterable[str], None]) -> List[str]:
+    # accepts a comma separated string or a list, returns the amenity names as spelled in get_amenities (they are the column names)
+    if amenities is None:
+        return []
+    if isinstance(amenities, str):
+        amenities = amenities.split(",")
+    knownAmenities = { name.lower() : name for name in get_amenities() }
+    result = []
+    for amenity in amenities:
+        amenity = str(amenity).strip()
+        if amenity == "":
+            continue
+        if amenity.lower() not in knownAmenities:
+            raise ValueError("Unknown amenity: " + amenity)
+        if knownAmenities[amenity.lower()] not in result:
+            result.append(knownAmenities[amenity.lower()])
+    return result
+
 
 if dbconnectionstringname == "MSSQL_CONNECTION_STRING":
     from . import mssqldblayer
@@ -109,6 +198,9 @@ if dbconnectionstringname == "MSSQL_CONNECTION_STRING":
     def longsqlrequest() -> int:
         return mssqldblayer.longsqlrequest()
 
+    def get_pool_stats() -> Dict[str, Union[int, float]]:
+        return mssqldblayer.get_pool_stats()
+
     def create_booking(hotelId : int, visitorId : int, checkin : datetime, checkout : datetime, adults : int, kids : int, babies : int, rooms : int = None, price : float = None, bookingId : int = None) -> Dict[str, Union[int, str, float, bool]]:
         return mssqldblayer.create_booking(hotelId, visitorId, checkin, checkout, adults, kids, babies, rooms, price, bookingId)
 
@@ -118,8 +210,11 @@ if dbconnectionstringname == "MSSQL_CONNECTION_STRING":
     def get_booking(bookingId : int) -> Dict[str, Union[int, str, float, bool]]:
         return mssqldblayer.get_booking(bookingId)
 
-    def get_bookings(visitorId : int = None, hotelId : int = None, fromdate : datetime = None, untildate : datetime = None) -> Iterable[Dict[str, Union[int, str, float, bool]]]:
-        return mssqldblayer.get_bookings(visitorId, hotelId, fromdate, untildate)
+    def get_bookings(visitorId : int = None, hotelId : int = None, fromdate : datetime = None, untildate : datetime = None, limit : int = None, cursor : str = None) -> Union[Iterable[Dict[str, Union[int, str, float, bool]]], Dict[str, Any]]:
+        return mssqldblayer.get_bookings(visitorId, hotelId, fromdate, untildate, limit, cursor)
+
+    def stream_bookings(visitorId : int = None, hotelId : int = None, fromdate : datetime = None, untildate : datetime = None) -> Iterator[Dict[str, Union[int, str, float, bool]]]:
+        return mssqldblayer.stream_bookings(visitorId, hotelId, fromdate, untildate)
 
     def create_visitor(firstname : str, lastname : str, visitorId : int = None) -> Dict[str, Union[int, str, float, bool]]:
         return mssqldblayer.create_visitor(firstname, lastname, visitorId)
@@ -136,8 +231,11 @@ if dbconnectionstringname == "MSSQL_CONNECTION_STRING":
     def get_visitor(visitorId : int) -> Dict[str, Union[int, str, float, bool]]:
         return mssqldblayer.get_visitor(visitorId)
 
-    def get_visitors(name : str = "", exactMatch : bool = False) -> Iterable[Dict[str, Union[int, str, float, bool]]]:
-        return mssqldblayer.get_visitors(name, exactMatch)
+    def get_visitors(name : str = "", exactMatch : bool = False, limit : int = None, cursor : str = None) -> Union[Iterable[Dict[str, Union[int, str, float, bool]]], Dict[str, Any]]:
+        return mssqldblayer.get_visitors(name, exactMatch, limit, cursor)
+
+    def stream_visitors(name : str = "", exactMatch : bool = False) -> Iterator[Dict[str, Union[int, str, float, bool]]]:
+        return mssqldblayer.stream_visitors(name, exactMatch)
 
     def create_hotel(
         hotelname : str,
@@ -293,14 +391,41 @@ if dbconnectionstringname == "MSSQL_CONNECTION_STRING":
     def get_hotel(hotelId : int) -> Dict[str, Union[int, str, float, bool]]:
         return mssqldblayer.get_hotel(hotelId)
 
-    def get_hotels(name : str = "", exactMatch : bool = False) -> Iterable[Dict[str, Union[int, str, float, bool]]]:
-        return mssqldblayer.get_hotels(name, exactMatch)
+    def get_hotels(name : str = "", exactMatch : bool = False, limit : int = None, cursor : str = None) -> Union[Iterable[Dict[str, Union[int, str, float, bool]]], Dict[str, Any]]:
+        return mssqldblayer.get_hotels(name, exactMatch, limit, cursor)
+
+    def stream_hotels(name : str = "", exactMatch : bool = False) -> Iterator[Dict[str, Union[int, str, float, bool]]]:
+        return mssqldblayer.stream_hotels(name, exactMatch)
+
+    def get_availability(hotelId : int, fromdate : datetime, untildate : datetime) -> Dict[str, Any]:
+        return mssqldblayer.get_availability(hotelId, fromdate, untildate)
+
+    def get_available_hotels(checkin : datetime, checkout : datetime, rooms : int = 1, amenities : Union[str, List[str]] = None) -> List[Dict[str, Union[int, str, float, bool]]]:
+        return mssqldblayer.get_available_hotels(checkin, checkout, rooms, amenities)
+
+    def get_data_versions() -> Union[Dict[str, int], None]:
+        return mssqldblayer.get_data_versions()
+
+    def get_booking_changes(since : str = None) -> Dict[str, Any]:
+        return mssqldblayer.get_booking_changes(since)
+
+    def get_booking_change_hub() -> ChangeHub:
+        return mssqldblayer.get_booking_change_hub()
+
+    def execute_batch(operations : List[Dict[str, Any]], atomic : bool = True) -> Dict[str, Any]:
+        return mssqldblayer.execute_batch(operations, atomic)
+
+    def import_bookings(records : List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        return mssqldblayer.import_bookings(records)
+
+    def export_table(tableName : str, format : str, visitorId : int = None, hotelId : int = None, fromdate : datetime = None, untildate : datetime = None, chunkSize : int = 65536) -> Iterator[str]:
+        return mssqldblayer.export_table(tableName, format, visitorId, hotelId, fromdate, untildate, chunkSize)
 
     def allTablesExists() -> bool:
         return mssqldblayer.allTablesExists()
 
-    def setupDb(drop_schema : bool, create_schema : bool, populate_data : bool, number_of_visitors : int = 100, min_bookings_per_visitor : int = 1, max_bookings_per_visitor : int = 5):
-        return mssqldblayer.setupDb(drop_schema, create_schema, populate_data, number_of_visitors, min_bookings_per_visitor, max_bookings_per_visitor)
+    def setupDb(drop_schema : bool, create_schema : bool, populate_data : bool, number_of_visitors : int = 100, min_bookings_per_visitor : int = 1, max_bookings_per_visitor : int = 5, seed : Union[int, None] = None, target_occupancy : Union[float, None] = None):
+        return mssqldblayer.setupDb(drop_schema, create_schema, populate_data, number_of_visitors, min_bookings_per_visitor, max_bookings_per_visitor, seed, target_occupancy)
 
 elif dbconnectionstringname == "POSTGRES_CONNECTION_STRING":
     from . import postgresdblayer
@@ -308,6 +433,9 @@ elif dbconnectionstringname == "POSTGRES_CONNECTION_STRING":
     def longsqlrequest() -> int:
         return postgresdblayer.longsqlrequest()
 
+    def get_pool_stats() -> Dict[str, Union[int, float]]:
+        return postgresdblayer.get_pool_stats()
+
     def create_booking(hotelId : int, visitorId : int, checkin : datetime, checkout : datetime, adults : int, kids : int, babies : int, rooms : int = None, price : float = None, bookingId : int = None) -> Dict[str, Union[int, str, float, bool]]:
         return postgresdblayer.create_booking(hotelId, visitorId, checkin, checkout, adults, kids, babies, rooms, price, bookingId)
 
@@ -317,8 +445,11 @@ elif dbconnectionstringname == "POSTGRES_CONNECTION_STRING":
     def get_booking(bookingId : int) -> Dict[str, Union[int, str, float, bool]]:
         return postgresdblayer.get_booking(bookingId)
 
-    def get_bookings(visitorId : int = None, hotelId : int = None, fromdate : datetime = None, untildate : datetime = None) -> Iterable[Dict[str, Union[int, str, float, bool]]]:
-        return postgresdblayer.get_bookings(visitorId, hotelId, fromdate, untildate)
+    def get_bookings(visitorId : int = None, hotelId : int = None, fromdate : datetime = None, untildate : datetime = None, limit : int = None, cursor : str = None) -> Union[Iterable[Dict[str, Union[int, str, float, bool]]], Dict[str, Any]]:
+        return postgresdblayer.get_bookings(visitorId, hotelId, fromdate, untildate, limit, cursor)
+
+    def stream_bookings(visitorId : int = None, hotelId : int = None, fromdate : datetime = None, untildate : datetime = None) -> Iterator[Dict[str, Union[int, str, float, bool]]]:
+        return postgresdblayer.stream_bookings(visitorId, hotelId, fromdate, untildate)
 
     def create_visitor(firstname : str, lastname : str, visitorId : int = None) -> Dict[str, Union[int, str, float, bool]]:
         return postgresdblayer.create_visitor(firstname, lastname, visitorId)
@@ -335,8 +466,11 @@ elif dbconnectionstringname == "POSTGRES_CONNECTION_STRING":
     def get_visitor(visitorId : int) -> Dict[str, Union[int, str, float, bool]]:
         return postgresdblayer.get_visitor(visitorId)
 
-    def get_visitors(name : str = "", exactMatch : bool = False) -> Iterable[Dict[str, Union[int, str, float, bool]]]:
-        return postgresdblayer.get_visitors(name, exactMatch)
+    def get_visitors(name : str = "", exactMatch : bool = False, limit : int = None, cursor : str = None) -> Union[Iterable[Dict[str, Union[int, str, float, bool]]], Dict[str, Any]]:
+        return postgresdblayer.get_visitors(name, exactMatch, limit, cursor)
+
+    def stream_visitors(name : str = "", exactMatch : bool = False) -> Iterator[Dict[str, Union[int, str, float, bool]]]:
+        return postgresdblayer.stream_visitors(name, exactMatch)
 
     def create_hotel(
         hotelname : str,
@@ -491,11 +625,38 @@ elif dbconnectionstringname == "POSTGRES_CONNECTION_STRING":
     def get_hotel(hotelId : int) -> Dict[str, Union[int, str, float, bool]]:
         return postgresdblayer.get_hotel(hotelId)
 
-    def get_hotels(name : str = "", exactMatch : bool = False) -> Iterable[Dict[str, Union[int, str, float, bool]]]:
-        return postgresdblayer.get_hotels(name, exactMatch)
+    def get_hotels(name : str = "", exactMatch : bool = False, limit : int = None, cursor : str = None) -> Union[Iterable[Dict[str, Union[int, str, float, bool]]], Dict[str, Any]]:
+        return postgresdblayer.get_hotels(name, exactMatch, limit, cursor)
+
+    def stream_hotels(name : str = "", exactMatch : bool = False) -> Iterator[Dict[str, Union[int, str, float, bool]]]:
+        return postgresdblayer.stream_hotels(name, exactMatch)
+
+    def get_availability(hotelId : int, fromdate : datetime, untildate : datetime) -> Dict[str, Any]:
+        return postgresdblayer.get_availability(hotelId, fromdate, untildate)
+
+    def get_available_hotels(checkin : datetime, checkout : datetime, rooms : int = 1, amenities : Union[str, List[str]] = None) -> List[Dict[str, Union[int, str, float, bool]]]:
+        return postgresdblayer.get_available_hotels(checkin, checkout, rooms, amenities)
+
+    def get_data_versions() -> Union[Dict[str, int], None]:
+        return postgresdblayer.get_data_versions()
+
+    def get_booking_changes(since : str = None) -> Dict[str, Any]:
+        return postgresdblayer.get_booking_changes(since)
+
+    def get_booking_change_hub() -> ChangeHub:
+        return postgresdblayer.get_booking_change_hub()
+
+    def execute_batch(operations : List[Dict[str, Any]], atomic : bool = True) -> Dict[str, Any]:
+        return postgresdblayer.execute_batch(operations, atomic)
+
+    def import_bookings(records : List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        return postgresdblayer.import_bookings(records)
+
+    def export_table(tableName : str, format : str, visitorId : int = None, hotelId : int = None, fromdate : datetime = None, untildate : datetime = None, chunkSize : int = 65536) -> Iterator[str]:
+        return postgresdblayer.export_table(tableName, format, visitorId, hotelId, fromdate, untildate, chunkSize)
 
     def allTablesExists() -> bool:
         return postgresdblayer.allTablesExists()
 
-    def setupDb(drop_schema : bool, create_schema : bool, populate_data : bool, number_of_visitors : int = 100, min_bookings_per_visitor : int = 1, max_bookings_per_visitor : int = 5):
-        return postgresdblayer.setupDb(drop_schema, create_schema, populate_data, number_of_visitors, min_bookings_per_visitor, max_bookings_per_visitor)
\ No newline at end of file
+    def setupDb(drop_schema : bool, create_schema : bool, populate_data : bool, number_of_visitors : int = 100, min_bookings_per_visitor : int = 1, max_bookings_per_visitor : int = 5, seed : Union[int, None] = None, target_occupancy : Union[float, None] = None):
+        return postgresdblayer.setupDb(drop_schema, create_schema, populate_data, number_of_visitors, min_bookings_per_visitor, max_bookings_per_visitor, seed, target_occupancy)
\ No newline at end of file
@@ -0,0 +1,67 @@
+from typing import Any, Callable, Dict, List, Tuple
+
+
+# operations of /api/batch, (action, entity) selects the write function of the backend
+BATCH_ACTIONS = ["create", "update", "delete"]
+BATCH_ENTITIES = ["hotel", "visitor", "booking"]
+
+
+class WriteEffects:
+    # what the writes of a transaction have to do after its commit:
+    # bump the data versions of the changed tables and update the in-memory state of this worker
+    def __init__(self):
+        self.tableNames : List[str] = []
+        self.callbacks : List[Callable[[], None]] = []
+
+    def touch(self, *tableNames : str):
+        for tableName in tableNames:
+            if tableName not in self.tableNames:
+                self.tableNames.append(tableName)
+
+    def after_commit(self, callback : Callable[[], None]):
+        self.callbacks.append(callback)
+
+    def extend(self, other : "WriteEffects"):
+        self.touch(*other.tableNames)
+        self.callbacks.extend(other.callbacks)
+
+
+def run_batch(
+    connection : Any,
+    operations : List[Dict[str, Any]],
+    handlers : Dict[Tuple[str, str], Callable[[Any, WriteEffects, Dict[str, Any]], Any]],
+    savepoint : Callable[[Any], None],
+    rollbackToSavepoint : Callable[[Any], bool],
+    releaseSavepoint : Callable[[Any], None] = None,
+    atomic : bool = True
+) -> Tuple[List[Dict[str, Any]], bool, WriteEffects]:
+    # runs the operations ({ "action", "entity", "data" }) on connection without committing and returns (results, commit, effects)
+    # atomic: the first failure rolls back the whole batch, otherwise every operation runs in a savepoint and only the failed
+    # operations are rolled back (rollbackToSavepoint returns False when the database already rolled back the whole transaction)
+    results = []
+    effects = WriteEffects()
+    failedIndex = None
+    for index, operation in enumerate(operations):
+        if failedIndex is not None:
+            results.append({ "index" : index, "success" : False, "error" : "Not executed, operation " + str(failedIndex) + " failed" })
+            continue
+        if not atomic:
+            savepoint(connection)
+        operationEffects = WriteEffects()
+        try:
+            result = handlers[(operation["action"], operation["entity"])](connection, operationEffects, operation["data"])
+        except Exception as e:
+            results.append({ "index" : index, "success" : False, "error" : str(e) })
+            if atomic or not rollbackToSavepoint(connection):
+                failedIndex = index
+            continue
+        if not atomic and releaseSavepoint is not None:
+            releaseSavepoint(connection)
+        effects.extend(operationEffects)
+        results.append({ "index" : index, "success" : True, "result" : result })
+    if failedIndex is None:
+        return results, True, effects
+    for result in results:
+        if result["success"]:
+            results[result["index"]] = { "index" : result["index"], "success" : False, "error" : "Rolled back, operation " + str(failedIndex) + " failed" }
+    return results, False, WriteEffects()
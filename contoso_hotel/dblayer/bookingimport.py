@@ -0,0 +1,97 @@
+import math
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Iterable, List, Set, Tuple, Union
+
+from .occupancy import BOOKING_HORIZON_DAYS
+
+
+# columns of the bulk insert, the rows of plan_booking_import are in this order
+# (bookingId is None for records without one, the backend fills in reserved ids before the insert)
+BOOKING_IMPORT_COLUMNS = ["bookingId", "hotelId", "visitorId", "checkin", "checkout", "adults", "kids", "babies", "rooms", "price"]
+
+
+def check_booking_values(checkin : datetime, checkout : datetime, adults : int, kids : int, babies : int, rooms : int = None) -> int:
+    # the rules of create_booking that need no database, returns the rooms of the booking
+    if adults <= 0:
+        raise ValueError("At least one adult is required")
+    if checkin >= checkout:
+        raise ValueError("Checkin date must be before checkout date")
+    today = date.today()
+    if abs((_as_date(checkin) - today).days) > BOOKING_HORIZON_DAYS or abs((_as_date(checkout) - today).days) > BOOKING_HORIZON_DAYS:
+        raise ValueError("Checkin and checkout must be within " + str(BOOKING_HORIZON_DAYS) + " days of today")
+    requiredRooms = int(math.ceil((adults / 2) + (kids / 4) + (babies / 8)))
+    if rooms is None:
+        return requiredRooms
+    if rooms < requiredRooms:
+        raise ValueError("Not enough rooms for the number of guests")
+    return rooms
+
+
+def booking_stay(record : Dict[str, Any]) -> Tuple[int, int, date, date]:
+    # a visitor can book a hotel only once for the same stay
+    return (record["hotelId"], record["visitorId"], _as_date(record["checkin"]), _as_date(record["checkout"]))
+
+
+def plan_booking_import(
+    records : List[Dict[str, Any]],
+    hotels : Dict[int, Tuple[float, int]],
+    visitorIds : Set[int],
+    existingBookingIds : Set[int],
+    existingStays : Set[Tuple[int, int, date, date]],
+    usedRooms : Dict[Tuple[int, date], int]
+) -> Tuple[List[Union[str, None]], List[Tuple[int, List[Any]]]]:
+    # applies the rules of create_booking to a batch of records (the keys are the parameter names of create_booking)
+    # with the data the backend loaded for the whole batch at once:
+    #   hotels: hotelId -> (pricePerNight, totalRooms), usedRooms: (hotelId, night) -> rooms booked on that night
+    # returns the error per record (None for records that can be inserted) and the (index, row) to insert,
+    # earlier records of the batch take the rooms (and stays) first, just like they would one request at a time
+    errors = [None] * len(records)
+    rows = []
+    bookingIds = set(existingBookingIds)
+    stays = set(existingStays)
+    usedRooms = dict(usedRooms)
+    for index, record in enumerate(records):
+        try:
+            rooms = check_booking_values(record["checkin"], record["checkout"], record["adults"], record["kids"], record["babies"], record["rooms"])
+        except ValueError as e:
+            errors[index] = str(e)
+            continue
+        if record["hotelId"] not in hotels:
+            errors[index] = "Hotel does not exist"
+            continue
+        if record["visitorId"] not in visitorIds:
+            errors[index] = "Visitor does not exist"
+            continue
+        stay = booking_stay(record)
+        if stay in stays or (record["bookingId"] is not None and record["bookingId"] in bookingIds):
+            errors[index] = "Booking already exists"
+            continue
+        pricePerNight, totalRooms = hotels[record["hotelId"]]
+        nights = [(record["hotelId"], stay[2] + timedelta(days=day)) for day in range((stay[3] - stay[2]).days)]
+        if any(usedRooms.get(night, 0) + rooms > totalRooms for night in nights):
+            errors[index] = "Not enough rooms available"
+            continue
+        for night in nights:
+            usedRooms[night] = usedRooms.get(night, 0) + rooms
+        stays.add(stay)
+        if record["bookingId"] is not None:
+            bookingIds.add(record["bookingId"])
+        price = record["price"]
+        if price is None or price <= 0:
+            price = pricePerNight * len(nights) * rooms
+        rows.append((index, [
+            record["bookingId"], record["hotelId"], record["visitorId"], stay[2].strftime('%Y-%m-%d'), stay[3].strftime('%Y-%m-%d'),
+            record["adults"], record["kids"], record["babies"], rooms, price
+        ]))
+    return errors, rows
+
+
+def booking_import_stays(records : Iterable[Dict[str, Any]]) -> List[Tuple[int, int, date, date]]:
+    # the distinct stays of a batch, for the set based duplicate and day usage lookups
+    return list(set(booking_stay(record) for record in records))
+
+
+def _as_date(value : Union[datetime, date]) -> date:
+    if isinstance(value, datetime):
+        return value.date()
+    return value
@@ -0,0 +1,176 @@
+import os, time, threading
+from collections import deque
+from typing import Any, Callable, Dict, List, Tuple, Union
+
+from ..config import get_float_configuration
+
+
+class ChangeHub:
+    # fans the booking changes out to the clients of /api/bookings/stream: a single thread per worker fetches the changes
+    # once per database notification (or poll) and keeps the current bookings in memory, every connected client gets its
+    # snapshot and the following changes from here, so the number of clients does not change the number of database queries
+    def __init__(
+        self,
+        fetch : Callable[[Union[str, None]], Dict[str, Any]],
+        listen : Callable[[Callable[[], None], Callable[[], bool]], None] = None,
+        pollSeconds : float = 1.0,
+        bufferSize : int = 256,
+        lingerSeconds : float = 30.0
+    ):
+        # fetch is get_booking_changes
+        # listen blocks while the second callable returns True and calls the first one on every database notification,
+        # without it the hub polls every pollSeconds (and whenever notify() is called by a write of this worker)
+        self._fetch = fetch
+        self._listen = listen
+        self._pollSeconds = float(pollSeconds)
+        # the hub keeps running for a while after the last client left, so a reconnecting client can resume
+        self._lingerSeconds = float(lingerSeconds)
+        self._idleSince = None
+        # changes with every start of the hub, the sequences of an earlier run (or another worker) cannot be resumed
+        self._generation = None
+        self._condition = threading.Condition()
+        self._wake = threading.Event()
+        # (sequence, changes) of the latest fetches that changed something
+        self._events = deque(maxlen=max(1, int(bufferSize)))
+        self._sequence = 0
+        self._subscribers = 0
+        self._since = None
+        self._bookings : Dict[int, Dict[str, Any]] = {}
+        self._snapshot = None
+        self._ready = False
+        self._error = None
+        self._thread = None
+
+    def subscribe(self, timeout : float = 30.0, lastEventId : str = None) -> Tuple[int, Union[List[Dict[str, Any]], None]]:
+        # returns the sequence to pass to wait() and all bookings at that sequence (ordered like /api/bookings),
+        # the first subscriber starts the hub and waits for it to load the bookings
+        # with the event_id() of the last event a client got, the bookings are None when the buffer still holds all changes after it
+        with self._condition:
+            self._subscribers += 1
+            self._idleSince = None
+            if self._thread is None:
+                self._ready = False
+                self._since = None
+                self._generation = os.urandom(6).hex()
+                self._thread = threading.Thread(target=self._run, name="booking-change-hub", daemon=True)
+                self._thread.start()
+                if self._listen is not None:
+                    threading.Thread(target=self._runListener, args=(self._thread,), name="booking-change-listener", daemon=True).start()
+            if not self._ready:
+                # a failed load is retried right away for the new subscriber
+                self._error = None
+                self._wake.set()
+            if not self._condition.wait_for(lambda: self._ready or self._error is not None, timeout) or not self._ready:
+                self._subscribers -= 1
+                raise RuntimeError("Booking changes are not available: " + str(self._error))
+            sequence = self._resumable(lastEventId)
+            if sequence is not None:
+                return sequence, None
+            if self._snapshot is None:
+                self._snapshot = sorted(self._bookings.values(), key=lambda b: (b["checkin"], b["checkout"], b["bookingId"]), reverse=True)
+            return self._sequence, self._snapshot
+
+    def unsubscribe(self):
+        # the hub stops (and drops the bookings) lingerSeconds after the last subscriber left
+        with self._condition:
+            self._subscribers -= 1
+            if self._subscribers <= 0:
+                self._idleSince = time.monotonic()
+
+    def event_id(self, sequence : int) -> str:
+        return self._generation + "-" + str(sequence)
+
+    def notify(self):
+        # something changed, fetch right away instead of waiting for the next poll
+        self._wake.set()
+
+    def wait(self, sequence : int, timeout : float) -> Tuple[int, List[Tuple[int, Dict[str, Any]]], bool]:
+        # blocks until there are changes after sequence (or the timeout passed) and returns (sequence, [(sequence, changes)], lost),
+        # lost is True when the client was too slow and the buffer no longer holds all of its changes
+        with self._condition:
+            if self._sequence == sequence:
+                self._condition.wait(timeout)
+            if len(self._events) > 0 and self._events[0][0] > sequence + 1:
+                return self._sequence, [], True
+            return self._sequence, [event for event in self._events if event[0] > sequence], False
+
+    def _resumable(self, lastEventId : Union[str, None]) -> Union[int, None]:
+        # must be called with the lock held, the sequence of lastEventId when wait() can deliver all changes after it
+        if lastEventId is None:
+            return None
+        generation, _, sequence = str(lastEventId).strip().rpartition("-")
+        if generation != self._generation or not sequence.isdigit():
+            return None
+        sequence = int(sequence)
+        if sequence > self._sequence:
+            return None
+        if sequence < self._sequence and (len(self._events) == 0 or self._events[0][0] > sequence + 1):
+            return None
+        return sequence
+
+    def _isRunning(self, thread : threading.Thread) -> bool:
+        return self._thread is thread
+
+    def _runListener(self, thread : threading.Thread):
+        while self._isRunning(thread):
+            try:
+                self._listen(self.notify, lambda: self._isRunning(thread))
+            except Exception:
+                # i.e. the listening connection broke, the hub keeps polling in between
+                time.sleep(self._pollSeconds)
+
+    def _apply(self, changes : Dict[str, Any]):
+        # must be called with the lock held
+        if changes["reset"]:
+            self._bookings = {}
+        for change in changes["changes"]:
+            if change["operation"] == "delete":
+                self._bookings.pop(change["bookingId"], None)
+            else:
+                self._bookings[change["bookingId"]] = change["booking"]
+        self._snapshot = None
+        self._sequence += 1
+
+    def _run(self):
+        # the first fetch (without a token) loads all bookings
+        self._wake.set()
+        while True:
+            self._wake.wait(self._pollSeconds)
+            self._wake.clear()
+            with self._condition:
+                if self._subscribers <= 0 and (self._idleSince is None or time.monotonic() - self._idleSince >= self._lingerSeconds):
+                    self._thread = None
+                    self._generation = None
+                    self._bookings = {}
+                    self._snapshot = None
+                    self._events.clear()
+                    return
+            try:
+                changes = self._fetch(self._since)
+            except Exception as e:
+                # the next poll tries again with the same token
+                with self._condition:
+                    self._error = e
+                    self._condition.notify_all()
+                continue
+            self._since = changes["next"]
+            with self._condition:
+                if not self._ready:
+                    self._apply(changes)
+                    self._ready = True
+                elif changes["reset"] or len(changes["changes"]) > 0:
+                    self._apply(changes)
+                    self._events.append((self._sequence, { "reset" : changes["reset"], "changes" : changes["changes"] }))
+                self._condition.notify_all()
+
+
+def create_configured_change_hub(
+    fetch : Callable[[Union[str, None]], Dict[str, Any]],
+    listen : Callable[[Callable[[], None], Callable[[], bool]], None] = None
+) -> ChangeHub:
+    # with a listener the poll is only the safety net for lost notifications
+    return ChangeHub(
+        fetch,
+        listen,
+        pollSeconds=get_float_configuration("BOOKING_STREAM_POLL_SECONDS", 1.0 if listen is None else 30.0)
+    )
@@ -0,0 +1,344 @@
+import os, time, threading
+from collections import deque
+from typing import Any, Callable, Dict, List, Union
+
+from ..config import get_int_configuration, get_float_configuration, get_bool_configuration
+
+
+class _PoolEntry:
+    __slots__ = ("connection", "createdAt", "lastUsedAt")
+
+    def __init__(self, connection : Any):
+        self.connection = connection
+        self.createdAt = time.monotonic()
+        self.lastUsedAt = self.createdAt
+
+
+class PooledConnection:
+    # thin proxy around a driver connection, close() hands the connection back to the pool instead of closing it
+    def __init__(self, pool : "ConnectionPool", entry : _PoolEntry, generation : int):
+        self._pool = pool
+        self._entry = entry
+        self._connection = entry.connection
+        self._generation = generation
+        self._pid = os.getpid()
+
+    def __getattr__(self, name : str):
+        connection = self.__dict__.get("_connection")
+        if connection is None:
+            raise RuntimeError("Connection has already been returned to the pool")
+        return getattr(connection, name)
+
+    @property
+    def raw_connection(self) -> Any:
+        return self._connection
+
+    def close(self):
+        connection = self.__dict__.get("_connection")
+        if connection is None:
+            return
+        self._connection = None
+        self._pool.release(self._entry, self._generation, self._pid)
+
+    def __del__(self):
+        # safety net for code paths that raise before calling close()
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class ConnectionPool:
+    def __init__(
+        self,
+        connect : Callable[[], Any],
+        minSize : int = 1,
+        maxSize : int = 10,
+        timeout : float = 30.0,
+        prePing : bool = True,
+        ping : Callable[[Any], None] = None,
+        reset : Callable[[Any], None] = None,
+        isClosed : Callable[[Any], bool] = None,
+        maxIdleTime : float = 0,
+        maxLifetime : float = 0
+    ):
+        maxSize = int(maxSize)
+        minSize = int(minSize)
+        if maxSize < 1:
+            raise ValueError("maxSize must be greater than 0")
+        if minSize < 0:
+            minSize = 0
+        if minSize > maxSize:
+            minSize = maxSize
+        self._connect = connect
+        self._minSize = minSize
+        self._maxSize = maxSize
+        self._timeout = float(timeout)
+        self._prePing = bool(prePing)
+        self._ping = ping
+        self._reset = reset
+        self._isClosed = isClosed
+        # 0 disables idle eviction / lifetime recycling
+        self._maxIdleTime = float(maxIdleTime)
+        self._maxLifetime = float(maxLifetime)
+        self._condition = threading.Condition(threading.Lock())
+        self._idle = deque()
+        self._waiters = deque()
+        self._size = 0
+        self._filled = False
+        self._generation = 0
+        self._pid = os.getpid()
+        # connections inherited from a parent process are never closed by the child
+        # (closing them would tear down the parent's session), so we just keep them referenced
+        self._inherited : List[Any] = []
+        self._stats = self._emptyStats()
+
+    def _emptyStats(self) -> Dict[str, Union[int, float]]:
+        return {
+            "connectionsCreated" : 0,
+            "connectionsClosed" : 0,
+            "checkouts" : 0,
+            "checkoutWaits" : 0,
+            "checkoutWaitSeconds" : 0.0,
+            "checkoutTimeouts" : 0,
+            "failedValidations" : 0,
+            "failedResets" : 0,
+            "evictedIdle" : 0,
+            "evictedLifetime" : 0
+        }
+
+    def _checkFork(self):
+        if self._pid == os.getpid():
+            return
+        with self._condition:
+            if self._pid == os.getpid():
+                return
+            self._inherited.extend(entry.connection for entry in self._idle)
+            self._idle.clear()
+            self._size = 0
+            self._filled = False
+            self._generation += 1
+            self._pid = os.getpid()
+            self._stats = self._emptyStats()
+
+    def _newEntry(self) -> _PoolEntry:
+        entry = _PoolEntry(self._connect())
+        with self._condition:
+            self._stats["connectionsCreated"] += 1
+        return entry
+
+    def _closeQuietly(self, connection : Any):
+        try:
+            connection.close()
+        except Exception:
+            pass
+        with self._condition:
+            self._stats["connectionsClosed"] += 1
+
+    def _isExpired(self, entry : _PoolEntry, now : float) -> bool:
+        return self._maxLifetime > 0 and now - entry.createdAt >= self._maxLifetime
+
+    def _isUsable(self, entry : _PoolEntry, ping : bool) -> bool:
+        try:
+            if self._isClosed is not None and self._isClosed(entry.connection):
+                return False
+            if ping and self._ping is not None:
+                self._ping(entry.connection)
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, entry : _PoolEntry):
+        self._closeQuietly(entry.connection)
+        with self._condition:
+            self._size -= 1
+            if self._size < self._minSize:
+                # expired or broken connections are replaced, the next acquire tops the pool up to minSize again
+                self._filled = False
+            self._condition.notify_all()
+
+    def _evictIdle(self, now : float) -> List[_PoolEntry]:
+        # must be called with the lock held, the least recently used connections sit on the left side
+        evicted = []
+        if self._maxIdleTime <= 0 and self._maxLifetime <= 0:
+            return evicted
+        while self._idle and self._size > self._minSize:
+            entry = self._idle[0]
+            if self._isExpired(entry, now):
+                self._stats["evictedLifetime"] += 1
+            elif self._maxIdleTime > 0 and now - entry.lastUsedAt >= self._maxIdleTime:
+                self._stats["evictedIdle"] += 1
+            else:
+                break
+            self._idle.popleft()
+            self._size -= 1
+            evicted.append(entry)
+        return evicted
+
+    def _fill(self):
+        # open the missing connections up to minSize, once per process and again after discards
+        with self._condition:
+            if self._filled:
+                return
+            self._filled = True
+            missing = self._minSize - self._size
+            self._size += max(0, missing)
+        for i in range(missing):
+            try:
+                entry = self._newEntry()
+            except Exception:
+                with self._condition:
+                    self._size -= missing - i
+                    self._filled = False
+                    self._condition.notify_all()
+                raise
+            with self._condition:
+                self._idle.append(entry)
+                self._condition.notify_all()
+
+    def acquire(self) -> PooledConnection:
+        self._checkFork()
+        start = time.monotonic()
+        deadline = start + self._timeout
+        waited = False
+        while True:
+            if not self._filled:
+                self._fill()
+            entry = None
+            ticket = object()
+            queued = False
+            with self._condition:
+                evicted = self._evictIdle(time.monotonic())
+                while True:
+                    # waiters are served first come first served, otherwise busy threads keep barging in
+                    if not self._waiters or self._waiters[0] is ticket:
+                        if self._idle:
+                            # LIFO keeps the hot connections busy and lets the others age out
+                            entry = self._idle.pop()
+                            break
+                        if self._size < self._maxSize:
+                            self._size += 1
+                            break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        if queued:
+                            self._waiters.remove(ticket)
+                            self._condition.notify_all()
+                        self._stats["checkoutTimeouts"] += 1
+                        raise RuntimeError("Timed out waiting for a database connection from the pool (pool size " + str(self._maxSize) + ")")
+                    if not queued:
+                        queued = True
+                        self._waiters.append(ticket)
+                        if not waited:
+                            waited = True
+                            self._stats["checkoutWaits"] += 1
+                    self._condition.wait(remaining)
+                if queued:
+                    self._waiters.popleft()
+                    if self._waiters and (self._idle or self._size < self._maxSize):
+                        self._condition.notify_all()
+                generation = self._generation
+                self._stats["checkouts"] += 1
+                if waited:
+                    self._stats["checkoutWaitSeconds"] += time.monotonic() - start
+                    start = time.monotonic()
+            for e in evicted:
+                self._closeQuietly(e.connection)
+            if entry is None:
+                try:
+                    entry = self._newEntry()
+                except Exception:
+                    with self._condition:
+                        self._size -= 1
+                        self._condition.notify_all()
+                    raise
+                return PooledConnection(self, entry, generation)
+            if self._isExpired(entry, time.monotonic()):
+                with self._condition:
+                    self._stats["evictedLifetime"] += 1
+                self._discard(entry)
+                continue
+            if self._isUsable(entry, self._prePing):
+                return PooledConnection(self, entry, generation)
+            # stale connection (server restart, failover, idle timeout) -> drop it and try again
+            with self._condition:
+                self._stats["failedValidations"] += 1
+            self._discard(entry)
+
+    def release(self, entry : _PoolEntry, generation : int, pid : int):
+        if pid != os.getpid():
+            with self._condition:
+                self._inherited.append(entry.connection)
+            return
+        with self._condition:
+            outdated = generation != self._generation
+        if outdated:
+            # the pool was disposed while the connection was checked out
+            self._closeQuietly(entry.connection)
+            return
+        try:
+            if self._reset is not None:
+                self._reset(entry.connection)
+            usable = self._isUsable(entry, False)
+        except Exception:
+            with self._condition:
+                self._stats["failedResets"] += 1
+            usable = False
+        now = time.monotonic()
+        if usable and self._isExpired(entry, now):
+            with self._condition:
+                self._stats["evictedLifetime"] += 1
+            usable = False
+        if not usable:
+            self._discard(entry)
+            return
+        entry.lastUsedAt = now
+        with self._condition:
+            self._idle.append(entry)
+            self._condition.notify_all()
+
+    def getStats(self) -> Dict[str, Union[int, float]]:
+        self._checkFork()
+        with self._condition:
+            stats = dict(self._stats)
+            stats["pid"] = self._pid
+            stats["size"] = self._size
+            stats["idle"] = len(self._idle)
+            stats["inUse"] = self._size - len(self._idle)
+            stats["minSize"] = self._minSize
+            stats["maxSize"] = self._maxSize
+        return stats
+
+    def dispose(self):
+        self._checkFork()
+        with self._condition:
+            entries = list(self._idle)
+            self._idle.clear()
+            self._generation += 1
+            self._size = 0
+            self._filled = False
+            self._condition.notify_all()
+        for entry in entries:
+            self._closeQuietly(entry.connection)
+
+
+def create_configured_pool(
+    connect : Callable[[], Any],
+    ping : Callable[[Any], None] = None,
+    reset : Callable[[Any], None] = None,
+    isClosed : Callable[[Any], bool] = None
+) -> ConnectionPool:
+    # pool settings are shared by both backends and resolved through the secrets-store / environment
+    return ConnectionPool(
+        connect,
+        minSize=get_int_configuration("DB_POOL_MIN_SIZE", 1),
+        # one connection per thread of the shipped gunicorn command (--threads=32), a thread never waits for another one's connection
+        maxSize=get_int_configuration("DB_POOL_MAX_SIZE", 32),
+        timeout=get_float_configuration("DB_POOL_TIMEOUT", 30.0),
+        prePing=get_bool_configuration("DB_POOL_PRE_PING", True),
+        ping=ping,
+        reset=reset,
+        isClosed=isClosed,
+        maxIdleTime=get_float_configuration("DB_POOL_MAX_IDLE_TIME", 300.0),
+        maxLifetime=get_float_configuration("DB_POOL_MAX_LIFETIME", 1800.0)
+    )
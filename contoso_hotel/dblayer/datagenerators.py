@@ -1,8 +1,57 @@
 import random, math
-from typing import List
-from datetime import datetime, timedelta
+import numpy as np
+from typing import Iterator, List, Sequence, Tuple, Union
+from datetime import datetime
 
-def generateBookings(visitorId : int, hotelIds : List[int], min_bookings : int = 2, max_bookings : int = 5, startDate: datetime = datetime.now()):
+firstNamesMales = [
+    'Albert', 'Andrew', 'Anthony', 'Ben', 'Bernd', 'Bob', 'Brian', 'Charles', 'Christian', 'Christopher', 'Claus', 'Constantin',
+    'Daniel', 'David', 'Dennis', 'Dieter', 'Donald', 'Dylan', 'Eliah', 'Erik', 'Felix', 'Finn', 'Frank', 'Geoffrey', 'Gregory',
+    'Gustav', 'Hank', 'Hans', 'Heinz', 'Henry', 'Ian', 'Ingo', 'Jack', 'Jake', 'James', 'Johannes', 'John', 'Joos', 'Joseph',
+    'Judson', 'Kevin', 'Klaus', 'Lars', 'Liam', 'Ludwig', 'Lukas', 'Luke', 'Manfred', 'Marco', 'Mark', 'Martin', 'Matthew',
+    'Maximilian', 'Michael', 'Nate', 'Nathan', 'Nico', 'Norbert', 'Oliver', 'Oscar', 'Otto', 'Patrick', 'Patty', 'Paul', 'Peter',
+    'Quincy', 'Quinn', 'Raphael', 'Richard', 'Robert', 'Ronald', 'Rudolf', 'Sam', 'Sebastian', 'Seth', 'Simon', 'Steve', 'Steven',
+    'Theodor', 'Thomas', 'Timothy', 'Tobias', 'Tom', 'Ulrich', 'Ulysses', 'Uwe', 'Valentin', 'Viktor', 'Vince', 'Walter',
+    'Werner', 'William', 'Wolfgang', 'Xander', 'Xaver', 'Xavier', 'Yannick', 'Yara', 'Yves', 'Zach', 'Zacharias', 'Zane', 'Zeno', 'Zoltan',
+]
+firstNamesFemales = [
+    'Alice', 'Amanda', 'Amelie', 'Anastasia', 'Anna', 'Ashley', 'Ava', 'Barbara', 'Cathy', 'Charlotte', 'Chiara', 'Christina',
+    'Clara', 'Diana', 'Elena', 'Elianne', 'Elisabeth', 'Elizabeth', 'Emilia', 'Emily', 'Emma', 'Eva', 'Eve', 'Fiona', 'Frederike',
+    'Frieda', 'Gabrielle', 'Gina', 'Giselle', 'Grace', 'Greta', 'Hanna', 'Helena', 'Helene', 'Irene', 'Iris', 'Isablle', 'Ivy',
+    'Jasmin', 'Jennifer', 'Jenny', 'Jessica', 'Johanna', 'Julia', 'Juliette', 'Kara', 'Katharina', 'Katie', 'Kimberly', 'Klara',
+    'Lara', 'Larissa', 'Laura', 'Lena', 'Lisa', 'Maila', 'Mandy', 'Maren', 'Maria', 'Marie', 'Mathilda', 'Melissa', 'Mia', 'Michelle',
+    'Molly', 'Nadine', 'Natalie', 'Nicole', 'Nina', 'Nora', 'Olive', 'Olivia', 'Pamela', 'Paula', 'Pauline', 'Rachel', 'Rebecca',
+    'Rike', 'Rita', 'Rosa', 'Rosalie', 'Rose', 'Sabrina', 'Sara', 'Saskia', 'Sophia', 'Sophie', 'Stephanie', 'Susan', 'Tabea', 'Tara',
+    'Theresa', 'Tiffany', 'Tina', 'Uma', 'Valerie', 'Vanessa', 'Victoria', 'Vivian', 'Wendy', 'Yara', 'Yvonne', 'Zara', 'Zoe'
+]
+
+lastNames = [
+    'Bach', 'Bachmann', 'Bachmeier', 'Baker', 'Bauer', 'Baumann', 'Beck', 'Becker', 'Bennett', 'Beyer', 'Black', 'Brooks',
+    'Brown', 'Carter', 'Clark', 'Cook', 'Cooper', 'Davis', 'Evans', 'Fisher', 'Fisher', 'Fuchs', 'Gray', 'Grayson', 'Green',
+    'Hall', 'Harrison', 'Henderson', 'Hill', 'Hoffmann', 'Hudson', 'James', 'Johnson', 'Jones', 'Kaiser', 'Kelly', 'King',
+    'Koch', 'Krause', 'Lang', 'Lee', 'Lehmann', 'Meier', 'Meyer', 'Miller', 'Mitchell', 'Morgan', 'Muller', 'Murphy',
+    'Neumann', 'Owens', 'Parker', 'Reed', 'Reiter', 'Richter', 'Ross', 'Ruescher', 'Schmidt', 'Schmitz', 'Schneider',
+    'Schreiber', 'Schulz', 'Schumacher', 'Schuster', 'Smith', 'Spencer', 'Staub', 'Steiner', 'Taylor', 'Thomas', 'Wagner',
+    'Watson', 'Weber', 'Wentlandt', 'White', 'Williams', 'Wilson', 'Wood', 'Wyler', 'Zeder', 'Zeder', 'Zederbauer',
+    'Zederbauer', 'Zehnder', 'Zeller', 'Zellweger', 'Ziegler', 'Zimmer', 'Zimmerman'
+]
+
+# column order of the tuples emitted by the chunk generators, matches the bulk loaders of the db layers
+visitorColumns = ["visitorId", "firstname", "lastname"]
+bookingColumns = ["bookingId", "hotelId", "visitorId", "checkin", "checkout", "adults", "kids", "babies", "rooms", "price"]
+
+# bookings are generated for blocks of this many visitors, so a seed yields the same data regardless of the chunk size
+_generatorBlockSize = 8192
+
+# number of hotels a stay is tried with before it is left out in the capacity aware mode
+_capacityAttempts = 3
+
+# the lists above contain a few names twice, every visitor name is built from the deduplicated lists
+_uniqueFirstNames = sorted(set(firstNamesMales) | set(firstNamesFemales))
+_uniqueLastNames = sorted(set(lastNames))
+_maleFirstNames = set(firstNamesMales)
+
+
+def _validateBookingRange(min_bookings : int, max_bookings : int):
     if min_bookings > max_bookings:
         raise ValueError("min_bookings must be less than or equal to max_bookings")
     if min_bookings < 0:
@@ -13,100 +62,235 @@ def generateBookings(visitorId : int, hotelIds : List[int], min_bookings : int =
         raise ValueError("max_bookings must be greater than 0")
     if max_bookings > 20:
         raise ValueError("max_bookings must be less than or equal to 20")
-    if min_bookings == max_bookings:
-        number = min_bookings
-    else:
-        number = random.randint(min_bookings, max_bookings)
-    if number == 0:
-        return []
-    
-    results = []
-    checkout = startDate
-    for i in range(number):
-        checkin = checkout + timedelta(days=random.randint(0, 14))
-        nights = random.randint(1, 21)
-        checkout = checkin + timedelta(days=nights)
-        adults = random.randint(1, 2)
-        kids = random.randint(0, 4)
-        rooms = int(math.ceil((adults / 2) + (kids / 4)))
-        price = (random.randint(1000, 80000) / 100) * nights * rooms
-        results.append({
-            "visitorid" : visitorId,
-            "hotelid": random.choice(hotelIds),
-            "checkin": checkin.strftime('%Y-%m-%d'),
-            "checkout": checkout.strftime('%Y-%m-%d'),
-            "adults": adults,
-            "kids": kids,
-            "babies": 0,
-            "rooms": rooms,
-            "price": (math.ceil(price * 100) / 100)
-        })
-    return results
-
-
-
-
-def generateVisitorData(numberOfVisitors: int):
-    if numberOfVisitors > 10000:
-        raise ValueError("numberOfVisitors must be less than or equal to 10000")
+
+
+def _namePermutation(seed : Union[int, None]) -> Tuple[int, int, int]:
+    # j -> (a * j + b) mod combinations is a bijection of 0..combinations-1 as long as a and combinations are coprime
+    # so the visitor at index i gets a unique name without tracking the names already handed out
+    combinations = len(_uniqueFirstNames) * len(_uniqueLastNames)
+    rng = random.Random(seed)
+    a = rng.randrange(1, combinations)
+    while math.gcd(a, combinations) != 1:
+        a = rng.randrange(1, combinations)
+    return combinations, a, rng.randrange(combinations)
+
+
+def _nameSuffix(cycle : int) -> str:
+    # once all combinations are used up, every further cycle appends II, III, ... to the lastname
+    number = cycle + 1
+    if number > 3999:
+        return str(number)
+    suffix = ""
+    for value, numeral in [(1000, "M"), (900, "CM"), (500, "D"), (400, "CD"), (100, "C"), (90, "XC"), (50, "L"), (40, "XL"), (10, "X"), (9, "IX"), (5, "V"), (4, "IV"), (1, "I")]:
+        while number >= value:
+            suffix += numeral
+            number -= value
+    return suffix
+
+
+def uniqueVisitorNames(numberOfVisitors : Union[int, None] = None, seed : Union[int, None] = None, offset : int = 0) -> Iterator[Tuple[str, str]]:
+    # yields unique (firstname, lastname) tuples in O(1) memory, None generates names endlessly
+    # offset continues the sequence of an earlier call with the same seed
+    combinations, a, b = _namePermutation(seed)
+    i = offset
+    while numberOfVisitors is None or i < offset + numberOfVisitors:
+        cycle, j = divmod(i, combinations)
+        firstIndex, lastIndex = divmod((a * j + b) % combinations, len(_uniqueLastNames))
+        lastName = _uniqueLastNames[lastIndex]
+        if cycle > 0:
+            lastName += " " + _nameSuffix(cycle)
+        yield _uniqueFirstNames[firstIndex], lastName
+        i += 1
+
+
+def generateVisitorData(numberOfVisitors: int, seed : Union[int, None] = None):
     if numberOfVisitors < 2:
         raise ValueError("numberOfVisitors must be greater than 1")
+    return [
+        {
+            'firstname' : firstName,
+            'lastname'  : lastName,
+            'gender'    : "male" if firstName in _maleFirstNames else "female"
+        }
+        for firstName, lastName in uniqueVisitorNames(numberOfVisitors, seed)
+    ]
 
 
-    firstNamesMales = [
-        'Albert', 'Andrew', 'Anthony', 'Ben', 'Bernd', 'Bob', 'Brian', 'Charles', 'Christian', 'Christopher', 'Claus', 'Constantin',
-        'Daniel', 'David', 'Dennis', 'Dieter', 'Donald', 'Dylan', 'Eliah', 'Erik', 'Felix', 'Finn', 'Frank', 'Geoffrey', 'Gregory',
-        'Gustav', 'Hank', 'Hans', 'Heinz', 'Henry', 'Ian', 'Ingo', 'Jack', 'Jake', 'James', 'Johannes', 'John', 'Joos', 'Joseph',
-        'Judson', 'Kevin', 'Klaus', 'Lars', 'Liam', 'Ludwig', 'Lukas', 'Luke', 'Manfred', 'Marco', 'Mark', 'Martin', 'Matthew',
-        'Maximilian', 'Michael', 'Nate', 'Nathan', 'Nico', 'Norbert', 'Oliver', 'Oscar', 'Otto', 'Patrick', 'Patty', 'Paul', 'Peter',
-        'Quincy', 'Quinn', 'Raphael', 'Richard', 'Robert', 'Ronald', 'Rudolf', 'Sam', 'Sebastian', 'Seth', 'Simon', 'Steve', 'Steven',
-        'Theodor', 'Thomas', 'Timothy', 'Tobias', 'Tom', 'Ulrich', 'Ulysses', 'Uwe', 'Valentin', 'Viktor', 'Vince', 'Walter',
-        'Werner', 'William', 'Wolfgang', 'Xander', 'Xaver', 'Xavier', 'Yannick', 'Yara', 'Yves', 'Zach', 'Zacharias', 'Zane', 'Zeno', 'Zoltan',
-    ]
-    firstNamesFemales = [
-        'Alice', 'Amanda', 'Amelie', 'Anastasia', 'Anna', 'Ashley', 'Ava', 'Barbara', 'Cathy', 'Charlotte', 'Chiara', 'Christina',
-        'Clara', 'Diana', 'Elena', 'Elianne', 'Elisabeth', 'Elizabeth', 'Emilia', 'Emily', 'Emma', 'Eva', 'Eve', 'Fiona', 'Frederike',
-        'Frieda', 'Gabrielle', 'Gina', 'Giselle', 'Grace', 'Greta', 'Hanna', 'Helena', 'Helene', 'Irene', 'Iris', 'Isablle', 'Ivy',
-        'Jasmin', 'Jennifer', 'Jenny', 'Jessica', 'Johanna', 'Julia', 'Juliette', 'Kara', 'Katharina', 'Katie', 'Kimberly', 'Klara',
-        'Lara', 'Larissa', 'Laura', 'Lena', 'Lisa', 'Maila', 'Mandy', 'Maren', 'Maria', 'Marie', 'Mathilda', 'Melissa', 'Mia', 'Michelle',
-        'Molly', 'Nadine', 'Natalie', 'Nicole', 'Nina', 'Nora', 'Olive', 'Olivia', 'Pamela', 'Paula', 'Pauline', 'Rachel', 'Rebecca',
-        'Rike', 'Rita', 'Rosa', 'Rosalie', 'Rose', 'Sabrina', 'Sara', 'Saskia', 'Sophia', 'Sophie', 'Stephanie', 'Susan', 'Tabea', 'Tara',
-        'Theresa', 'Tiffany', 'Tina', 'Uma', 'Valerie', 'Vanessa', 'Victoria', 'Vivian', 'Wendy', 'Yara', 'Yvonne', 'Zara', 'Zoe'
-    ]
+def _toRows(columns : List[np.ndarray], start : int, end : int) -> List[Tuple]:
+    # tolist() converts to native python types, the db drivers do not accept numpy scalars
+    return list(zip(*[c[start:end].tolist() for c in columns]))
 
-    lastNames = [
-        'Bach', 'Bachmann', 'Bachmeier', 'Baker', 'Bauer', 'Baumann', 'Beck', 'Becker', 'Bennett', 'Beyer', 'Black', 'Brooks',
-        'Brown', 'Carter', 'Clark', 'Cook', 'Cooper', 'Davis', 'Evans', 'Fisher', 'Fisher', 'Fuchs', 'Gray', 'Grayson', 'Green',
-        'Hall', 'Harrison', 'Henderson', 'Hill', 'Hoffmann', 'Hudson', 'James', 'Johnson', 'Jones', 'Kaiser', 'Kelly', 'King',
-        'Koch', 'Krause', 'Lang', 'Lee', 'Lehmann', 'Meier', 'Meyer', 'Miller', 'Mitchell', 'Morgan', 'Muller', 'Murphy',
-        'Neumann', 'Owens', 'Parker', 'Reed', 'Reiter', 'Richter', 'Ross', 'Ruescher', 'Schmidt', 'Schmitz', 'Schneider',
-        'Schreiber', 'Schulz', 'Schumacher', 'Schuster', 'Smith', 'Spencer', 'Staub', 'Steiner', 'Taylor', 'Thomas', 'Wagner',
-        'Watson', 'Weber', 'Wentlandt', 'White', 'Williams', 'Wilson', 'Wood', 'Wyler', 'Zeder', 'Zeder', 'Zederbauer',
-        'Zederbauer', 'Zehnder', 'Zeller', 'Zellweger', 'Ziegler', 'Zimmer', 'Zimmerman'
-    ]
 
-    # create a list of unique visitor names
-    visitorNames = {}
-    duplicates = 0
-    while len(visitorNames) < numberOfVisitors:
-        if len(visitorNames) % 2 == 0:
-            firstName = random.choice(firstNamesMales)
-            gender = "male"
-        else:
-            firstName = random.choice(firstNamesFemales)
-            gender = "female"
-        lastName = random.choice(lastNames)
-        k =  firstName + '|' + lastName
-        if k not in visitorNames:
-            duplicates = 0
-            visitorNames[k] = {
-                'firstname' : firstName,
-                'lastname'  : lastName,
-                'gender'    : gender
-            }
-        else:
-            duplicates += 1
-            if duplicates > 1000:
-                raise ValueError("Failed to generate names, too many duplicates generated")
-    return list(visitorNames.values())
+def _sliceChunks(columns : List[np.ndarray], chunkSize : int) -> Iterator[List[Tuple]]:
+    total = len(columns[0])
+    for start in range(0, total, chunkSize):
+        yield _toRows(columns, start, min(total, start + chunkSize))
+
+
+def generateVisitorChunks(numberOfVisitors : int, seed : Union[int, None] = None, chunkSize : int = 10000, firstVisitorId : int = 1) -> Iterator[List[Tuple]]:
+    # vectorized counterpart of generateVisitorData, yields lists of (visitorId, firstname, lastname) tuples
+    # names are the same as uniqueVisitorNames, computed for a whole chunk of indexes at once
+    if numberOfVisitors < 2:
+        raise ValueError("numberOfVisitors must be greater than 1")
+    if chunkSize < 1:
+        raise ValueError("chunkSize must be greater than 0")
+    combinations, a, b = _namePermutation(seed)
+    firstNames = np.array(_uniqueFirstNames)
+    lastNamesUnique = np.array(_uniqueLastNames)
+    for start in range(0, numberOfVisitors, chunkSize):
+        indexes = np.arange(start, min(numberOfVisitors, start + chunkSize), dtype=np.int64)
+        cycles, j = np.divmod(indexes, combinations)
+        firstIndexes, lastIndexes = np.divmod((a * j + b) % combinations, len(lastNamesUnique))
+        chunkLastNames = lastNamesUnique[lastIndexes]
+        if cycles[-1] > 0:
+            firstCycle = int(cycles[0])
+            suffixes = np.array([("" if r == 0 else " " + _nameSuffix(r)) for r in range(firstCycle, int(cycles[-1]) + 1)])
+            chunkLastNames = np.char.add(chunkLastNames, suffixes[cycles - firstCycle])
+        yield _toRows([indexes + firstVisitorId, firstNames[firstIndexes], chunkLastNames], 0, len(indexes))
+
+
+def _hotelWeights(numberOfHotels : int, hotelSkew : float) -> Union[np.ndarray, None]:
+    # 0 is a uniform distribution, greater values concentrate the bookings on the first hotels (zipf like)
+    if hotelSkew <= 0:
+        return None
+    weights = 1.0 / np.power(np.arange(1, numberOfHotels + 1, dtype=np.float64), hotelSkew)
+    return weights / weights.sum()
+
+
+def _fitCapacity(
+    occupancy : np.ndarray,
+    limits : np.ndarray,
+    hotelIndexes : np.ndarray,
+    checkin : np.ndarray,
+    checkout : np.ndarray,
+    rooms : np.ndarray,
+    rng : np.random.Generator,
+    weights : Union[np.ndarray, None]
+) -> np.ndarray:
+    # occupancy holds the used rooms per hotel (rows) and night (columns), a stay uses the nights checkin..checkout-1
+    # returns the mask of accepted candidates, occupancy and hotelIndexes are updated in place
+    numberOfHotels, days = occupancy.shape
+
+    def addStays(indexes : np.ndarray) -> np.ndarray:
+        # sweep line: difference array of the stays, the prefix sum over the nights yields the used rooms
+        diff = np.zeros((numberOfHotels, days + 1), dtype=np.int64)
+        np.add.at(diff, (hotelIndexes[indexes], checkin[indexes]), rooms[indexes])
+        np.add.at(diff, (hotelIndexes[indexes], checkout[indexes]), -rooms[indexes])
+        return np.cumsum(diff, axis=1)[:, :days]
+
+    def touchedNights(nightCounts : np.ndarray, indexes : np.ndarray) -> np.ndarray:
+        # nightCounts is a prefix sum over the nights, the difference counts the nights within each stay
+        h = hotelIndexes[indexes]
+        before = np.where(checkin[indexes] > 0, nightCounts[h, checkin[indexes] - 1], 0)
+        return nightCounts[h, checkout[indexes] - 1] - before
+
+    accepted = np.zeros(len(rooms), dtype=bool)
+    pending = np.arange(len(rooms))
+    for attempt in range(_capacityAttempts):
+        if len(pending) == 0:
+            break
+        if attempt > 0:
+            hotelIndexes[pending] = rng.choice(numberOfHotels, size=len(pending), p=weights)
+        # stays that do not even fit on their own are out for this hotel
+        freeRooms = limits[:, None] - occupancy
+        tooFew = np.stack([np.cumsum(freeRooms < r, axis=1) for r in range(1, int(rooms.max()) + 1)])
+        h = hotelIndexes[pending]
+        before = np.where(checkin[pending] > 0, tooFew[rooms[pending] - 1, h, checkin[pending] - 1], 0)
+        candidates = pending[tooFew[rooms[pending] - 1, h, checkout[pending] - 1] - before == 0]
+        # candidates not touching any night overbooked by all candidates together fit no matter which of the others are accepted
+        overbooked = np.cumsum(occupancy + addStays(candidates) > limits[:, None], axis=1)
+        conflicts = touchedNights(overbooked, candidates) > 0
+        occupancy += addStays(candidates[~conflicts])
+        accepted[candidates[~conflicts]] = True
+        # the others are placed one by one
+        for i in candidates[conflicts]:
+            usedRooms = occupancy[hotelIndexes[i], checkin[i]:checkout[i]]
+            if usedRooms.max() + rooms[i] <= limits[hotelIndexes[i]]:
+                usedRooms += rooms[i]
+                accepted[i] = True
+        pending = pending[~accepted[pending]]
+    return accepted
+
 
+def generateBookingChunks(
+    visitorIds : Sequence[int],
+    hotelIds : Sequence[int],
+    min_bookings : int = 2,
+    max_bookings : int = 5,
+    startDate : datetime = None,
+    seed : Union[int, None] = None,
+    hotelSkew : float = 0.0,
+    chunkSize : int = 10000,
+    firstBookingId : int = 1,
+    hotelCapacities : Union[Sequence[int], None] = None,
+    targetOccupancy : float = 1.0
+) -> Iterator[List[Tuple]]:
+    # yields the generated bookings as lists of tuples in the order of bookingColumns
+    # every visitor gets min_bookings..max_bookings consecutive stays, spread over hotelIds (see _hotelWeights)
+    # with hotelCapacities (totalRooms of every hotel in hotelIds) no night of a hotel gets more than
+    # targetOccupancy * totalRooms rooms booked, stays that do not fit anywhere are left out
+    _validateBookingRange(min_bookings, max_bookings)
+    if len(hotelIds) < 1:
+        raise ValueError("hotelIds must not be empty")
+    if hotelCapacities is not None:
+        if len(hotelCapacities) != len(hotelIds):
+            raise ValueError("hotelCapacities must have the same length as hotelIds")
+        if targetOccupancy <= 0 or targetOccupancy > 1:
+            raise ValueError("targetOccupancy must be greater than 0 and less than or equal to 1")
+    if chunkSize < 1:
+        raise ValueError("chunkSize must be greater than 0")
+    if startDate is None:
+        startDate = datetime.now()
+    startDay = np.datetime64(startDate.date(), "D")
+    hotelIdArray = np.asarray(hotelIds, dtype=np.int64)
+    weights = _hotelWeights(len(hotelIdArray), hotelSkew)
+    visitorIdArray = np.asarray(visitorIds, dtype=np.int64)
+    rng = np.random.default_rng(seed)
+    occupancy = None
+    if hotelCapacities is not None:
+        limits = np.floor(np.asarray(hotelCapacities, dtype=np.float64) * targetOccupancy).astype(np.int64)
+        # the latest checkout is max_bookings stays of at most 14 days gap and 21 nights
+        occupancy = np.zeros((len(hotelIdArray), max_bookings * (14 + 21) + 1), dtype=np.int64)
+    nextBookingId = firstBookingId
+    for blockStart in range(0, len(visitorIdArray), _generatorBlockSize):
+        blockVisitors = visitorIdArray[blockStart:blockStart + _generatorBlockSize]
+        counts = rng.integers(min_bookings, max_bookings + 1, size=len(blockVisitors))
+        total = int(counts.sum())
+        if total == 0:
+            continue
+        gaps = rng.integers(0, 15, size=total)
+        nights = rng.integers(1, 22, size=total)
+        # stays of a visitor follow each other, the checkout is the running sum of gaps and nights within the visitor
+        steps = np.cumsum(gaps + nights)
+        groupEnds = np.cumsum(counts)
+        groupOffsets = np.repeat(np.concatenate(([0], steps))[groupEnds - counts], counts)
+        checkout = steps - groupOffsets
+        checkin = checkout - nights
+        adults = rng.integers(1, 3, size=total)
+        kids = rng.integers(0, 5, size=total)
+        rooms = (2 * adults + kids + 3) // 4
+        price = np.ceil(rng.integers(1000, 80001, size=total) * nights * rooms) / 100
+        hotelIndexes = rng.choice(len(hotelIdArray), size=total, p=weights)
+        bookingVisitors = np.repeat(blockVisitors, counts)
+        if occupancy is not None:
+            accepted = _fitCapacity(occupancy, limits, hotelIndexes, checkin, checkout, rooms, rng, weights)
+            checkin, checkout, adults, kids, rooms, price, hotelIndexes, bookingVisitors = (
+                c[accepted] for c in (checkin, checkout, adults, kids, rooms, price, hotelIndexes, bookingVisitors)
+            )
+            total = len(rooms)
+            if total == 0:
+                continue
+        columns = [
+            np.arange(nextBookingId, nextBookingId + total, dtype=np.int64),
+            hotelIdArray[hotelIndexes],
+            bookingVisitors,
+            (startDay + checkin).astype(str),
+            (startDay + checkout).astype(str),
+            adults,
+            kids,
+            np.zeros(total, dtype=np.int64),
+            rooms,
+            price
+        ]
+        nextBookingId += total
+        yield from _sliceChunks(columns, chunkSize)
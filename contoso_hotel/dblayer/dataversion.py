@@ -0,0 +1,72 @@
+import time, threading
+from typing import Any, Callable, Dict, Iterable, List, Union
+
+from ..config import get_float_configuration
+
+
+# tables with a version, every committed write bumps the versions of the tables it changed
+DATA_VERSION_TABLES = ["hotels", "visitors", "bookings"]
+
+
+class DataVersions:
+    # the versions live in database sequences (one per table), so the writes of all workers are seen and writers never lock each other
+    # every worker caches them for ttlSeconds, reads within that time do not touch the database at all,
+    # so the writes of other workers show up after at most ttlSeconds (bounded staleness, 0 reads them every time)
+    def __init__(
+        self,
+        read : Callable[[], Dict[str, int]],
+        bump : Callable[[Any, List[str]], Dict[str, int]],
+        ttlSeconds : float = 1.0
+    ):
+        self._read = read
+        self._bump = bump
+        self._ttlSeconds = float(ttlSeconds)
+        self._lock = threading.Lock()
+        self._versions = None
+        self._loadedAt = None
+
+    def get(self) -> Union[Dict[str, int], None]:
+        # returns None when the versions cannot be read (i.e. create_schema did not create the sequences yet)
+        with self._lock:
+            if self._loadedAt is not None and time.monotonic() - self._loadedAt < self._ttlSeconds:
+                return self._versions
+        # the database is read without holding the lock, a slow read must not block the other request threads
+        loadedAt = time.monotonic()
+        try:
+            versions = dict(self._read())
+        except Exception:
+            versions = None
+        with self._lock:
+            if versions is not None and self._versions is not None:
+                # versions only grow, a bump or another read published in the meantime may be newer
+                for tableName, version in self._versions.items():
+                    versions[tableName] = max(versions.get(tableName, 0), version)
+            if self._loadedAt is None or loadedAt >= self._loadedAt:
+                self._versions = versions
+                self._loadedAt = loadedAt
+            return self._versions
+
+    def bump(self, connection : Any, tableNames : Iterable[str]):
+        # must be called after the commit, a reader that sees the new version is guaranteed to see the new data
+        try:
+            versions = self._bump(connection, list(tableNames))
+        except Exception:
+            # the write itself is committed, so the caller must not fail, the next get() reads the versions again
+            self.invalidate()
+            return
+        with self._lock:
+            if self._versions is not None:
+                # a new dict, get() handed the current one to other request threads which must not see it change
+                merged = { tableName : max(self._versions.get(tableName, 0), version) for tableName, version in versions.items() }
+                self._versions = { **self._versions, **merged }
+
+    def invalidate(self):
+        with self._lock:
+            self._loadedAt = None
+
+
+def create_configured_data_versions(
+    read : Callable[[], Dict[str, int]],
+    bump : Callable[[Any, List[str]], Dict[str, int]]
+) -> DataVersions:
+    return DataVersions(read, bump, ttlSeconds=get_float_configuration("DATA_VERSION_TTL_SECONDS", 1.0))
@@ -0,0 +1,86 @@
+import io, csv, json
+from datetime import date, datetime
+from typing import Any, Callable, Iterable, Iterator, List, Tuple
+
+
+EXPORT_FORMATS = ["csv", "ndjson"]
+
+# the exported columns of every table, named like in the api responses (the first one is the primary key and the sort order)
+EXPORT_COLUMNS = {
+    "bookings" : ["bookingId", "hotelId", "visitorId", "checkin", "checkout", "adults", "kids", "babies", "rooms", "price"],
+    "visitors" : ["visitorId", "firstname", "lastname"],
+    "hotels" : [
+        "hotelId", "hotelname", "pricePerNight", "totalRooms", "country",
+        "skiing", "suites", "inRoomEntertainment", "conciergeServices", "housekeeping", "petFriendlyOptions", "laundryServices",
+        "roomService", "indoorPool", "outdoorPool", "fitnessCenter", "complimentaryBreakfast", "businessCenter", "freeGuestParking",
+        "complimentaryCoffeaAndTea", "climateControl", "bathroomEssentials"
+    ]
+}
+EXPORT_BOOLEAN_COLUMNS = set(EXPORT_COLUMNS["hotels"][5:])
+
+# the filters every table accepts, fromdate / untildate select the bookings overlapping the range like /api/bookings
+EXPORT_FILTERS = {
+    "bookings" : ["visitorId", "hotelId", "fromdate", "untildate"],
+    "visitors" : ["visitorId"],
+    "hotels" : ["hotelId"]
+}
+
+
+def export_query(tableName : str, placeholder : str, visitorId : int = None, hotelId : int = None, fromdate : datetime = None, untildate : datetime = None) -> Tuple[str, List[Any]]:
+    # the FROM, WHERE and ORDER BY part of the export query, the backend puts its select list in front
+    conditions = []
+    params = []
+    if visitorId is not None:
+        conditions.append("visitorId = " + placeholder)
+        params.append(visitorId)
+    if hotelId is not None:
+        conditions.append("hotelId = " + placeholder)
+        params.append(hotelId)
+    if fromdate is not None:
+        conditions.append("checkout >= " + placeholder)
+        params.append(fromdate.strftime('%Y-%m-%d'))
+    if untildate is not None:
+        conditions.append("checkin <= " + placeholder)
+        params.append(untildate.strftime('%Y-%m-%d'))
+    query = " FROM " + tableName
+    if len(conditions) > 0:
+        query += " WHERE " + " AND ".join(conditions)
+    return query + " ORDER BY " + EXPORT_COLUMNS[tableName][0], params
+
+
+def _export_value(value : Any) -> Any:
+    if isinstance(value, (date, datetime)):
+        return value.strftime('%Y-%m-%d')
+    return value
+
+
+def _csv_value(value : Any) -> Any:
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return _export_value(value)
+
+
+def encode_export_rows(rows : Iterable[Tuple], columns : List[str], format : str, chunkSize : int = 65536) -> Iterator[str]:
+    # encodes the rows (in the order of columns) as csv with a header line or as ndjson, in chunks of roughly chunkSize characters
+    rows = iter(rows)
+    buffer = io.StringIO()
+    try:
+        if format == "csv":
+            writer = csv.writer(buffer, lineterminator="\n")
+            writer.writerow(columns)
+            encode : Callable[[Tuple], None] = lambda row: writer.writerow([_csv_value(value) for value in row])
+        else:
+            encode = lambda row: buffer.write(json.dumps(dict(zip(columns, (_export_value(value) for value in row)))) + "\n")
+        for row in rows:
+            encode(row)
+            if buffer.tell() >= chunkSize:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        if buffer.tell() > 0:
+            yield buffer.getvalue()
+    finally:
+        # hands the database connection back even when the client goes away mid export
+        close = getattr(rows, "close", None)
+        if close is not None:
+            close()
@@ -0,0 +1,71 @@
+import os, threading
+from collections import deque
+from typing import Any, Callable, Dict, Iterable, Union
+
+from ..config import get_int_configuration
+
+
+class IdAllocator:
+    # hands out primary keys from database sequences
+    # with a block size > 1 every worker reserves a whole block of ids at once (hi-lo) and serves inserts from memory
+    def __init__(
+        self,
+        reserve : Callable[[Any, str, int], Iterable[int]],
+        synchronize : Callable[[str], None],
+        blockSize : int = 1
+    ):
+        # synchronize runs on a connection of its own, it must never commit (or see) the transaction of the caller
+        self._reserve = reserve
+        self._synchronize = synchronize
+        self._blockSize = max(1, int(blockSize))
+        self._lock = threading.Lock()
+        self._blocks : Dict[str, deque] = {}
+        self._synchronized = set()
+        self._pid = os.getpid()
+
+    @property
+    def block_size(self) -> int:
+        return self._blockSize
+
+    def _checkFork(self):
+        # a forked worker must never reuse the ids its parent has already reserved
+        if self._pid != os.getpid():
+            self._blocks = {}
+            self._synchronized = set()
+            self._pid = os.getpid()
+
+    def ensure_synchronized(self, sequenceName : str):
+        # rows inserted with explicit ids (old deployments, data population) can be ahead of the sequence
+        # so the sequence is moved past the highest id once per process
+        with self._lock:
+            self._checkFork()
+            if sequenceName in self._synchronized:
+                return
+            self._synchronize(sequenceName)
+            self._synchronized.add(sequenceName)
+
+    def next_id(self, connection : Any, sequenceName : str) -> Union[int, None]:
+        # returns None when the insert statement should draw the id from the sequence itself
+        self.ensure_synchronized(sequenceName)
+        if self._blockSize <= 1:
+            return None
+        with self._lock:
+            self._checkFork()
+            block = self._blocks.get(sequenceName)
+            if not block:
+                block = deque(self._reserve(connection, sequenceName, self._blockSize))
+                self._blocks[sequenceName] = block
+            return block.popleft()
+
+    def invalidate(self):
+        # drop reserved blocks, i.e. after the schema was recreated or the sequences were reset
+        with self._lock:
+            self._blocks = {}
+            self._synchronized = set()
+
+
+def create_configured_id_allocator(
+    reserve : Callable[[Any, str, int], Iterable[int]],
+    synchronize : Callable[[str], None]
+) -> IdAllocator:
+    return IdAllocator(reserve, synchronize, blockSize=get_int_configuration("DB_ID_BLOCK_SIZE", 1))
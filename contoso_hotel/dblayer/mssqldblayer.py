@@ -1,13 +1,26 @@
 import pyodbc
-import os, time, math
+import os, time, threading
 from datetime import datetime, timedelta
-from typing import Dict, Union, Iterable
+from typing import Any, Callable, Dict, List, Tuple, Union, Iterable, Iterator
 from enum import Enum
 
-from . import SQLMode, get_defined_database, get_bool_value
+from . import SQLMode, get_defined_database, get_bool_value, get_amenities, parse_amenities, get_page_limit, encode_cursor, decode_cursor, cursor_date, build_page, escape_like, chunked
+from .connectionpool import ConnectionPool, PooledConnection, create_configured_pool
+from .idallocator import IdAllocator, create_configured_id_allocator
+from .occupancy import OccupancyEngine, create_configured_occupancy_engine
+from .dataversion import DataVersions, DATA_VERSION_TABLES, create_configured_data_versions
+from .changehub import ChangeHub, create_configured_change_hub
+from .batch import WriteEffects, run_batch
+from .bookingimport import BOOKING_IMPORT_COLUMNS, check_booking_values, plan_booking_import, booking_import_stays
+from .export import EXPORT_COLUMNS, export_query, encode_export_rows
+from .rowmapper import RowMapper
+from ..config import get_int_configuration
 
+# we pool connections ourselves, don't stack the ODBC driver manager pool on top of it
+pyodbc.pooling = False
 
-def get_mssql_connection() -> pyodbc.Connection:
+
+def create_mssql_connection() -> pyodbc.Connection:
     connectionstring, connectionname = get_defined_database()
     if connectionname != "MSSQL_CONNECTION_STRING":
         raise ValueError("Connection string is not for MSSQL")
@@ -17,6 +30,321 @@ def get_mssql_connection() -> pyodbc.Connection:
     return pyodbc.connect(connectionstring)
 
 
+def _ping_mssql_connection(connection : pyodbc.Connection):
+    cursor = connection.cursor()
+    cursor.execute("SELECT 1")
+    cursor.fetchall()
+    cursor.close()
+
+def _reset_mssql_connection(connection : pyodbc.Connection):
+    # reset-on-return: drop any open transaction and restore the driver defaults a caller might have changed
+    connection.rollback()
+    if connection.autocommit:
+        connection.autocommit = False
+    connection.timeout = 0
+
+_pool = None
+_poolConnectionString = None
+_poolLock = threading.Lock()
+
+def get_mssql_pool() -> ConnectionPool:
+    global _pool, _poolConnectionString
+    connectionstring, connectionname = get_defined_database()
+    if _pool is None or _poolConnectionString != connectionstring:
+        with _poolLock:
+            if _pool is not None and _poolConnectionString != connectionstring:
+                # connection string was rotated, drain the pool so new checkouts use the new credentials
+                _pool.dispose()
+                _pool = None
+            if _pool is None:
+                _pool = create_configured_pool(
+                    create_mssql_connection,
+                    ping=_ping_mssql_connection,
+                    reset=_reset_mssql_connection,
+                    isClosed=lambda connection: getattr(connection, "closed", False)
+                )
+                _poolConnectionString = connectionstring
+    return _pool
+
+def get_mssql_connection() -> PooledConnection:
+    # the returned connection goes back to the pool on close()
+    return get_mssql_pool().acquire()
+
+def get_pool_stats() -> Dict[str, Union[int, float]]:
+    return get_mssql_pool().getStats()
+
+
+# sequences feeding the primary keys -> (table, primary key)
+_sequenceColumns = {
+    "hotels_seq" : ("hotels", "hotelId"),
+    "visitors_seq" : ("visitors", "visitorId"),
+    "bookings_seq" : ("bookings", "bookingId")
+}
+
+def _create_mssql_sequence_statement(sequenceName : str) -> str:
+    return "IF OBJECT_ID('" + sequenceName + "', 'SO') IS NULL CREATE SEQUENCE " + sequenceName + " AS INT START WITH 1 INCREMENT BY 1 CACHE 50;"
+
+def _synchronize_mssql_sequence(sequenceName : str):
+    tableName, columnName = _sequenceColumns[sequenceName]
+    # a dedicated connection, the commit must not end the transaction of the write that needs the id
+    # (and the pool might have no connection left while the caller holds one)
+    connection = create_mssql_connection()
+    try:
+        cursor = connection.cursor()
+        # databases created before the sequences existed get them on first use, then the sequence is moved past the highest id
+        cursor.execute(_create_mssql_sequence_statement(sequenceName) + """
+            DECLARE @maxId BIGINT = (SELECT ISNULL(MAX(""" + columnName + """), 0) FROM """ + tableName + """);
+            DECLARE @nextId BIGINT = (
+                SELECT CASE WHEN CAST(last_used_value AS BIGINT) IS NULL THEN CAST(start_value AS BIGINT) ELSE CAST(last_used_value AS BIGINT) + 1 END
+                FROM sys.sequences WHERE object_id = OBJECT_ID('""" + sequenceName + """')
+            );
+            IF @maxId >= @nextId
+            BEGIN
+                DECLARE @restartStmt NVARCHAR(200) = N'ALTER SEQUENCE """ + sequenceName + """ RESTART WITH ' + CAST(@maxId + 1 AS NVARCHAR(20));
+                EXEC sp_executesql @restartStmt;
+            END
+        """)
+        cursor.close()
+        connection.commit()
+    finally:
+        connection.close()
+
+def _reserve_mssql_ids(connection : pyodbc.Connection, sequenceName : str, count : int) -> Iterable[int]:
+    cursor = connection.cursor()
+    cursor.execute("""
+        SET NOCOUNT ON;
+        DECLARE @firstValue SQL_VARIANT;
+        EXEC sp_sequence_get_range @sequence_name = ?, @range_size = ?, @range_first_value = @firstValue OUTPUT;
+        SELECT CAST(@firstValue AS BIGINT) AS firstValue;
+    """, (sequenceName, count))
+    firstValue = int(cursor.fetchone().firstValue)
+    cursor.close()
+    return range(firstValue, firstValue + count)
+
+_idAllocator = None
+
+def get_mssql_id_allocator() -> IdAllocator:
+    global _idAllocator
+    if _idAllocator is None:
+        with _poolLock:
+            if _idAllocator is None:
+                _idAllocator = create_configured_id_allocator(_reserve_mssql_ids, _synchronize_mssql_sequence)
+    return _idAllocator
+
+
+_occupancyBookingsSelect = "SELECT bookingId, hotelId, DATEDIFF(DAY, '19700101', checkin), DATEDIFF(DAY, '19700101', checkout), rooms FROM bookings"
+
+def _load_mssql_occupancy() -> Tuple[List[Tuple[int, int]], List[Tuple[int, int, int, int, int]], Tuple[int, float]]:
+    connection = get_mssql_connection()
+    cursor = connection.cursor()
+    # the position in the change log is read before the tables (like the token of get_booking_changes)
+    cursor.execute("SELECT CAST(MIN_ACTIVE_ROWVERSION() AS BIGINT) AS watermark")
+    position = (cursor.fetchone().watermark, time.time())
+    cursor.execute("SELECT hotelId, totalRooms FROM hotels ORDER BY hotelId")
+    hotels = [tuple(row) for row in cursor.fetchall()]
+    cursor.execute(_occupancyBookingsSelect)
+    bookings = [tuple(row) for row in cursor.fetchall()]
+    cursor.close()
+    connection.close()
+    return hotels, bookings, position
+
+def _load_mssql_occupancy_changes(position : Tuple[int, float]) -> Union[Tuple[List[Tuple[int, int, int, int, int]], List[int], Tuple[int, float]], None]:
+    # the bookings changed after position, None when the change log was reset or pruned since then
+    retention = get_int_configuration("BOOKING_CHANGES_RETENTION_SECONDS", 86400)
+    if position is None or position[1] < time.time() - retention:
+        return None
+    connection = get_mssql_connection()
+    cursor = connection.cursor()
+    cursor.execute("SELECT CAST(MIN_ACTIVE_ROWVERSION() AS BIGINT) AS watermark")
+    watermark = cursor.fetchone().watermark
+    cursor.execute(
+        "SELECT DISTINCT bookingId FROM booking_changes " +
+        "WHERE changeVersion >= CAST(CAST(? AS BIGINT) AS BINARY(8)) AND changeVersion < CAST(CAST(? AS BIGINT) AS BINARY(8))",
+        (position[0], watermark)
+    )
+    bookingIds = [row.bookingId for row in cursor.fetchall()]
+    bookings = []
+    if None not in bookingIds:
+        # stays below the limit of 2100 parameters per statement
+        for chunk in chunked(bookingIds, 1000):
+            cursor.execute(_occupancyBookingsSelect + " WHERE bookingId IN (" + ", ".join("?" for b in chunk) + ")", chunk)
+            bookings.extend(tuple(row) for row in cursor.fetchall())
+    cursor.close()
+    connection.close()
+    if None in bookingIds:
+        # setupDb dropped or populated the tables
+        return None
+    found = set(booking[0] for booking in bookings)
+    return bookings, [bookingId for bookingId in bookingIds if bookingId not in found], (watermark, time.time())
+
+_occupancyEngine = None
+
+def get_mssql_occupancy_engine() -> OccupancyEngine:
+    global _occupancyEngine
+    if _occupancyEngine is None:
+        with _poolLock:
+            if _occupancyEngine is None:
+                _occupancyEngine = create_configured_occupancy_engine(_load_mssql_occupancy, _load_mssql_occupancy_changes, get_data_versions)
+    return _occupancyEngine
+
+def get_availability(hotelId : int, fromdate : datetime, untildate : datetime) -> Dict[str, Any]:
+    return get_mssql_occupancy_engine().get_availability(hotelId, fromdate, untildate)
+
+
+# one sequence per table, they survive drop_schema so a recreated database never repeats an old version
+_dataVersionSequences = { tableName : "data_version_" + tableName for tableName in DATA_VERSION_TABLES }
+
+def _read_mssql_data_versions() -> Dict[str, int]:
+    connection = get_mssql_connection()
+    cursor = connection.cursor()
+    # last_used_value stays NULL until the first NEXT VALUE FOR
+    cursor.execute(
+        "SELECT name, ISNULL(CAST(last_used_value AS BIGINT), 0) AS version FROM sys.sequences WHERE name IN (" + ", ".join("?" for tableName in DATA_VERSION_TABLES) + ")",
+        tuple(_dataVersionSequences[tableName] for tableName in DATA_VERSION_TABLES)
+    )
+    versions = { row.name : row.version for row in cursor.fetchall() }
+    cursor.close()
+    connection.close()
+    if len(versions) != len(DATA_VERSION_TABLES):
+        raise RuntimeError("Data version sequences do not exist")
+    return { tableName : versions[_dataVersionSequences[tableName]] for tableName in DATA_VERSION_TABLES }
+
+def _bump_mssql_data_versions(connection : pyodbc.Connection, tableNames : List[str]) -> Dict[str, int]:
+    # every committed write passes here, MSSQL has no LISTEN / NOTIFY so the change hub of this worker is woken up directly
+    # (the writes of other workers are picked up by its poll)
+    get_mssql_change_hub().notify()
+    # NEXT VALUE FOR is not transactional, the new versions are visible to all workers right away
+    cursor = connection.cursor()
+    cursor.execute("SELECT " + ", ".join("NEXT VALUE FOR " + _dataVersionSequences[tableName] for tableName in tableNames))
+    row = cursor.fetchone()
+    cursor.close()
+    return dict(zip(tableNames, tuple(row)))
+
+_dataVersions = None
+
+def get_mssql_data_versions() -> DataVersions:
+    global _dataVersions
+    if _dataVersions is None:
+        with _poolLock:
+            if _dataVersions is None:
+                _dataVersions = create_configured_data_versions(_read_mssql_data_versions, _bump_mssql_data_versions)
+    return _dataVersions
+
+def get_data_versions() -> Union[Dict[str, int], None]:
+    return get_mssql_data_versions().get()
+
+def _apply_write_effects(connection : pyodbc.Connection, effects : WriteEffects):
+    # must be called after the commit
+    if len(effects.tableNames) > 0:
+        get_mssql_data_versions().bump(connection, effects.tableNames)
+    for callback in effects.callbacks:
+        callback()
+
+def _run_write(write : Callable[[pyodbc.Connection, WriteEffects], Any]) -> Any:
+    # runs write in a transaction of its own
+    effects = WriteEffects()
+    connection = get_mssql_connection()
+    try:
+        result = write(connection, effects)
+        connection.commit()
+        _apply_write_effects(connection, effects)
+    finally:
+        # a failed write is rolled back when the connection returns to the pool
+        connection.close()
+    return result
+
+def _mssql_savepoint(connection : pyodbc.Connection):
+    cursor = connection.cursor()
+    # with autocommit off the driver runs in implicit transaction mode, reading a table opens the transaction the savepoint needs
+    cursor.execute("IF @@TRANCOUNT = 0 SELECT TOP 0 hotelId FROM hotels; SAVE TRANSACTION batch_operation")
+    cursor.close()
+
+def _rollback_mssql_savepoint(connection : pyodbc.Connection) -> bool:
+    cursor = connection.cursor()
+    cursor.execute("SELECT XACT_STATE() AS xactState")
+    xactState = cursor.fetchone().xactState
+    # errors thrown by triggers (i.e. the day usage capacity check) already rolled back or doomed the whole transaction
+    if xactState == 1:
+        cursor.execute("ROLLBACK TRANSACTION batch_operation")
+    cursor.close()
+    return xactState == 1
+
+# the data of the operations is validated and converted by the view, the keys are the parameter names of the write functions
+_batchHandlers = {
+    ("create", "booking") : lambda connection, effects, data: _create_booking(connection, effects, **data),
+    ("delete", "booking") : lambda connection, effects, data: { "deleted" : _delete_booking(connection, effects, data["bookingId"]), "bookingId" : data["bookingId"] },
+    ("create", "visitor") : lambda connection, effects, data: _manage_visitor(connection, effects, sqlmode=SQLMode.INSERT, **data),
+    ("update", "visitor") : lambda connection, effects, data: _manage_visitor(connection, effects, sqlmode=SQLMode.UPDATE, **data),
+    ("delete", "visitor") : lambda connection, effects, data: { "deleted" : _delete_visitor(connection, effects, data["visitorId"]), "visitorId" : data["visitorId"] },
+    ("create", "hotel") : lambda connection, effects, data: _manage_hotel(connection, effects, sqlmode=SQLMode.INSERT, **data),
+    ("update", "hotel") : lambda connection, effects, data: _manage_hotel(connection, effects, sqlmode=SQLMode.UPDATE, **data),
+    ("delete", "hotel") : lambda connection, effects, data: { "deleted" : _delete_hotel(connection, effects, data["hotelId"]), "hotelId" : data["hotelId"] }
+}
+
+def execute_batch(operations : List[Dict[str, Any]], atomic : bool = True) -> Dict[str, Any]:
+    # all operations run on one connection in one transaction
+    connection = get_mssql_connection()
+    try:
+        # synchronized before the batch writes, the dedicated connection of the synchronization would wait for their locks
+        for sequenceName in _sequenceColumns:
+            get_mssql_id_allocator().ensure_synchronized(sequenceName)
+        results, commit, effects = run_batch(
+            connection, operations, _batchHandlers,
+            _mssql_savepoint, _rollback_mssql_savepoint, None,
+            atomic
+        )
+        if commit:
+            connection.commit()
+            _apply_write_effects(connection, effects)
+    finally:
+        connection.close()
+    return { "success" : all(result["success"] for result in results), "atomic" : atomic, "committed" : commit, "results" : results }
+
+
+def bulk_insert(connection : pyodbc.Connection, tableName : str, columns : List[str], rows : Iterable[Tuple], chunkSize : int = None) -> int:
+    if chunkSize is None:
+        chunkSize = get_int_configuration("DB_BULK_CHUNK_SIZE", 10000)
+    return bulk_insert_chunks(connection, tableName, columns, chunked(rows, chunkSize))
+
+
+def bulk_insert_chunks(connection : pyodbc.Connection, tableName : str, columns : List[str], chunks : Iterable[List[Tuple]]) -> int:
+    # fast_executemany sends a whole chunk as one parameter array, one round trip per chunk instead of one per row
+    insertStmt = "INSERT INTO " + tableName + " (" + ", ".join(columns) + ") VALUES (" + ", ".join("?" for c in columns) + ")"
+    cursor = connection.cursor()
+    cursor.fast_executemany = True
+    count = 0
+    for chunk in chunks:
+        cursor.executemany(insertStmt, chunk)
+        count += len(chunk)
+    cursor.close()
+    return count
+
+
+def _stream_rows(query : str, params : List[Any], mapper : RowMapper = None) -> Iterator[Dict[str, Union[int, str, float, bool]]]:
+    # rows are fetched in batches of DB_STREAM_BATCH_SIZE instead of all at once, without a mapper they are yielded as they are
+    connection = get_mssql_connection()
+    cursor = None
+    try:
+        cursor = connection.cursor()
+        batchSize = max(1, get_int_configuration("DB_STREAM_BATCH_SIZE", 1000))
+        cursor.execute(query, params)
+        mapRow = (lambda row: row) if mapper is None else mapper.compile(cursor.description)
+        while True:
+            rows = cursor.fetchmany(batchSize)
+            if not rows:
+                break
+            for row in rows:
+                yield mapRow(row)
+    finally:
+        # also runs when the client disconnects and the generator gets closed early
+        if cursor is not None:
+            try:
+                cursor.close()
+            except Exception:
+                pass
+        connection.close()
+
+
 def longsqlrequest() -> int:
     connection = get_mssql_connection()
     cursor = connection.cursor()
@@ -31,98 +359,97 @@ def longsqlrequest() -> int:
     return 10 + 10
 
 def create_booking(hotelId : int, visitorId : int, checkin : datetime, checkout : datetime, adults : int, kids : int, babies : int, rooms : int = None, price : float = None, bookingId : int = None) -> Dict[str, Union[int, str, float, bool]]:
-    if adults <= 0:
-        raise ValueError("At least one adult is required")
-    if checkin >= checkout:
-        raise ValueError("Checkin date must be before checkout date")
-    if rooms is None:
-        rooms = int(math.ceil((adults / 2) + (kids / 4) + (babies / 8)))
-    elif rooms < int(math.ceil((adults / 2) + (kids / 4) + (babies / 8))):
-        raise ValueError("Not enough rooms for the number of guests")
+    return _run_write(lambda connection, effects: _create_booking(connection, effects, hotelId, visitorId, checkin, checkout, adults, kids, babies, rooms, price, bookingId))
 
-    connection = get_mssql_connection()
-    # checking hotel exists
+def _create_booking(connection : pyodbc.Connection, effects : WriteEffects, hotelId : int, visitorId : int, checkin : datetime, checkout : datetime, adults : int, kids : int, babies : int, rooms : int = None, price : float = None, bookingId : int = None, newBookingId : int = None) -> Dict[str, Union[int, str, float, bool]]:
+    # bookingId is only checked for duplicates, newBookingId is the id to insert (a new one from the sequence without it)
+    rooms = check_booking_values(checkin, checkout, adults, kids, babies, rooms)
+
+    # one round trip: hotel / visitor existence, duplicate check, price calculation and insert are done server side
+    if newBookingId is None:
+        newBookingId = get_mssql_id_allocator().next_id(connection, "bookings_seq")
     cursor = connection.cursor()
-    cursor.execute("SELECT hotelId, pricePerNight FROM hotels WHERE hotelId = ?", (hotelId))
+    try:
+        cursor.execute("""
+            SET NOCOUNT ON;
+            DECLARE @hotelId INT = ?, @visitorId INT = ?, @bookingId INT = ?, @newBookingId INT = ?, @checkin DATE = ?, @checkout DATE = ?, @nights INT = ?;
+            DECLARE @adults INT = ?, @kids INT = ?, @babies INT = ?, @rooms INT = ?, @price FLOAT = ?;
+            DECLARE @hotelExists INT = 0, @visitorExists INT = 0, @duplicates INT = 0, @pricePerNight FLOAT;
+            DECLARE @inserted TABLE (bookingId INT, price FLOAT);
+
+            SELECT @hotelExists = 1, @pricePerNight = pricePerNight FROM hotels WHERE hotelId = @hotelId;
+            SELECT @visitorExists = count(*) FROM visitors WHERE visitorId = @visitorId;
+            SELECT @duplicates = count(*) FROM bookings
+            WHERE bookingId = @bookingId
+               OR (hotelId = @hotelId AND visitorId = @visitorId AND checkin = @checkin AND checkout = @checkout);
+
+            IF @hotelExists = 1 AND @visitorExists > 0 AND @duplicates = 0
+            BEGIN
+                IF @price IS NULL OR @price <= 0
+                    SET @price = @pricePerNight * @nights * @rooms;
+                IF @newBookingId IS NULL
+                    SET @newBookingId = NEXT VALUE FOR bookings_seq;
+                INSERT INTO bookings (bookingId, hotelId, visitorId, checkin, checkout, adults, kids, babies, rooms, price)
+                OUTPUT INSERTED.bookingId, INSERTED.price INTO @inserted
+                VALUES (@newBookingId, @hotelId, @visitorId, @checkin, @checkout, @adults, @kids, @babies, @rooms, @price);
+                SELECT @price = price FROM @inserted;
+            END
+
+            SELECT @hotelExists AS hotelExists, @visitorExists AS visitorExists, @duplicates AS duplicates, (SELECT bookingId FROM @inserted) AS bookingId, @price AS price;
+        """, (hotelId, visitorId, bookingId, newBookingId, checkin.strftime('%Y-%m-%d'), checkout.strftime('%Y-%m-%d'), (checkout - checkin).days, adults, kids, babies, rooms, price))
+    except pyodbc.Error as e:
+        # thrown by the day usage trigger
+        cursor.close()
+        if str(_capacityError) in str(e) and "Not enough rooms available" in str(e):
+            raise ValueError("Not enough rooms available")
+        raise
     row = cursor.fetchone()
-    if row is not None:
-        hotelExists = True
-        if price is None or price <= 0:
-            price = row.pricePerNight * (checkout - checkin).days * rooms
-    else:
-        hotelExists = False
     cursor.close()
-    if not hotelExists:
+    if row.hotelExists <= 0:
         raise ValueError("Hotel does not exist")
-    # checking visitor exists
-    cursor = connection.cursor()
-    cursor.execute("SELECT count(*) as num FROM visitors WHERE visitorId = ?", (visitorId))
-    row = cursor.fetchone()
-    visitorExists = row.num > 0
-    cursor.close()
-    if not visitorExists:
+    if row.visitorExists <= 0:
         raise ValueError("Visitor does not exist")
-    # checking if booking already exists and getting next bookingId
-    cursor = connection.cursor()
-    if bookingId is None:
-        cursor.execute("SELECT count(*) as num, (select max(b.bookingId) from bookings as b) as currentMaxId FROM bookings WHERE hotelId = ? and visitorId = ? and checkin = ? and checkout = ?", (hotelId, visitorId, checkin.strftime('%Y-%m-%d'), checkout.strftime('%Y-%m-%d')))
-    else:
-        cursor.execute("SELECT count(*) as num, (select max(b.bookingId) from bookings as b) as currentMaxId FROM bookings WHERE bookingId = ? or (hotelId = ? and visitorId = ? and checkin = ? and checkout = ?)", (bookingId, hotelId, visitorId, checkin.strftime('%Y-%m-%d'), checkout.strftime('%Y-%m-%d')))
-    row = cursor.fetchone()
-    alreadyExists = row.num > 0
-    nextId = row.currentMaxId + 1
-    cursor.close()
-    
-    if alreadyExists:
+    if row.duplicates > 0:
         raise RuntimeError("Booking already exists")
+    nextId = row.bookingId
+    price = row.price
+    effects.touch("bookings")
+    effects.after_commit(lambda: get_mssql_occupancy_engine().add_booking(nextId, hotelId, checkin, checkout, rooms))
+    return { "bookingId" : nextId, "hotelId" : hotelId, "visitorId" : visitorId, "checkin" : checkin.strftime('%Y-%m-%d'), "checkout" : checkout.strftime('%Y-%m-%d'), "adults" : adults, "kids" : kids, "babies" : babies, "rooms" : rooms, "price" : price }
 
-    if nextId <= 0:
-        nextId = 1
-    
+def delete_booking(bookingId : int) -> bool:
+    return _run_write(lambda connection, effects: _delete_booking(connection, effects, bookingId))
+
+def _delete_booking(connection : pyodbc.Connection, effects : WriteEffects, bookingId : int) -> bool:
     cursor = connection.cursor()
-    cursor.execute("INSERT INTO bookings (bookingId, hotelId, visitorId, checkin, checkout, adults, kids, babies, rooms, price) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (nextId, hotelId, visitorId, checkin.strftime('%Y-%m-%d'), checkout.strftime('%Y-%m-%d'), adults, kids, babies, rooms, price))
+    cursor.execute("""
+        SET NOCOUNT ON;
+        DECLARE @deleted TABLE (hotelId INT, checkin DATE, checkout DATE, rooms INT);
+        DELETE FROM bookings OUTPUT DELETED.hotelId, DELETED.checkin, DELETED.checkout, DELETED.rooms INTO @deleted WHERE bookingId = ?;
+        SELECT hotelId, checkin, checkout, rooms FROM @deleted;
+    """, (bookingId))
+    row = cursor.fetchone()
     cursor.close()
-    connection.commit()
-    connection.close()
-    return { "bookingId" : nextId, "hotelId" : hotelId, "visitorId" : visitorId, "checkin" : checkin.strftime('%Y-%m-%d'), "checkout" : checkout.strftime('%Y-%m-%d'), "adults" : adults, "kids" : kids, "babies" : babies, "rooms" : rooms, "price" : price }
+    if row is None:
+        return False
+    effects.touch("bookings")
+    effects.after_commit(lambda: get_mssql_occupancy_engine().remove_booking(bookingId))
+    return True
 
-def delete_booking(bookingId : int) -> bool:
-    connection = get_mssql_connection()
-    requiresDeletion = tablePrimaryKeyExists(connection, "bookings", bookingId)
-    if requiresDeletion:
-        cursor = connection.cursor()
-        cursor.execute("DELETE FROM bookings WHERE bookingId = ?", (bookingId))
-        cursor.close()
-        connection.commit()
-    connection.close()
-    return requiresDeletion
+_bookingMapper = RowMapper("bookingId", "hotelId", "visitorId", "checkin", "checkout", "adults", "kids", "babies", "rooms", "price")
 
 def get_booking(bookingId : int) -> Dict[str, Union[int, str, float, bool]]:
     connection = get_mssql_connection()
     cursor = connection.cursor()
-    cursor.execute("select bookingId, hotelId, visitorId, checkin, checkout, adults, kids, babies, rooms, price from bookings where bookingId = ?", (bookingId))
-    row = cursor.fetchone()
-    if row is None:
-        return {}
-    booking = {
-        "bookingId" : row.bookingId,
-        "hotelId" : row.hotelId,
-        "visitorId" : row.visitorId,
-        "checkin" : row.checkin.strftime('%Y-%m-%d'),
-        "checkout" : row.checkout.strftime('%Y-%m-%d'),
-        "adults" : row.adults,
-        "kids" : row.kids,
-        "babies" : row.babies,
-        "rooms" : row.rooms,
-        "price" : row.price
-    }
+    cursor.execute("select " + _bookingMapper.columns + " from bookings where bookingId = ?", (bookingId))
+    booking = _bookingMapper.fetchone(cursor)
     cursor.close()
     connection.close()
+    if booking is None:
+        return {}
     return booking
 
-def get_bookings(visitorId : int = None, hotelId : int = None, fromdate : datetime = None, untildate : datetime = None) -> Iterable[Dict[str, Union[int, str, float, bool]]]:
-    params = []
-    query = """
+_bookingsSelect = """
     select
         bookings.bookingId,
         bookings.checkin,
@@ -140,6 +467,10 @@ def get_bookings(visitorId : int = None, hotelId : int = None, fromdate : dateti
     from bookings
     left join visitors on visitors.visitorId = bookings.visitorId
     """
+
+def _bookings_query(visitorId : int = None, hotelId : int = None, fromdate : datetime = None, untildate : datetime = None, limit : int = None, cursor : str = None) -> Tuple[str, List[Any], Union[int, None]]:
+    params = []
+    query = _bookingsSelect
     if visitorId is not None:
         if len(params) <= 0:
             query += "where "
@@ -168,48 +499,220 @@ def get_bookings(visitorId : int = None, hotelId : int = None, fromdate : dateti
             query += " and "
         query += "bookings.checkin <= ?"
         params.append(untildate.strftime('%Y-%m-%d'))
+    # keyset pagination on the sort order, every page costs the same no matter how deep the client pages
+    limit = get_page_limit(limit, cursor)
+    after = decode_cursor("bookings", cursor, [cursor_date, cursor_date, int])
+    if after is not None:
+        if len(params) <= 0:
+            query += "where "
+        else:
+            query += " and "
+        query += "(bookings.checkin < ? or (bookings.checkin = ? and (bookings.checkout < ? or (bookings.checkout = ? and bookings.bookingId < ?))))"
+        params.extend([after[0], after[0], after[1], after[1], after[2]])
     query += " order by bookings.checkin desc, bookings.checkout desc, bookings.bookingId desc"
+    if limit is not None:
+        query += " offset 0 rows fetch next ? rows only"
+        params.append(limit + 1)
+    return query, params, limit
+
+# the rows of _bookingsSelect
+_bookingListMapper = RowMapper("bookingId", "checkin", "checkout", "adults", "kids", "babies", "rooms", "price", "hotelId", "hotelname", "visitorId", "firstname", "lastname")
+
+def get_bookings(visitorId : int = None, hotelId : int = None, fromdate : datetime = None, untildate : datetime = None, limit : int = None, cursor : str = None) -> Union[Iterable[Dict[str, Union[int, str, float, bool]]], Dict[str, Any]]:
+    query, params, limit = _bookings_query(visitorId, hotelId, fromdate, untildate, limit, cursor)
     connection = get_mssql_connection()
     cursor = connection.cursor()
     cursor.execute(query, params)
-    bookings = []
-    for row in cursor.fetchall():
-        bookings.append({
-            "bookingId" : row.bookingId,
-            "checkin" : row.checkin.strftime('%Y-%m-%d'),
-            "checkout" : row.checkout.strftime('%Y-%m-%d'),
-            "adults" : row.adults,
-            "kids" : row.kids,
-            "babies" : row.babies,
-            "rooms" : row.rooms,
-            "price" : row.price,
-            "hotelId" : row.hotelId,
-            "hotelname" : row.hotelname,
-            "visitorId" : row.visitorId,
-            "firstname" : row.firstname,
-            "lastname" : row.lastname
-        })
+    bookings = _bookingListMapper.fetchall(cursor)
     cursor.close()
     connection.close()
+    if limit is not None:
+        return build_page(bookings, limit, "bookings", ["checkin", "checkout", "bookingId"])
     return bookings
 
+def stream_bookings(visitorId : int = None, hotelId : int = None, fromdate : datetime = None, untildate : datetime = None) -> Iterator[Dict[str, Union[int, str, float, bool]]]:
+    query, params, limit = _bookings_query(visitorId, hotelId, fromdate, untildate)
+    return _stream_rows(query, params, _bookingListMapper)
+
+_lastChangesPrune = 0.0
+
+def get_booking_changes(since : str = None) -> Dict[str, Any]:
+    global _lastChangesPrune
+    # the token holds the low watermark of the previous call: all rowversions below it are committed,
+    # so rows of transactions that commit out of order are never skipped, they just show up one call later
+    retention = get_int_configuration("BOOKING_CHANGES_RETENTION_SECONDS", 86400)
+    after = decode_cursor("bookingchanges", since, [int, float])
+    # without a token, or with one older than the change log, the client gets all bookings and has to replace its list
+    reset = after is None or after[1] < time.time() - retention
+    connection = get_mssql_connection()
+    cursor = connection.cursor()
+    cursor.execute("SELECT CAST(MIN_ACTIVE_ROWVERSION() AS BIGINT) AS watermark")
+    watermark = cursor.fetchone().watermark
+    changes = []
+    if not reset:
+        cursor.execute(
+            "SELECT bookingId, operation FROM booking_changes " +
+            "WHERE changeVersion >= CAST(CAST(? AS BIGINT) AS BINARY(8)) AND changeVersion < CAST(CAST(? AS BIGINT) AS BINARY(8)) ORDER BY changeVersion",
+            (after[0], watermark)
+        )
+        operations = {}
+        for row in cursor.fetchall():
+            if row.operation == 'R':
+                # setupDb dropped or populated the tables
+                reset = True
+                break
+            # the first operation tells whether the client can know the booking already, the position is the last change
+            first = operations.pop(row.bookingId, row.operation)
+            operations[row.bookingId] = first
+    if reset:
+        cursor.execute(_bookingsSelect + " order by bookings.checkin desc, bookings.checkout desc, bookings.bookingId desc")
+        changes = [{ "operation" : "insert", "bookingId" : booking["bookingId"], "booking" : booking } for booking in _bookingListMapper.fetchall(cursor)]
+    elif len(operations) > 0:
+        bookings = {}
+        # stays below the limit of 2100 parameters per statement
+        for bookingIds in chunked(operations, 1000):
+            cursor.execute(_bookingsSelect + " where bookings.bookingId in (" + ", ".join("?" for b in bookingIds) + ")", bookingIds)
+            for booking in _bookingListMapper.fetchall(cursor):
+                bookings[booking["bookingId"]] = booking
+        for bookingId, first in operations.items():
+            if bookingId not in bookings:
+                if first == 'I':
+                    # created and deleted again since the last call, the client never saw it
+                    continue
+                changes.append({ "operation" : "delete", "bookingId" : bookingId, "booking" : None })
+            else:
+                changes.append({ "operation" : "insert" if first == 'I' else "update", "bookingId" : bookingId, "booking" : bookings[bookingId] })
+    if time.monotonic() - _lastChangesPrune > 60:
+        # every worker prunes the change log at most once a minute
+        _lastChangesPrune = time.monotonic()
+        cursor.execute("DELETE FROM booking_changes WHERE changedAt < DATEADD(SECOND, -?, SYSUTCDATETIME())", (retention,))
+        connection.commit()
+    cursor.close()
+    connection.close()
+    return { "reset" : reset, "changes" : changes, "next" : encode_cursor("bookingchanges", [watermark, time.time()]) }
+
+_changeHub = None
+
+def get_mssql_change_hub() -> ChangeHub:
+    global _changeHub
+    if _changeHub is None:
+        with _poolLock:
+            if _changeHub is None:
+                _changeHub = create_configured_change_hub(get_booking_changes)
+    return _changeHub
+
+def get_booking_change_hub() -> ChangeHub:
+    return get_mssql_change_hub()
+
+
+def _plan_mssql_booking_import(connection : pyodbc.Connection, records : List[Dict[str, Any]]) -> Tuple[List[Union[str, None]], List[Tuple[int, List[Any]]]]:
+    # everything create_booking checks per booking, loaded with a few set based queries for the whole batch
+    # (chunked to stay below the limit of 2100 parameters per statement)
+    stays = booking_import_stays(records)
+    cursor = connection.cursor()
+    hotels = {}
+    for hotelIds in chunked(list(set(r["hotelId"] for r in records)), 1000):
+        cursor.execute("SELECT hotelId, pricePerNight, totalRooms FROM hotels WHERE hotelId IN (" + ", ".join("?" for h in hotelIds) + ")", hotelIds)
+        for row in cursor.fetchall():
+            hotels[row.hotelId] = (row.pricePerNight, row.totalRooms)
+    visitorIds = set()
+    for chunk in chunked(list(set(r["visitorId"] for r in records)), 1000):
+        cursor.execute("SELECT visitorId FROM visitors WHERE visitorId IN (" + ", ".join("?" for v in chunk) + ")", chunk)
+        visitorIds.update(row.visitorId for row in cursor.fetchall())
+    bookingIds = set()
+    for chunk in chunked(list(set(r["bookingId"] for r in records if r["bookingId"] is not None)), 1000):
+        cursor.execute("SELECT bookingId FROM bookings WHERE bookingId IN (" + ", ".join("?" for b in chunk) + ")", chunk)
+        bookingIds.update(row.bookingId for row in cursor.fetchall())
+    existingStays = set()
+    usedRooms = {}
+    for chunk in chunked(stays, 500):
+        cursor.execute(
+            "SELECT b.hotelId, b.visitorId, b.checkin, b.checkout " +
+            "FROM (VALUES " + ", ".join("(?, ?, CAST(? AS DATE), CAST(? AS DATE))" for s in chunk) + ") AS s(hotelId, visitorId, checkin, checkout) " +
+            "JOIN bookings AS b ON b.hotelId = s.hotelId AND b.visitorId = s.visitorId AND b.checkin = s.checkin AND b.checkout = s.checkout",
+            [value for stay in chunk for value in stay]
+        )
+        existingStays.update((row.hotelId, row.visitorId, row.checkin, row.checkout) for row in cursor.fetchall())
+        cursor.execute(
+            "SELECT DISTINCT u.hotelId, u.usageDate, u.usedRooms " +
+            "FROM (VALUES " + ", ".join("(?, CAST(? AS DATE), CAST(? AS DATE))" for s in chunk) + ") AS s(hotelId, checkin, checkout) " +
+            "JOIN hotel_day_usage AS u ON u.hotelId = s.hotelId AND u.usageDate >= s.checkin AND u.usageDate < s.checkout",
+            [value for stay in chunk for value in (stay[0], stay[2], stay[3])]
+        )
+        for row in cursor.fetchall():
+            usedRooms[(row.hotelId, row.usageDate)] = row.usedRooms
+    cursor.close()
+    return plan_booking_import(records, hotels, visitorIds, bookingIds, existingStays, usedRooms)
+
+def import_bookings(records : List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    # imports a batch of bookings (the keys of the records are the parameter names of create_booking) in one transaction
+    # and returns { "bookingId" } or { "error" } per record, the valid records are inserted with fast_executemany
+    results = [None] * len(records)
+    connection = get_mssql_connection()
+    try:
+        # the reserved ids have to be past the imported ones
+        get_mssql_id_allocator().ensure_synchronized("bookings_seq")
+        errors, rows = _plan_mssql_booking_import(connection, records)
+        missingIds = sum(1 for index, row in rows if row[0] is None)
+        if missingIds > 0:
+            missingIds = iter(_reserve_mssql_ids(connection, "bookings_seq", missingIds))
+            for index, row in rows:
+                if row[0] is None:
+                    row[0] = next(missingIds)
+        try:
+            bulk_insert(connection, "bookings", BOOKING_IMPORT_COLUMNS, [row for index, row in rows])
+            connection.commit()
+            for index, row in rows:
+                results[index] = { "bookingId" : row[0] }
+        except pyodbc.Error as e:
+            if not (isinstance(e, pyodbc.IntegrityError) or (str(_capacityError) in str(e) and "Not enough rooms available" in str(e))):
+                raise
+            # a concurrent write changed the data after the batch was checked (a booking took the rooms, a hotel or visitor
+            # was deleted, a booking id was taken), the records are booked one by one instead and the failing ones are rejected
+            connection.rollback()
+            for index, row in rows:
+                try:
+                    # with the planned id, so a record gets the same id on both paths
+                    results[index] = { "bookingId" : _create_booking(connection, WriteEffects(), newBookingId=row[0], **records[index])["bookingId"] }
+                    connection.commit()
+                except Exception as e:
+                    connection.rollback()
+                    errors[index] = str(e)
+        for index, error in enumerate(errors):
+            if error is not None:
+                results[index] = { "error" : error }
+        imported = any("bookingId" in result for result in results)
+        if imported:
+            get_mssql_data_versions().bump(connection, ["bookings"])
+            if any(record["bookingId"] is not None for record in records):
+                # imported ids can be ahead of the sequence
+                _synchronize_mssql_sequence("bookings_seq")
+    finally:
+        connection.close()
+    if imported:
+        occupancyEngine = get_mssql_occupancy_engine()
+        for index, row in rows:
+            if "bookingId" in results[index]:
+                occupancyEngine.add_booking(row[0], row[1], records[index]["checkin"], records[index]["checkout"], row[8])
+    return results
 
 def create_visitor(firstname : str, lastname : str, visitorId : int = None) -> Dict[str, Union[int, str, float, bool]]:
     return manage_visitor(firstname, lastname, visitorId, SQLMode.INSERT)
 def update_visitor(firstname : str, lastname : str, visitorId : int) -> Dict[str, Union[int, str, float, bool]]:
     return manage_visitor(firstname, lastname, visitorId, SQLMode.UPDATE)
 def manage_visitor(firstname : str, lastname : str, visitorId : int = None, sqlmode : SQLMode = 1) -> Dict[str, Union[int, str, float, bool]]:
-    connection = get_mssql_connection()
+    return _run_write(lambda connection, effects: _manage_visitor(connection, effects, firstname, lastname, visitorId, sqlmode))
+
+def _manage_visitor(connection : pyodbc.Connection, effects : WriteEffects, firstname : str, lastname : str, visitorId : int = None, sqlmode : SQLMode = 1) -> Dict[str, Union[int, str, float, bool]]:
     cursor = connection.cursor()
     if visitorId is None:
         if sqlmode == SQLMode.UPDATE:
             raise ValueError("visitorId is required for update")
-        cursor.execute("SELECT count(*) as num, (select max(v.visitorId) from visitors as v) as currentMaxId FROM visitors WHERE firstname = ? and lastname = ?", (firstname, lastname))
+        cursor.execute("SELECT count(*) as num FROM visitors WHERE firstname = ? and lastname = ?", (firstname, lastname))
     else:
-        cursor.execute("SELECT count(*) as num, (select max(v.visitorId) from visitors as v) as currentMaxId FROM visitors WHERE visitorId = ? or (firstname = ? and lastname = ?)", (visitorId, firstname, lastname))
+        cursor.execute("SELECT count(*) as num FROM visitors WHERE visitorId = ? or (firstname = ? and lastname = ?)", (visitorId, firstname, lastname))
     row = cursor.fetchone()
     alreadyExists = row.num > 0
-    nextId = row.currentMaxId + 1
     cursor.close()
     
     if alreadyExists:
@@ -222,73 +725,103 @@ def manage_visitor(firstname : str, lastname : str, visitorId : int = None, sqlm
         if sqlmode == SQLMode.UPDATE:
             raise RuntimeError("Visitor does not exist")
 
-    if nextId <= 0:
-        nextId = 1
-    
     cursor = connection.cursor()
     if sqlmode == SQLMode.UPDATE:
         nextId = visitorId
         cursor.execute("UPDATE visitors SET firstname = ?, lastname = ? WHERE visitorId = ?", (firstname, lastname, visitorId))
     elif sqlmode == SQLMode.INSERT:
-        cursor.execute("INSERT INTO visitors (visitorId, firstname, lastname) VALUES (?, ?, ?)", (nextId, firstname, lastname))
+        nextId = get_mssql_id_allocator().next_id(connection, "visitors_seq")
+        cursor.execute("""
+            SET NOCOUNT ON;
+            DECLARE @visitorId INT = ?;
+            IF @visitorId IS NULL
+                SET @visitorId = NEXT VALUE FOR visitors_seq;
+            INSERT INTO visitors (visitorId, firstname, lastname) VALUES (@visitorId, ?, ?);
+            SELECT @visitorId AS visitorId;
+        """, (nextId, firstname, lastname))
+        nextId = cursor.fetchone().visitorId
     else:
         raise ValueError("Invalid SQL mode")
     cursor.close()
-    connection.commit()
-    connection.close()
+    effects.touch("visitors")
     return { "visitorId" : nextId, "firstname" : firstname, "lastname" : lastname }
 
 
 def delete_visitor(visitorId : int) -> bool:
-    connection = get_mssql_connection()
+    return _run_write(lambda connection, effects: _delete_visitor(connection, effects, visitorId))
+
+def _delete_visitor(connection : pyodbc.Connection, effects : WriteEffects, visitorId : int) -> bool:
     requiresDeletion = tablePrimaryKeyExists(connection, "visitors", visitorId)
     if requiresDeletion:
         cursor = connection.cursor()
         cursor.execute("DELETE FROM visitors WHERE visitorId = ?", (visitorId))
         cursor.close()
-        connection.commit()
-    connection.close()
+        # the bookings of the visitor were removed by the cascade, the occupancy reads them from the change log
+        effects.touch("visitors", "bookings")
     return requiresDeletion
 
+_visitorMapper = RowMapper("visitorId", "firstname", "lastname")
+
 def get_visitor(visitorId : int) -> Dict[str, Union[int, str, float, bool]]:
     connection = get_mssql_connection()
     cursor = connection.cursor()
-    cursor.execute("SELECT visitorId, firstname, lastname FROM visitors WHERE visitorId = ?", (visitorId))
-    row = cursor.fetchone()
-    if row is None:
-        return {}
-    visitor = {
-        "visitorId" : row.visitorId,
-        "firstname" : row.firstname,
-        "lastname" : row.lastname
-    }
+    cursor.execute("SELECT " + _visitorMapper.columns + " FROM visitors WHERE visitorId = ?", (visitorId))
+    visitor = _visitorMapper.fetchone(cursor)
     cursor.close()
     connection.close()
+    if visitor is None:
+        return {}
     return visitor
 
-def get_visitors(name : str = "", exactMatch : bool = False) -> Iterable[Dict[str, Union[int, str, float, bool]]]:
-    connection = get_mssql_connection()
-    cursor = connection.cursor()
+def _visitors_query(name : str = "", exactMatch : bool = False, limit : int = None, cursor : str = None) -> Tuple[str, List[Any], Union[int, None]]:
     name = str(name).strip()
+    limit = get_page_limit(limit, cursor)
+    after = decode_cursor("visitors", cursor, [int])
+    query = "SELECT " + _visitorMapper.columns + " FROM visitors"
+    conditions = []
+    params = []
     if name != "":
         if exactMatch:
-            cursor.execute("SELECT visitorId, firstname, lastname FROM visitors WHERE firstname = ? or lastname = ? order by visitorId desc", (name, name))
+            conditions.append("(firstname = ? or lastname = ?)")
         else:
-            name = "%" + name + "%"
-            cursor.execute("SELECT visitorId, firstname, lastname FROM visitors WHERE firstname like ? or lastname like ? order by visitorId desc", (name, name))
-    else:
-        cursor.execute("SELECT visitorId, firstname, lastname FROM visitors order by visitorId desc")
-    visitors = []
-    for row in cursor.fetchall():
-        visitors.append({
-            "visitorId" : row.visitorId,
-            "firstname" : row.firstname,
-            "lastname" : row.lastname
-        })
+            # case insensitive substring search, candidates come from the trigram side table (see _trigramTables)
+            if len(name) >= 3 and has_trigram_search():
+                conditions.append("visitorId IN (SELECT t.visitorId FROM visitors_trigrams AS t WHERE t.trigram IN (SELECT g.trigram FROM dbo.GetTrigrams(?) AS g) GROUP BY t.visitorId HAVING COUNT(*) = (SELECT COUNT(*) FROM dbo.GetTrigrams(?)))")
+                params.extend([name, name])
+            name = "%" + escape_like(name.lower()) + "%"
+            conditions.append("(LOWER(firstname) like ? escape '\\' or LOWER(lastname) like ? escape '\\')")
+        params.extend([name, name])
+    if after is not None:
+        conditions.append("visitorId < ?")
+        params.append(after[0])
+    if len(conditions) > 0:
+        query += " WHERE " + " and ".join(conditions)
+    query += " order by visitorId desc"
+    if limit is not None:
+        query += " offset 0 rows fetch next ? rows only"
+        params.append(limit + 1)
+    elif name != "" and not exactMatch:
+        # substring searches (autocomplete) are capped
+        query += " offset 0 rows fetch next ? rows only"
+        params.append(get_int_configuration("SEARCH_RESULT_LIMIT", 100))
+    return query, params, limit
+
+def get_visitors(name : str = "", exactMatch : bool = False, limit : int = None, cursor : str = None) -> Union[Iterable[Dict[str, Union[int, str, float, bool]]], Dict[str, Any]]:
+    query, params, limit = _visitors_query(name, exactMatch, limit, cursor)
+    connection = get_mssql_connection()
+    cursor = connection.cursor()
+    cursor.execute(query, params)
+    visitors = _visitorMapper.fetchall(cursor)
     cursor.close()
     connection.close()
+    if limit is not None:
+        return build_page(visitors, limit, "visitors", ["visitorId"])
     return visitors
 
+def stream_visitors(name : str = "", exactMatch : bool = False) -> Iterator[Dict[str, Union[int, str, float, bool]]]:
+    query, params, limit = _visitors_query(name, exactMatch)
+    return _stream_rows(query, params, _visitorMapper)
+
 
 def create_hotel(
     hotelname : str,
@@ -413,17 +946,69 @@ def manage_hotel(
     bathroomEssentials : bool = None,
     sqlmode : SQLMode = 1
 ) -> Dict[str, Union[int, str, float, bool]]:
-    connection = get_mssql_connection()
+    return _run_write(lambda connection, effects: _manage_hotel(
+        connection,
+        effects,
+        hotelname,
+        pricePerNight,
+        totalRooms,
+        hotelId,
+        country,
+        skiing,
+        suites,
+        inRoomEntertainment,
+        conciergeServices,
+        housekeeping,
+        petFriendlyOptions,
+        laundryServices,
+        roomService,
+        indoorPool,
+        outdoorPool,
+        fitnessCenter,
+        complimentaryBreakfast,
+        businessCenter,
+        freeGuestParking,
+        complimentaryCoffeaAndTea,
+        climateControl,
+        bathroomEssentials,
+        sqlmode
+    ))
+def _manage_hotel(
+    connection : pyodbc.Connection,
+    effects : WriteEffects,
+    hotelname : str,
+    pricePerNight : float,
+    totalRooms : int,
+    hotelId : int = None,
+    country : str = None,
+    skiing : bool = None,
+    suites : bool = None,
+    inRoomEntertainment : bool = None,
+    conciergeServices : bool = None,
+    housekeeping : bool = None,
+    petFriendlyOptions : bool = None,
+    laundryServices : bool = None,
+    roomService : bool = None,
+    indoorPool : bool = None,
+    outdoorPool : bool = None,
+    fitnessCenter : bool = None,
+    complimentaryBreakfast : bool = None,
+    businessCenter : bool = None,
+    freeGuestParking : bool = None,
+    complimentaryCoffeaAndTea : bool = None,
+    climateControl : bool = None,
+    bathroomEssentials : bool = None,
+    sqlmode : SQLMode = 1
+) -> Dict[str, Union[int, str, float, bool]]:
     cursor = connection.cursor()
     if hotelId is None:
         if sqlmode == SQLMode.UPDATE:
             raise ValueError("hotelId is required for update")
-        cursor.execute("SELECT count(*) as num, (select max(h.hotelId) from hotels as h) as currentMaxId FROM hotels WHERE hotelname = ?", (hotelname))
+        cursor.execute("SELECT count(*) as num FROM hotels WHERE hotelname = ?", (hotelname))
     else:
-        cursor.execute("SELECT count(*) as num, (select max(h.hotelId) from hotels as h) as currentMaxId FROM hotels WHERE hotelId = ? or hotelname = ?", (hotelId, hotelname))    
+        cursor.execute("SELECT count(*) as num FROM hotels WHERE hotelId = ? or hotelname = ?", (hotelId, hotelname))
     row = cursor.fetchone()
     alreadyExists = row.num > 0
-    nextId = row.currentMaxId + 1
     cursor.close()
     
     if alreadyExists:
@@ -436,14 +1021,10 @@ def manage_hotel(
         if sqlmode == SQLMode.UPDATE:
             raise RuntimeError("Hotel does not exist")
 
-    if nextId <= 0:
-        nextId = 1
-    
     hotelname = str(hotelname).strip()
 
     if sqlmode == SQLMode.UPDATE:
         cursor = connection.cursor()
-        nextId = hotelId
         parts = [ hotelname, pricePerNight, totalRooms ]
         setPartStmt = ""
         if country is not None:
@@ -503,12 +1084,10 @@ def manage_hotel(
         parts.append(hotelId)
         cursor.execute("UPDATE hotels SET hotelname = ?, pricePerNight = ?, totalRooms = ? " + setPartStmt + " WHERE hotelId =?", tuple(parts))
         cursor.close()
-        connection.commit()
-        connection.close()
-        hotelResult = get_hotel(hotelId)
+        hotelResult = _get_hotel(connection, hotelId)
     elif sqlmode == SQLMode.INSERT:
         cursor = connection.cursor()
-        hotelId = nextId
+        hotelId = get_mssql_id_allocator().next_id(connection, "hotels_seq")
         if country is None:
             country = 'Unknown'
         country = str(country).strip()
@@ -530,12 +1109,15 @@ def manage_hotel(
         climateControl = get_bool_value(climateControl)
         bathroomEssentials = get_bool_value(bathroomEssentials)
         cursor.execute(
-            "INSERT INTO hotels (hotelId, hotelname, pricePerNight, totalRooms, country, skiing, suites, inRoomEntertainment, conciergeServices, housekeeping, petFriendlyOptions, laundryServices, roomService, indoorPool, outdoorPool, fitnessCenter, complimentaryBreakfast, businessCenter, freeGuestParking, complimentaryCoffeaAndTea, climateControl, bathroomEssentials) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            "SET NOCOUNT ON; " +
+            "DECLARE @hotelId INT = ?; " +
+            "IF @hotelId IS NULL SET @hotelId = NEXT VALUE FOR hotels_seq; " +
+            "INSERT INTO hotels (hotelId, hotelname, pricePerNight, totalRooms, country, skiing, suites, inRoomEntertainment, conciergeServices, housekeeping, petFriendlyOptions, laundryServices, roomService, indoorPool, outdoorPool, fitnessCenter, complimentaryBreakfast, businessCenter, freeGuestParking, complimentaryCoffeaAndTea, climateControl, bathroomEssentials) VALUES (@hotelId, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?); " +
+            "SELECT @hotelId AS hotelId;",
             (hotelId, hotelname, pricePerNight, totalRooms, country, skiing, suites, inRoomEntertainment, conciergeServices, housekeeping, petFriendlyOptions, laundryServices, roomService, indoorPool, outdoorPool, fitnessCenter, complimentaryBreakfast, businessCenter, freeGuestParking, complimentaryCoffeaAndTea, climateControl, bathroomEssentials)
         )
+        hotelId = cursor.fetchone().hotelId
         cursor.close()
-        connection.commit()
-        connection.close()
         hotelResult = {
             "hotelId" : hotelId,
             "hotelname" : hotelname,
@@ -561,83 +1143,360 @@ def manage_hotel(
             "bathroomEssentials" : bathroomEssentials
         }
     else:
-        connection.close()
         raise ValueError("Invalid SQL mode")
+    effects.touch("hotels")
+    # totalRooms might have changed
+    effects.after_commit(get_mssql_occupancy_engine().invalidate)
     return hotelResult
 
 
 def delete_hotel(hotelId : int) -> bool:
-    connection = get_mssql_connection()
+    return _run_write(lambda connection, effects: _delete_hotel(connection, effects, hotelId))
+
+def _delete_hotel(connection : pyodbc.Connection, effects : WriteEffects, hotelId : int) -> bool:
     requiresDeletion = tablePrimaryKeyExists(connection, "hotels", hotelId)
     if requiresDeletion:
         cursor = connection.cursor()
         cursor.execute("DELETE FROM hotels WHERE hotelId = ?", (hotelId))
         cursor.close()
-        connection.commit()
-    connection.close()
+        effects.touch("hotels", "bookings")
+        # the bookings of the hotel were removed by the cascade
+        effects.after_commit(get_mssql_occupancy_engine().invalidate)
     return requiresDeletion
 
 def get_hotel(hotelId : int) -> Dict[str, Union[int, str, float, bool]]:
     connection = get_mssql_connection()
-    cursor = connection.cursor()
-    cursor.execute("SELECT * FROM hotels WHERE hotelId = ?", (hotelId))
-    row = cursor.fetchone()
-    if row is None:
-        return {}
-    hotel = {
-        "hotelId" : row.hotelId,
-        "hotelname" : row.hotelname,
-        "pricePerNight" : row.pricePerNight,
-        "totalRooms" : row.totalRooms,
-        "country" : row.country,
-        "skiing" : get_bool_value(row.skiing),
-        "suites" : get_bool_value(row.suites),
-        "inRoomEntertainment" : get_bool_value(row.inRoomEntertainment),
-        "conciergeServices" : get_bool_value(row.conciergeServices),
-        "housekeeping" : get_bool_value(row.housekeeping),
-        "petFriendlyOptions" : get_bool_value(row.petFriendlyOptions),
-        "laundryServices" : get_bool_value(row.laundryServices),
-        "roomService" : get_bool_value(row.roomService),
-        "indoorPool" : get_bool_value(row.indoorPool),
-        "outdoorPool" : get_bool_value(row.outdoorPool),
-        "fitnessCenter" : get_bool_value(row.fitnessCenter),
-        "complimentaryBreakfast" : get_bool_value(row.complimentaryBreakfast),
-        "businessCenter" : get_bool_value(row.businessCenter),
-        "freeGuestParking" : get_bool_value(row.freeGuestParking),
-        "complimentaryCoffeaAndTea" : get_bool_value(row.complimentaryCoffeaAndTea),
-        "climateControl" : get_bool_value(row.climateControl),
-        "bathroomEssentials" : get_bool_value(row.bathroomEssentials)
-    }
-    cursor.close()
+    hotel = _get_hotel(connection, hotelId)
     connection.close()
     return hotel
 
-def get_hotels(name : str = "", exactMatch : bool = False) -> Iterable[Dict[str, Union[int, str, float, bool]]]:
-    connection = get_mssql_connection()
+# the booleans come from NOT NULL bit columns, pyodbc returns them as bool already
+_hotelDetailsMapper = RowMapper("hotelId", "hotelname", "pricePerNight", "totalRooms", "country", *get_amenities().keys())
+
+def _get_hotel(connection : pyodbc.Connection, hotelId : int) -> Dict[str, Union[int, str, float, bool]]:
     cursor = connection.cursor()
+    cursor.execute("SELECT " + _hotelDetailsMapper.columns + " FROM hotels WHERE hotelId = ?", (hotelId))
+    hotel = _hotelDetailsMapper.fetchone(cursor)
+    cursor.close()
+    if hotel is None:
+        return {}
+    return hotel
+
+_hotelMapper = RowMapper("hotelId", "hotelname", "pricePerNight", "totalRooms", "country")
+
+def _hotels_query(name : str = "", exactMatch : bool = False, limit : int = None, cursor : str = None) -> Tuple[str, List[Any], Union[int, None]]:
     name = str(name).strip()
+    limit = get_page_limit(limit, cursor)
+    after = decode_cursor("hotels", cursor, [int])
+    query = "SELECT " + _hotelMapper.columns + " FROM hotels"
+    conditions = []
+    params = []
     if name != "":
         if exactMatch:
-            cursor.execute("SELECT hotelId, hotelname, pricePerNight, totalRooms, country FROM hotels WHERE hotelname = ? order by hotelId desc", (name))
+            conditions.append("hotelname = ?")
         else:
-            name = "%" + name + "%"
-            cursor.execute("SELECT hotelId, hotelname, pricePerNight, totalRooms, country FROM hotels WHERE hotelname like ? order by hotelId desc", (name))
-    else:
-        cursor.execute("SELECT hotelId, hotelname, pricePerNight, totalRooms, country FROM hotels order by hotelId desc")
+            # case insensitive substring search, candidates come from the trigram side table (see _trigramTables)
+            if len(name) >= 3 and has_trigram_search():
+                conditions.append("hotelId IN (SELECT t.hotelId FROM hotels_trigrams AS t WHERE t.trigram IN (SELECT g.trigram FROM dbo.GetTrigrams(?) AS g) GROUP BY t.hotelId HAVING COUNT(*) = (SELECT COUNT(*) FROM dbo.GetTrigrams(?)))")
+                params.extend([name, name])
+            name = "%" + escape_like(name.lower()) + "%"
+            conditions.append("LOWER(hotelname) like ? escape '\\'")
+        params.append(name)
+    if after is not None:
+        conditions.append("hotelId < ?")
+        params.append(after[0])
+    if len(conditions) > 0:
+        query += " WHERE " + " and ".join(conditions)
+    query += " order by hotelId desc"
+    if limit is not None:
+        query += " offset 0 rows fetch next ? rows only"
+        params.append(limit + 1)
+    elif name != "" and not exactMatch:
+        # substring searches (autocomplete) are capped
+        query += " offset 0 rows fetch next ? rows only"
+        params.append(get_int_configuration("SEARCH_RESULT_LIMIT", 100))
+    return query, params, limit
+
+def get_hotels(name : str = "", exactMatch : bool = False, limit : int = None, cursor : str = None) -> Union[Iterable[Dict[str, Union[int, str, float, bool]]], Dict[str, Any]]:
+    query, params, limit = _hotels_query(name, exactMatch, limit, cursor)
+    connection = get_mssql_connection()
+    cursor = connection.cursor()
+    cursor.execute(query, params)
+    hotels = _hotelMapper.fetchall(cursor)
+    cursor.close()
+    connection.close()
+    if limit is not None:
+        return build_page(hotels, limit, "hotels", ["hotelId"])
+    return hotels
+
+def stream_hotels(name : str = "", exactMatch : bool = False) -> Iterator[Dict[str, Union[int, str, float, bool]]]:
+    query, params, limit = _hotels_query(name, exactMatch)
+    return _stream_rows(query, params, _hotelMapper)
+
+def get_available_hotels(checkin : datetime, checkout : datetime, rooms : int = 1, amenities : Union[str, List[str]] = None) -> List[Dict[str, Union[int, str, float, bool]]]:
+    amenities = parse_amenities(amenities)
+    rooms = int(rooms)
+    # the room check runs against the in-memory occupancy, the database only filters by amenities
+    freeRooms = get_mssql_occupancy_engine().find_available_hotels(checkin, checkout, rooms)
+    if len(freeRooms) == 0:
+        return []
+    query = "SELECT " + _hotelMapper.columns + " FROM hotels"
+    if len(amenities) > 0:
+        # the names were validated against get_amenities, so they can be used as column names
+        query += " WHERE " + " and ".join(amenity + " = 1" for amenity in amenities)
+    query += " order by hotelId desc"
+    connection = get_mssql_connection()
+    cursor = connection.cursor()
+    cursor.execute(query)
+    nights = (checkout - checkin).days
     hotels = []
-    for row in cursor.fetchall():
-        hotels.append({
-            "hotelId" : row.hotelId,
-            "hotelname" : row.hotelname,
-            "pricePerNight" : row.pricePerNight,
-            "totalRooms" : row.totalRooms,
-            "country" : row.country
-        })
+    for hotel in _hotelMapper.fetchall(cursor):
+        if hotel["hotelId"] not in freeRooms:
+            continue
+        hotel["freeRooms"] = freeRooms[hotel["hotelId"]]
+        hotel["price"] = hotel["pricePerNight"] * nights * rooms
+        hotels.append(hotel)
     cursor.close()
     connection.close()
     return hotels
 
 
+def export_table(tableName : str, format : str, visitorId : int = None, hotelId : int = None, fromdate : datetime = None, untildate : datetime = None, chunkSize : int = 65536) -> Iterator[str]:
+    # the rows are fetched in batches and encoded chunk by chunk, so the export needs constant memory no matter how large the table is
+    query, params = export_query(tableName, "?", visitorId, hotelId, fromdate, untildate)
+    columns = EXPORT_COLUMNS[tableName]
+    return encode_export_rows(_stream_rows("SELECT " + ", ".join(columns) + query, params), columns, format, chunkSize)
+
+
+# indexes backing get_bookings (filters + sort order + keyset pagination) and GetRoomsUsageWithinTimeSpan (hotelId + date range)
+_bookingIndexes = {
+    "ix_bookings_order" : "CREATE INDEX ix_bookings_order ON bookings (checkin DESC, checkout DESC, bookingId DESC)",
+    "ix_bookings_visitor" : "CREATE INDEX ix_bookings_visitor ON bookings (visitorId, checkin DESC, checkout DESC, bookingId DESC)",
+    "ix_bookings_hotel" : "CREATE INDEX ix_bookings_hotel ON bookings (hotelId, checkin DESC, checkout DESC, bookingId DESC) INCLUDE (rooms)"
+}
+
+# substring search side tables: every distinct lower case trigram of the searchable columns, maintained by triggers
+# table -> (primary key, searchable columns)
+_trigramTables = {
+    "visitors" : ("visitorId", ["firstname", "lastname"]),
+    "hotels" : ("hotelId", ["hotelname"])
+}
+
+_trigramSearchAvailable = False
+_trigramSearchCheckedAt = None
+_trigramSearchLock = threading.Lock()
+
+def has_trigram_search() -> bool:
+    # databases set up before the side tables existed keep using plain LIKE scans, the check is repeated every minute
+    global _trigramSearchAvailable, _trigramSearchCheckedAt
+    if _trigramSearchAvailable:
+        return True
+    with _trigramSearchLock:
+        now = time.monotonic()
+        if _trigramSearchAvailable or (_trigramSearchCheckedAt is not None and now - _trigramSearchCheckedAt < 60):
+            return _trigramSearchAvailable
+        connection = get_mssql_connection()
+        try:
+            available = doesFunctionExist(connection, "GetTrigrams")
+            for tableName in _trigramTables:
+                available = available and doesTableExist(connection, tableName + "_trigrams")
+        finally:
+            connection.close()
+        _trigramSearchAvailable = available
+        _trigramSearchCheckedAt = now
+    return _trigramSearchAvailable
+
+def _trigram_select(tableName : str, source : str) -> str:
+    keyColumn, columns = _trigramTables[tableName]
+    return " UNION ".join(
+        "SELECT g.trigram, s." + keyColumn + " FROM " + source + " AS s CROSS APPLY dbo.GetTrigrams(s." + column + ") AS g"
+        for column in columns
+    )
+
+def rebuildTrigrams(connection, tableName : str):
+    keyColumn, columns = _trigramTables[tableName]
+    trigramTable = tableName + "_trigrams"
+    cursor = connection.cursor()
+    cursor.execute("DELETE FROM " + trigramTable)
+    cursor.execute("INSERT INTO " + trigramTable + " (trigram, " + keyColumn + ") " + _trigram_select(tableName, tableName))
+    cursor.close()
+
+def createTrigramSearch(connection, responseDict : Dict[str, Any]):
+    global _trigramSearchAvailable, _trigramSearchCheckedAt
+    if not doesFunctionExist(connection, "GetTrigrams"):
+        responseDict["create_schema"]["GetTrigrams"] = True
+        cursor = connection.cursor()
+        cursor.execute("""
+            CREATE FUNCTION GetTrigrams (@value NVARCHAR(200))
+            RETURNS TABLE
+            AS
+            RETURN (
+                SELECT DISTINCT SUBSTRING(LOWER(@value), n.n, 3) AS trigram
+                FROM (
+                    SELECT TOP (CASE WHEN LEN(@value) >= 3 THEN LEN(@value) - 2 ELSE 0 END) ROW_NUMBER() OVER (ORDER BY (SELECT NULL)) AS n
+                    FROM sys.all_columns
+                ) AS n
+            );
+        """)
+        cursor.close()
+    for tableName, (keyColumn, columns) in _trigramTables.items():
+        trigramTable = tableName + "_trigrams"
+        if doesTableExist(connection, trigramTable):
+            continue
+        responseDict["create_schema"][trigramTable] = True
+        cursor = connection.cursor()
+        cursor.execute(
+            "CREATE TABLE " + trigramTable + " (" +
+            "trigram NVARCHAR(3) NOT NULL, " +
+            keyColumn + " INT NOT NULL, " +
+            "CONSTRAINT pk_" + trigramTable + " PRIMARY KEY (trigram, " + keyColumn + "), " +
+            "FOREIGN KEY (" + keyColumn + ") REFERENCES " + tableName + "(" + keyColumn + ") ON DELETE CASCADE" +
+            ")"
+        )
+        cursor.execute("CREATE INDEX ix_" + trigramTable + "_key ON " + trigramTable + " (" + keyColumn + ")")
+        # CREATE TRIGGER has to be the only statement of its batch
+        cursor.execute(
+            "CREATE TRIGGER trg_" + trigramTable + " ON " + tableName + " AFTER INSERT, UPDATE AS " +
+            "BEGIN " +
+            "SET NOCOUNT ON; " +
+            "DELETE t FROM " + trigramTable + " AS t INNER JOIN inserted AS i ON i." + keyColumn + " = t." + keyColumn + "; " +
+            "INSERT INTO " + trigramTable + " (trigram, " + keyColumn + ") " + _trigram_select(tableName, "inserted") + "; " +
+            "END"
+        )
+        cursor.close()
+        # rows that existed before the side table
+        rebuildTrigrams(connection, tableName)
+    _trigramSearchAvailable = False
+    _trigramSearchCheckedAt = None
+
+# used rooms per hotel and night (checkin..checkout-1), maintained by a trigger on bookings
+_dayUsageTrigger = "trg_bookings_day_usage"
+
+def _day_usage_select(source : str) -> str:
+    # expands every booking of source (hotelId, checkin, checkout, rooms) into its nights
+    # (DATEADD does not accept the bigint of ROW_NUMBER)
+    return (
+        "SELECT s.hotelId, DATEADD(DAY, n.n, s.checkin) AS usageDate, SUM(s.rooms) AS usedRooms " +
+        "FROM " + source + " AS s " +
+        "CROSS APPLY (" +
+            "SELECT TOP (DATEDIFF(DAY, s.checkin, s.checkout)) CAST(ROW_NUMBER() OVER (ORDER BY (SELECT NULL)) - 1 AS INT) AS n " +
+            "FROM sys.all_columns AS a CROSS JOIN sys.all_columns AS b" +
+        ") AS n " +
+        "GROUP BY s.hotelId, DATEADD(DAY, n.n, s.checkin)"
+    )
+
+def rebuildDayUsage(connection):
+    # set based recomputation from all bookings, i.e. after a bulk load with the trigger disabled
+    cursor = connection.cursor()
+    cursor.execute("DELETE FROM hotel_day_usage")
+    cursor.execute("INSERT INTO hotel_day_usage (hotelId, usageDate, usedRooms) " + _day_usage_select("bookings"))
+    cursor.close()
+
+# error number thrown by the day usage trigger when a booking does not fit into the remaining rooms of its hotel
+_capacityError = 50001
+
+def createDayUsage(connection, responseDict : Dict[str, Any]):
+    created = False
+    cursor = connection.cursor()
+    if not doesTableExist(connection, "hotel_day_usage"):
+        created = True
+        responseDict["create_schema"]["hotel_day_usage"] = True
+        cursor.execute("""
+            CREATE TABLE hotel_day_usage (
+                hotelId INT NOT NULL,
+                usageDate DATE NOT NULL,
+                usedRooms INT NOT NULL,
+                CONSTRAINT pk_hotel_day_usage PRIMARY KEY (hotelId, usageDate),
+                FOREIGN KEY (hotelId) REFERENCES hotels(hotelId) ON DELETE CASCADE
+            )
+        """)
+    # altered on every schema creation, so existing deployments pick up the capacity check
+    # deleted bookings of a deleted hotel are skipped, its rows are already gone by the cascade
+    # the MERGE keeps its locks on the day rows of the booking until the commit, only bookings sharing a night wait for each other
+    # CREATE TRIGGER has to be the only statement of its batch
+    cursor.execute(
+        "CREATE OR ALTER TRIGGER " + _dayUsageTrigger + " ON bookings AFTER INSERT, UPDATE, DELETE AS " +
+        "BEGIN " +
+        "SET NOCOUNT ON; " +
+        "MERGE hotel_day_usage WITH (HOLDLOCK) AS u " +
+        "USING (" + _day_usage_select(
+            "(SELECT i.hotelId, i.checkin, i.checkout, i.rooms FROM inserted AS i " +
+            "UNION ALL " +
+            "SELECT d.hotelId, d.checkin, d.checkout, -d.rooms FROM deleted AS d WHERE EXISTS (SELECT 1 FROM hotels AS h WHERE h.hotelId = d.hotelId))"
+        ) + ") AS c " +
+        "ON u.hotelId = c.hotelId AND u.usageDate = c.usageDate " +
+        "WHEN MATCHED THEN UPDATE SET usedRooms = u.usedRooms + c.usedRooms " +
+        "WHEN NOT MATCHED THEN INSERT (hotelId, usageDate, usedRooms) VALUES (c.hotelId, c.usageDate, c.usedRooms); " +
+        "IF EXISTS (" +
+            "SELECT 1 FROM inserted AS i " +
+            "JOIN hotels AS h ON h.hotelId = i.hotelId " +
+            "JOIN hotel_day_usage AS u ON u.hotelId = i.hotelId AND u.usageDate >= i.checkin AND u.usageDate < i.checkout " +
+            "WHERE u.usedRooms > h.totalRooms" +
+        ") " +
+        "THROW " + str(_capacityError) + ", 'Not enough rooms available', 1; " +
+        "END"
+    )
+    if created:
+        # older deployments computed GetRoomsUsageWithinTimeSpan from the bookings, it is recreated on top of the new table
+        cursor.execute("DROP FUNCTION IF EXISTS GetRoomsUsageWithinTimeSpan")
+    cursor.close()
+    if created:
+        # bookings that existed before the table
+        rebuildDayUsage(connection)
+
+def createBookingChanges(connection, responseDict : Dict[str, Any]):
+    # change log behind /api/bookings/changes, the rowversion orders the rows by the time they were written
+    if doesTableExist(connection, "booking_changes"):
+        return
+    responseDict["create_schema"]["booking_changes"] = True
+    cursor = connection.cursor()
+    cursor.execute("""
+        CREATE TABLE booking_changes (
+            changeId BIGINT IDENTITY(1,1) PRIMARY KEY,
+            changeVersion ROWVERSION,
+            bookingId INT NULL,
+            operation CHAR(1) NOT NULL,
+            changedAt DATETIME2 NOT NULL DEFAULT SYSUTCDATETIME()
+        )
+    """)
+    cursor.execute("CREATE INDEX ix_booking_changes_changeversion ON booking_changes (changeVersion)")
+    cursor.execute("CREATE INDEX ix_booking_changes_changedat ON booking_changes (changedAt)")
+    # CREATE TRIGGER has to be the only statement of its batch
+    cursor.execute(
+        "CREATE OR ALTER TRIGGER trg_bookings_changes ON bookings AFTER INSERT, UPDATE, DELETE AS " +
+        "BEGIN " +
+        "SET NOCOUNT ON; " +
+        "INSERT INTO booking_changes (bookingId, operation) " +
+        "SELECT i.bookingId, CASE WHEN EXISTS (SELECT 1 FROM deleted) THEN 'U' ELSE 'I' END FROM inserted AS i; " +
+        "INSERT INTO booking_changes (bookingId, operation) " +
+        "SELECT d.bookingId, 'D' FROM deleted AS d WHERE NOT EXISTS (SELECT 1 FROM inserted); " +
+        "END"
+    )
+    # the bookings contain the names of the hotel and the visitor
+    cursor.execute(
+        "CREATE OR ALTER TRIGGER trg_hotels_booking_changes ON hotels AFTER UPDATE AS " +
+        "BEGIN " +
+        "SET NOCOUNT ON; " +
+        "INSERT INTO booking_changes (bookingId, operation) " +
+        "SELECT b.bookingId, 'U' FROM inserted AS i " +
+        "JOIN deleted AS d ON d.hotelId = i.hotelId " +
+        "JOIN bookings AS b ON b.hotelId = i.hotelId " +
+        "WHERE i.hotelname <> d.hotelname; " +
+        "END"
+    )
+    cursor.execute(
+        "CREATE OR ALTER TRIGGER trg_visitors_booking_changes ON visitors AFTER UPDATE AS " +
+        "BEGIN " +
+        "SET NOCOUNT ON; " +
+        "INSERT INTO booking_changes (bookingId, operation) " +
+        "SELECT b.bookingId, 'U' FROM inserted AS i " +
+        "JOIN deleted AS d ON d.visitorId = i.visitorId " +
+        "JOIN bookings AS b ON b.visitorId = i.visitorId " +
+        "WHERE i.firstname <> d.firstname OR i.lastname <> d.lastname; " +
+        "END"
+    )
+    cursor.close()
+
 def tablePrimaryKeyExists(connection, tableName : str, primaryKey : str) -> bool:
     if tableName == "hotels":
         query = "SELECT count(*) as num from hotels where hotelId = ?"
@@ -677,6 +1536,13 @@ def doesFunctionExist(connection, functionName : str) -> bool:
     cursor.close()
     return exists
 
+def doesIndexExist(connection, tableName : str, indexName : str) -> bool:
+    cursor = connection.cursor()
+    cursor.execute("SELECT count(*) as num FROM sys.indexes WHERE object_id = OBJECT_ID(?) and name = ?", (str(tableName).strip(), str(indexName).strip()))
+    exists = cursor.fetchone()[0] > 0
+    cursor.close()
+    return exists
+
 def allTablesExists() -> bool:
     try:
         connection = get_mssql_connection()
@@ -689,14 +1555,14 @@ def allTablesExists() -> bool:
     except Exception as e:
         return False
 
-def setupDb(drop_schema : bool, create_schema : bool, populate_data : bool, number_of_visitors : int, min_bookings_per_visitor : int, max_bookings_per_visitor : int):
+def setupDb(drop_schema : bool, create_schema : bool, populate_data : bool, number_of_visitors : int, min_bookings_per_visitor : int, max_bookings_per_visitor : int, seed : Union[int, None] = None, target_occupancy : Union[float, None] = None):
     number_of_visitors = int(number_of_visitors)
     min_bookings_per_visitor = int(min_bookings_per_visitor)
     max_bookings_per_visitor = int(max_bookings_per_visitor)
     if number_of_visitors < 2:
         number_of_visitors = 2
-    if number_of_visitors > 10000:
-        number_of_visitors = 10000
+    if number_of_visitors > 1000000:
+        number_of_visitors = 1000000
     if min_bookings_per_visitor < 0:
         min_bookings_per_visitor = 0
     if min_bookings_per_visitor > 10:
@@ -707,32 +1573,48 @@ def setupDb(drop_schema : bool, create_schema : bool, populate_data : bool, numb
         max_bookings_per_visitor = 1
     if max_bookings_per_visitor > 20:
         max_bookings_per_visitor = 20
+    # bookings are rejected once a night of a hotel is full, so the generated data has to respect the rooms as well
+    if target_occupancy is None:
+        target_occupancy = 1.0
+    target_occupancy = min(1.0, max(0.01, float(target_occupancy)))
     if drop_schema and not create_schema:
         raise Exception("Cannot drop schema without creating schema")
     responseDict = {
         "success" : True,
         "drop_schema" : False,
-        "create_schema" : { "hotels" : False, "visitors" : False, "bookings" : False, "GetRoomsUsageWithinTimeSpan" : False },
+        "create_schema" : { "hotels" : False, "visitors" : False, "bookings" : False, "hotel_day_usage" : False, "booking_changes" : False, "GetRoomsUsageWithinTimeSpan" : False, "GetTrigrams" : False, "visitors_trigrams" : False, "hotels_trigrams" : False },
+        "create_indexes" : { indexName : False for indexName in _bookingIndexes },
         "populate_data" : { "hotels" : False, "visitors" : False, "bookings" : False },
         "number_of_visitors" : number_of_visitors,
         "min_bookings_per_visitor" : min_bookings_per_visitor,
-        "max_bookings_per_visitor" : max_bookings_per_visitor
+        "max_bookings_per_visitor" : max_bookings_per_visitor,
+        "seed" : seed,
+        "target_occupancy" : target_occupancy
     }
     connection = get_mssql_connection()
     if drop_schema:
         responseDict["drop_schema"] = True
         cursor = connection.cursor()
+        cursor.execute("DROP TABLE IF EXISTS visitors_trigrams, hotels_trigrams, hotel_day_usage, booking_changes")
         cursor.execute("DROP TABLE IF EXISTS bookings, hotels, visitors")
         cursor.execute("DROP FUNCTION IF EXISTS GetRoomsUsageWithinTimeSpan")
+        cursor.execute("DROP FUNCTION IF EXISTS GetTrigrams")
+        cursor.execute("DROP SEQUENCE IF EXISTS bookings_seq, hotels_seq, visitors_seq")
         cursor.close()
         connection.commit()
+        get_mssql_id_allocator().invalidate()
     if create_schema:     
+        # the primary key defaults draw from the sequences, so they have to exist first
+        cursor = connection.cursor()
+        for sequenceName in _sequenceColumns:
+            cursor.execute(_create_mssql_sequence_statement(sequenceName))
+        cursor.close()
         if not doesTableExist(connection, "hotels"):
             responseDict["create_schema"]["hotels"] = True
             cursor = connection.cursor()
             cursor.execute("""
                 CREATE TABLE hotels (
-                    hotelId INT NOT NULL PRIMARY KEY,
+                    hotelId INT NOT NULL PRIMARY KEY DEFAULT (NEXT VALUE FOR hotels_seq),
                     hotelname VARCHAR(200) NOT NULL,
                     pricePerNight FLOAT NOT NULL CHECK (pricePerNight > 0),
                     totalRooms INT NOT NULL CHECK (totalRooms > 0),
@@ -763,7 +1645,7 @@ def setupDb(drop_schema : bool, create_schema : bool, populate_data : bool, numb
             cursor = connection.cursor()
             cursor.execute("""
                 CREATE TABLE visitors (
-                    visitorId INT NOT NULL PRIMARY KEY,
+                    visitorId INT NOT NULL PRIMARY KEY DEFAULT (NEXT VALUE FOR visitors_seq),
                     firstname VARCHAR(200) NOT NULL,
                     lastname VARCHAR(200) NOT NULL,
                     CONSTRAINT visitornameUq UNIQUE(firstname, lastname)
@@ -775,7 +1657,7 @@ def setupDb(drop_schema : bool, create_schema : bool, populate_data : bool, numb
             cursor = connection.cursor()
             cursor.execute("""
                 CREATE TABLE bookings (
-                    bookingId INT NOT NULL PRIMARY KEY,
+                    bookingId INT NOT NULL PRIMARY KEY DEFAULT (NEXT VALUE FOR bookings_seq),
                     hotelId INT NOT NULL,
                     visitorId INT NOT NULL,
                     checkin date NOT NULL,
@@ -800,52 +1682,50 @@ def setupDb(drop_schema : bool, create_schema : bool, populate_data : bool, numb
                 )
             """)
             cursor.close()
-        if not doesFunctionExist(connection, "GetRoomsUsage"):
+        createDayUsage(connection, responseDict)
+        createBookingChanges(connection, responseDict)
+        cursor = connection.cursor()
+        for sequenceName in _dataVersionSequences.values():
+            cursor.execute("IF OBJECT_ID('" + sequenceName + "', 'SO') IS NULL CREATE SEQUENCE " + sequenceName + " AS BIGINT START WITH 1 INCREMENT BY 1 NO CACHE;")
+        cursor.close()
+        if not doesFunctionExist(connection, "GetRoomsUsageWithinTimeSpan"):
             responseDict["create_schema"]["GetRoomsUsageWithinTimeSpan"] = True
             cursor = connection.cursor()
             cursor.execute("""
                 CREATE FUNCTION GetRoomsUsageWithinTimeSpan (@StartDate DATE, @EndDate DATE)
-                RETURNS @RoomUsageTable TABLE (
-                    hotelId INT,
-                    hotelname VARCHAR(200),
-                    country VARCHAR(200),
-                    date DATE,
-                    usedRooms INT,
-                    freeRooms INT
-                )
+                RETURNS TABLE
                 AS
-                BEGIN
-                    -- Generate the dates in the range using a recursive CTE
-                    WITH DateSeries AS (
-                        SELECT @StartDate AS Date
-                        UNION ALL
-                        SELECT DATEADD(DAY, 1, Date)
-                        FROM DateSeries
-                        WHERE Date < @EndDate
-                    )
-                    -- Calculate room usage for each hotel and date
-                    INSERT INTO @RoomUsageTable (hotelId, hotelname, country, date, usedRooms, freeRooms)
+                RETURN (
                     SELECT 
                         h.hotelId,
                         h.hotelname,
                         h.country,
-                        d.Date,
-                        ISNULL(SUM(b.rooms), 0) AS usedRooms,
-                        h.totalRooms - ISNULL(SUM(b.rooms), 0) AS freeRooms
+                        d.date,
+                        ISNULL(u.usedRooms, 0) AS usedRooms,
+                        h.totalRooms - ISNULL(u.usedRooms, 0) AS freeRooms
                     FROM 
                         hotels h
-                    CROSS JOIN 
-                        DateSeries d
+                    CROSS JOIN (
+                        SELECT TOP (CASE WHEN @EndDate >= @StartDate THEN DATEDIFF(DAY, @StartDate, @EndDate) + 1 ELSE 0 END)
+                            DATEADD(DAY, CAST(ROW_NUMBER() OVER (ORDER BY (SELECT NULL)) - 1 AS INT), @StartDate) AS date
+                        FROM sys.all_columns AS a CROSS JOIN sys.all_columns AS b
+                    ) d
                     LEFT JOIN 
-                        bookings b ON h.hotelId = b.hotelId AND d.Date BETWEEN b.checkin AND b.checkout
-                    GROUP BY 
-                        h.hotelId, h.hotelname, h.country, d.Date, h.totalRooms
-                    OPTION (MAXRECURSION 0);
-                    RETURN;
-                END;
+                        hotel_day_usage u ON u.hotelId = h.hotelId AND u.usageDate = d.date
+                );
             """)
             cursor.close()
+        for indexName, createStmt in _bookingIndexes.items():
+            if not doesIndexExist(connection, "bookings", indexName):
+                responseDict["create_indexes"][indexName] = True
+                cursor = connection.cursor()
+                cursor.execute(createStmt)
+                cursor.close()
+        createTrigramSearch(connection, responseDict)
         connection.commit()
+        for indexName in _bookingIndexes:
+            if not doesIndexExist(connection, "bookings", indexName):
+                raise RuntimeError("Index " + indexName + " could not be created")
     if populate_data:
         if not doesTableHaveRows(connection, "hotels"):
             responseDict["populate_data"]["hotels"] = True
@@ -894,31 +1774,69 @@ def setupDb(drop_schema : bool, create_schema : bool, populate_data : bool, numb
             cursor.close()
         if not doesTableHaveRows(connection, "visitors"):
             responseDict["populate_data"]["visitors"] = True
-            cursor = connection.cursor()
-            from .datagenerators import generateVisitorData
-            nextId = 1
-            for visitor in generateVisitorData(number_of_visitors):
-                cursor.execute("INSERT INTO visitors (visitorId, firstname, lastname) VALUES (?, ?, ?)", (nextId, visitor["firstname"], visitor["lastname"]))
-                nextId += 1
-            cursor.close()
+            from .datagenerators import generateVisitorChunks, visitorColumns
+            # the trigram trigger would fire per row, the side table is rebuilt set based after the load instead
+            trigramSearch = doesTableExist(connection, "visitors_trigrams")
+            if trigramSearch:
+                cursor = connection.cursor()
+                cursor.execute("DISABLE TRIGGER trg_visitors_trigrams ON visitors")
+                cursor.close()
+            bulk_insert_chunks(connection, "visitors", visitorColumns, generateVisitorChunks(number_of_visitors, seed, get_int_configuration("DB_BULK_CHUNK_SIZE", 10000)))
+            if trigramSearch:
+                cursor = connection.cursor()
+                cursor.execute("ENABLE TRIGGER trg_visitors_trigrams ON visitors")
+                cursor.close()
+                rebuildTrigrams(connection, "visitors")
         if not doesTableHaveRows(connection, "bookings"):
             responseDict["populate_data"]["bookings"] = True
             cursor = connection.cursor()
             # getting required data
             startDate = datetime.now() + timedelta(days=4)
-            cursor.execute("SELECT hotelId FROM hotels where hotelId <= 1000")
-            hotelIds = [row.hotelId for row in cursor.fetchall()]
-            cursor.execute("SELECT visitorId FROM visitors where visitorId <= 10000")
+            cursor.execute("SELECT hotelId, totalRooms FROM hotels where hotelId <= 1000")
+            hotels = cursor.fetchall()
+            hotelIds = [row.hotelId for row in hotels]
+            hotelCapacities = [row.totalRooms for row in hotels]
+            cursor.execute("SELECT visitorId FROM visitors")
             visitorIds = [row.visitorId for row in cursor.fetchall()]
-            # generating bookings
-            from .datagenerators import generateBookings
-            bookingId = 1
-            for visitorId in visitorIds:
-                for booking in generateBookings(visitorId, hotelIds, min_bookings_per_visitor, max_bookings_per_visitor, startDate):
-                    cursor.execute("INSERT INTO bookings (bookingId, hotelId, visitorId, checkin, checkout, adults, kids, babies, rooms, price) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (bookingId, booking["hotelid"], booking["visitorid"], booking["checkin"], booking["checkout"], booking["adults"], booking["kids"], booking["babies"], booking["rooms"], booking["price"]))
-                    bookingId += 1
             cursor.close()
+            # generating bookings, the day usage and change log triggers would fire per row,
+            # the day usage is rebuilt set based after the load instead and the change log gets a single reset marker
+            from .datagenerators import generateBookingChunks, bookingColumns
+            dayUsage = doesTableExist(connection, "hotel_day_usage")
+            cursor = connection.cursor()
+            cursor.execute("DISABLE TRIGGER ALL ON bookings")
+            cursor.close()
+            bulk_insert_chunks(
+                connection,
+                "bookings",
+                bookingColumns,
+                generateBookingChunks(
+                    visitorIds, hotelIds, min_bookings_per_visitor, max_bookings_per_visitor, startDate, seed,
+                    chunkSize=get_int_configuration("DB_BULK_CHUNK_SIZE", 10000),
+                    hotelCapacities=hotelCapacities,
+                    targetOccupancy=target_occupancy
+                )
+            )
+            cursor = connection.cursor()
+            cursor.execute("ENABLE TRIGGER ALL ON bookings")
+            cursor.close()
+            if dayUsage:
+                rebuildDayUsage(connection)
         connection.commit()
+        # the data was inserted with explicit ids, move the sequences past them
+        idAllocator = get_mssql_id_allocator()
+        idAllocator.invalidate()
+        for sequenceName in _sequenceColumns:
+            idAllocator.ensure_synchronized(sequenceName)
+    if drop_schema or populate_data:
+        if doesTableExist(connection, "booking_changes"):
+            # clients of /api/bookings/changes have to reload all bookings
+            cursor = connection.cursor()
+            cursor.execute("INSERT INTO booking_changes (bookingId, operation) VALUES (NULL, 'R')")
+            cursor.close()
+            connection.commit()
+        get_mssql_data_versions().bump(connection, DATA_VERSION_TABLES)
     connection.close()
+    get_mssql_occupancy_engine().invalidate()
     return responseDict
 
@@ -0,0 +1,391 @@
+import time, threading
+import numpy as np
+from datetime import date, datetime
+from typing import Any, Callable, Dict, Iterable, List, Tuple, Union
+
+from ..config import get_float_configuration
+
+
+# longest time span a single availability request may cover
+MAX_AVAILABILITY_DAYS = 3660
+
+# bookings lie within this many days before / after today, the engine holds these nights only
+# (so a single booking far in the future cannot make every worker allocate arrays up to it)
+BOOKING_HORIZON_DAYS = 3660
+
+_epoch = date(1970, 1, 1)
+
+
+def day_number(value : Union[date, datetime]) -> int:
+    # days since 1970-01-01, the loaders return checkin / checkout in the same unit
+    if isinstance(value, datetime):
+        value = value.date()
+    return (value - _epoch).days
+
+
+class OccupancyEngine:
+    # used rooms per hotel (rows) and night (columns) held in memory, a booking uses the nights checkin..checkout-1
+    # the writes of this process are applied right away, the bookings written by other workers are read from the change log
+    # whenever the bookings data version changed, the arrays are only rebuilt from the database after the hotels changed,
+    # after a reset of the change log (setupDb) and at the latest every refreshSeconds
+    def __init__(
+        self,
+        load : Callable[[], Tuple[Iterable[Tuple[int, int]], Iterable[Tuple[int, int, int, int, int]], Any]],
+        changes : Callable[[Any], Union[Tuple[Iterable[Tuple[int, int, int, int, int]], Iterable[int], Any], None]],
+        refreshSeconds : float = 60.0,
+        versions : Callable[[], Union[Dict[str, int], None]] = None
+    ):
+        # load returns (hotelId, totalRooms) ordered by hotelId, (bookingId, hotelId, checkin day, checkout day, rooms)
+        # and the position in the change log to continue from
+        # changes returns the bookings changed after that position (in the format of load), the ids of the removed bookings
+        # and the new position, or None when the change log cannot be continued (reset or pruned)
+        # versions returns the current data versions (None when they are not available)
+        self._load = load
+        self._changes = changes
+        self._refreshSeconds = float(refreshSeconds)
+        self._versions = versions
+        self._lock = threading.Lock()
+        self._buildLock = threading.Lock()
+        self._loadedAt = None
+        self._invalidations = 0
+        # data versions read before the last build / sync and the position in the change log
+        self._seenVersions = None
+        self._position = None
+        # (first day, last day) of the nights held, set by the build
+        self._window = (0, 0)
+        self._hotelIndexes : Dict[int, int] = {}
+        self._hotelIds = np.zeros(0, dtype=np.int64)
+        self._totalRooms = np.zeros(0, dtype=np.int64)
+        # the counted bookings: (hotelId, first day, last day, rooms) ordered by bookingId as loaded by the last build,
+        # and the bookings changed since then (None for a booking that is not counted)
+        self._bookingIds = np.zeros(0, dtype=np.int64)
+        self._bookings = np.zeros((0, 4), dtype=np.int64)
+        self._changed : Dict[int, Union[Tuple[int, int, int, int], None]] = {}
+        self._firstDay = 0
+        self._usedRooms = np.zeros((0, 0), dtype=np.int32)
+        # max segment tree over the nights of every hotel (leaves at _treeSize + night), built on the first search
+        self._tree = None
+        self._treeSize = 0
+
+    def _readVersions(self) -> Union[Dict[str, int], None]:
+        if self._versions is None:
+            return None
+        try:
+            return self._versions()
+        except Exception:
+            return None
+
+    def _build(self):
+        # must be called with _buildLock held
+        with self._lock:
+            invalidations = self._invalidations
+        # the versions and the position are read before the load, a write the load does not see is read from the change log
+        # by the next sync (its version bump comes after the read, so the versions differ and trigger that sync)
+        versions = self._readVersions()
+        hotels, bookings, position = self._load()
+        hotels = np.array(list(hotels), dtype=np.int64).reshape(-1, 2)
+        bookings = np.array(list(bookings), dtype=np.int64).reshape(-1, 5)
+        hotelIds = hotels[:, 0]
+        today = day_number(date.today())
+        window = (today - BOOKING_HORIZON_DAYS, today + BOOKING_HORIZON_DAYS)
+        # nights outside of the window are left out, bookings of hotels deleted between the two queries are skipped
+        bookings[:, 2] = np.maximum(bookings[:, 2], window[0])
+        bookings[:, 3] = np.minimum(bookings[:, 3], window[1])
+        rows = np.searchsorted(hotelIds, bookings[:, 1])
+        valid = rows < len(hotelIds)
+        valid[valid] = hotelIds[rows[valid]] == bookings[valid, 1]
+        valid &= bookings[:, 3] > bookings[:, 2]
+        rows, bookings = rows[valid], bookings[valid]
+        if len(bookings) > 0:
+            firstDay = int(bookings[:, 2].min())
+            days = int(bookings[:, 3].max()) - firstDay
+        else:
+            firstDay = today
+            days = 0
+        # difference array: +rooms at the checkin, -rooms at the checkout, the prefix sum yields the used rooms per night
+        width = days + 1
+        diff = np.bincount(rows * width + (bookings[:, 2] - firstDay), weights=bookings[:, 4], minlength=len(hotelIds) * width)
+        diff -= np.bincount(rows * width + (bookings[:, 3] - firstDay), weights=bookings[:, 4], minlength=len(hotelIds) * width)
+        usedRooms = np.cumsum(diff.reshape(len(hotelIds), width), axis=1)[:, :days].astype(np.int32)
+        order = np.argsort(bookings[:, 0], kind="stable")
+        with self._lock:
+            self._hotelIndexes = { int(hotelId) : i for i, hotelId in enumerate(hotelIds) }
+            self._hotelIds = hotelIds
+            self._totalRooms = hotels[:, 1]
+            self._bookingIds = bookings[order, 0]
+            self._bookings = bookings[order, 1:]
+            self._changed = {}
+            self._window = window
+            self._firstDay = firstDay
+            self._usedRooms = usedRooms
+            self._tree = None
+            self._seenVersions = versions
+            self._position = position
+            # an invalidate() during the load asks for another build
+            self._loadedAt = time.monotonic() if self._invalidations == invalidations else None
+
+    def _sync(self) -> bool:
+        # must be called with _buildLock held, applies the bookings written since the last build / sync (by any worker,
+        # the writes of this process are applied already, setting them once more changes nothing)
+        # returns False when the change log cannot be continued and the arrays have to be rebuilt
+        versions = self._readVersions()
+        with self._lock:
+            position = self._position
+            invalidations = self._invalidations
+        result = self._changes(position)
+        if result is None:
+            return False
+        bookings, removedBookingIds, position = result
+        with self._lock:
+            if self._invalidations != invalidations or self._loadedAt is None:
+                # the next request rebuilds the arrays anyway
+                return True
+            for bookingId, hotelId, firstDay, lastDay, rooms in bookings:
+                self._setLocked(bookingId, hotelId, firstDay, lastDay, rooms)
+            for bookingId in removedBookingIds:
+                self._setLocked(bookingId, None)
+            self._seenVersions = versions
+            self._position = position
+        return True
+
+    def _staleness(self, loadedAt : float) -> Union[str, None]:
+        # "build" or "sync" when the arrays are behind the database, None when they are current
+        if self._refreshSeconds > 0 and time.monotonic() - loadedAt >= self._refreshSeconds:
+            return "build"
+        versions = self._readVersions()
+        seenVersions = self._seenVersions
+        if versions is None or seenVersions is None:
+            return None
+        if versions.get("hotels") != seenVersions.get("hotels"):
+            # hotels were created, changed or deleted (by another worker)
+            return "build"
+        if versions.get("bookings") != seenVersions.get("bookings"):
+            return "sync"
+        return None
+
+    def _ensureLoaded(self):
+        loadedAt = self._loadedAt
+        if loadedAt is None:
+            # nothing (valid) to serve yet, wait for the build
+            with self._buildLock:
+                if self._loadedAt is None:
+                    self._build()
+            return
+        staleness = self._staleness(loadedAt)
+        if staleness is not None and self._buildLock.acquire(blocking=False):
+            # a single thread updates in the background, the requests keep answering from the current arrays
+            threading.Thread(target=self._update, args=(staleness,), name="occupancy-update", daemon=True).start()
+
+    def _update(self, staleness : str):
+        try:
+            if staleness == "sync" and self._sync():
+                return
+            self._build()
+        except Exception:
+            # the arrays stay as they are, the next request tries again
+            pass
+        finally:
+            self._buildLock.release()
+
+    def _ensureDays(self, firstDay : int, lastDay : int):
+        # must be called with the lock held, grows the arrays to cover the nights firstDay..lastDay-1
+        currentLast = self._firstDay + self._usedRooms.shape[1]
+        before = max(0, self._firstDay - firstDay)
+        after = max(0, lastDay - currentLast)
+        if before > 0 or after > 0:
+            self._usedRooms = np.pad(self._usedRooms, ((0, 0), (before, after)))
+            self._firstDay -= before
+            self._tree = None
+
+    def _ensureTree(self):
+        # must be called with the lock held, one vectorized pass per tree level over all hotels
+        if self._tree is not None:
+            return
+        days = self._usedRooms.shape[1]
+        size = 1
+        while size < days:
+            size *= 2
+        tree = np.zeros((self._usedRooms.shape[0], 2 * size), dtype=np.int32)
+        tree[:, size:size + days] = self._usedRooms
+        level = size
+        while level > 1:
+            tree[:, level // 2:level] = np.maximum(tree[:, level:2 * level:2], tree[:, level + 1:2 * level:2])
+            level //= 2
+        self._tree = tree
+        self._treeSize = size
+
+    def _updateTree(self, hotelIndex : int, start : int, end : int):
+        # must be called with the lock held, copies the nights start..end-1 into the leaves and recomputes their parents
+        if self._tree is None:
+            return
+        tree = self._tree[hotelIndex]
+        lo = self._treeSize + start
+        hi = self._treeSize + end - 1
+        tree[lo:hi + 1] = self._usedRooms[hotelIndex, start:end]
+        while lo > 1:
+            lo //= 2
+            hi //= 2
+            tree[lo:hi + 1] = np.maximum(tree[2 * lo:2 * hi + 2:2], tree[2 * lo + 1:2 * hi + 2:2])
+
+    def _treeNodes(self, start : int, end : int) -> List[int]:
+        # the O(log n) nodes covering the nights start..end-1, they are the same for every hotel
+        nodes = []
+        lo = self._treeSize + start
+        hi = self._treeSize + end
+        while lo < hi:
+            if lo & 1:
+                nodes.append(lo)
+                lo += 1
+            if hi & 1:
+                hi -= 1
+                nodes.append(hi)
+            lo //= 2
+            hi //= 2
+        return nodes
+
+    def _countedLocked(self, bookingId : int) -> Union[Tuple[int, int, int, int], None]:
+        # must be called with the lock held, (hotelId, first day, last day, rooms) the arrays count for the booking
+        if bookingId in self._changed:
+            return self._changed[bookingId]
+        index = int(np.searchsorted(self._bookingIds, bookingId))
+        if index < len(self._bookingIds) and self._bookingIds[index] == bookingId:
+            return tuple(self._bookings[index].tolist())
+        return None
+
+    def _addLocked(self, hotelId : int, firstDay : int, lastDay : int, rooms : int):
+        # must be called with the lock held
+        hotelIndex = self._hotelIndexes[hotelId]
+        self._ensureDays(firstDay, lastDay)
+        self._usedRooms[hotelIndex, firstDay - self._firstDay:lastDay - self._firstDay] += rooms
+        self._updateTree(hotelIndex, firstDay - self._firstDay, lastDay - self._firstDay)
+
+    def _setLocked(self, bookingId : int, hotelId : Union[int, None], firstDay : int = 0, lastDay : int = 0, rooms : int = 0):
+        # must be called with the lock held, makes the arrays count the booking with this stay (or not at all without a hotel),
+        # so applying the same write twice (by this process and from the change log) counts it once
+        if self._loadedAt is None:
+            # the next build loads the booking
+            return
+        if hotelId is not None:
+            firstDay = max(firstDay, self._window[0])
+            lastDay = min(lastDay, self._window[1])
+            if lastDay <= firstDay:
+                hotelId = None
+            elif hotelId not in self._hotelIndexes:
+                # hotel created after the last build
+                self._invalidateLocked()
+                return
+        stay = (hotelId, firstDay, lastDay, rooms) if hotelId is not None else None
+        counted = self._countedLocked(bookingId)
+        if counted == stay:
+            return
+        if counted is not None:
+            self._addLocked(counted[0], counted[1], counted[2], -counted[3])
+        if stay is not None:
+            self._addLocked(hotelId, firstDay, lastDay, rooms)
+        self._changed[bookingId] = stay
+
+    def add_booking(self, bookingId : int, hotelId : int, checkin : Union[date, datetime], checkout : Union[date, datetime], rooms : int):
+        with self._lock:
+            self._setLocked(bookingId, hotelId, day_number(checkin), day_number(checkout), rooms)
+
+    def remove_booking(self, bookingId : int):
+        with self._lock:
+            self._setLocked(bookingId, None)
+
+    def _invalidateLocked(self):
+        self._loadedAt = None
+        self._invalidations += 1
+
+    def invalidate(self):
+        # the next request rebuilds the arrays, i.e. after hotels were changed or the tables were set up again
+        with self._lock:
+            self._invalidateLocked()
+
+    def _checkWindow(self, firstDay : int, lastDay : int):
+        # must be called with the lock held
+        if firstDay < self._window[0] or lastDay > self._window[1]:
+            raise ValueError("The time span must be within " + str(BOOKING_HORIZON_DAYS) + " days of today")
+
+    def get_availability(self, hotelId : int, fromdate : Union[date, datetime], untildate : Union[date, datetime]) -> Dict[str, Any]:
+        firstDay = day_number(fromdate)
+        lastDay = day_number(untildate)
+        if lastDay <= firstDay:
+            raise ValueError("from must be before until")
+        if lastDay - firstDay > MAX_AVAILABILITY_DAYS:
+            raise ValueError("The time span must not exceed " + str(MAX_AVAILABILITY_DAYS) + " days")
+        self._ensureLoaded()
+        loadedAt = self._loadedAt
+        if hotelId not in self._hotelIndexes and loadedAt is not None and time.monotonic() - loadedAt >= 1.0:
+            # the hotel might have been created after the last build (at most one rebuild per second for unknown hotels)
+            self.invalidate()
+            self._ensureLoaded()
+        with self._lock:
+            hotelIndex = self._hotelIndexes.get(hotelId)
+            if hotelIndex is None:
+                raise ValueError("Hotel does not exist")
+            self._checkWindow(firstDay, lastDay)
+            totalRooms = int(self._totalRooms[hotelIndex])
+            usedRooms = np.zeros(lastDay - firstDay, dtype=np.int32)
+            # nights outside of the arrays have no bookings
+            start = max(firstDay, self._firstDay)
+            end = min(lastDay, self._firstDay + self._usedRooms.shape[1])
+            if start < end:
+                usedRooms[start - firstDay:end - firstDay] = self._usedRooms[hotelIndex, start - self._firstDay:end - self._firstDay]
+        freeRooms = totalRooms - usedRooms
+        dates = (np.datetime64(_epoch, "D") + np.arange(firstDay, lastDay)).astype(str)
+        return {
+            "hotelId" : hotelId,
+            "totalRooms" : totalRooms,
+            "fromdate" : str(dates[0]),
+            "untildate" : str(np.datetime64(_epoch, "D") + lastDay),
+            "minFreeRooms" : int(freeRooms.min()),
+            "days" : [
+                { "date" : d, "usedRooms" : u, "freeRooms" : f }
+                for d, u, f in zip(dates.tolist(), usedRooms.tolist(), freeRooms.tolist())
+            ]
+        }
+
+    def find_available_hotels(
+        self,
+        checkin : Union[date, datetime],
+        checkout : Union[date, datetime],
+        rooms : int = 1,
+        hotelIds : Iterable[int] = None
+    ) -> Dict[int, int]:
+        # returns hotelId -> free rooms on the fullest night of the stay for the hotels with at least rooms free rooms on every night
+        firstDay = day_number(checkin)
+        lastDay = day_number(checkout)
+        rooms = int(rooms)
+        if lastDay <= firstDay:
+            raise ValueError("checkin must be before checkout")
+        if lastDay - firstDay > MAX_AVAILABILITY_DAYS:
+            raise ValueError("The stay must not exceed " + str(MAX_AVAILABILITY_DAYS) + " nights")
+        if rooms <= 0:
+            raise ValueError("rooms must be greater than 0")
+        self._ensureLoaded()
+        with self._lock:
+            self._checkWindow(firstDay, lastDay)
+            if hotelIds is None:
+                candidates = np.arange(len(self._totalRooms))
+            else:
+                # hotels created after the last build are unknown until the next rebuild
+                candidates = np.array([self._hotelIndexes[hotelId] for hotelId in hotelIds if hotelId in self._hotelIndexes], dtype=np.int64)
+            # nights outside of the arrays have no bookings
+            start = max(firstDay, self._firstDay) - self._firstDay
+            end = min(lastDay, self._firstDay + self._usedRooms.shape[1]) - self._firstDay
+            if start < end and len(candidates) > 0:
+                self._ensureTree()
+                usedRooms = self._tree[np.ix_(candidates, self._treeNodes(start, end))].max(axis=1)
+            else:
+                usedRooms = np.zeros(len(candidates), dtype=np.int32)
+            freeRooms = self._totalRooms[candidates] - usedRooms
+            available = freeRooms >= rooms
+            return dict(zip(self._hotelIds[candidates[available]].tolist(), freeRooms[available].tolist()))
+
+
+def create_configured_occupancy_engine(
+    load : Callable[[], Tuple[Iterable[Tuple[int, int]], Iterable[Tuple[int, int, int, int, int]], Any]],
+    changes : Callable[[Any], Union[Tuple[Iterable[Tuple[int, int, int, int, int]], Iterable[int], Any], None]],
+    versions : Callable[[], Union[Dict[str, int], None]] = None
+) -> OccupancyEngine:
+    return OccupancyEngine(load, changes, refreshSeconds=get_float_configuration("OCCUPANCY_REFRESH_SECONDS", 60.0), versions=versions)
@@ -1,22 +1,31 @@
 import psycopg2
-from psycopg2.extras import RealDictCursor
-import os, time, math
+import os, io, csv, time, queue, select, threading
 from datetime import datetime, timedelta
-from typing import Dict, Union, Iterable
+from typing import Any, Callable, Dict, List, Tuple, Union, Iterable, Iterator
 from enum import Enum
 
 
-from . import SQLMode, get_defined_database, parse_connection_string_to_dict, get_bool_value
+from . import SQLMode, get_defined_database, get_connection_parameters, get_bool_value, get_amenities, parse_amenities, get_page_limit, encode_cursor, decode_cursor, cursor_date, build_page, escape_like, chunked
+from .connectionpool import ConnectionPool, PooledConnection, create_configured_pool
+from .idallocator import IdAllocator, create_configured_id_allocator
+from .occupancy import OccupancyEngine, create_configured_occupancy_engine
+from .dataversion import DataVersions, DATA_VERSION_TABLES, create_configured_data_versions
+from .changehub import ChangeHub, create_configured_change_hub
+from .batch import WriteEffects, run_batch
+from .bookingimport import BOOKING_IMPORT_COLUMNS, check_booking_values, plan_booking_import, booking_import_stays
+from .export import EXPORT_COLUMNS, EXPORT_BOOLEAN_COLUMNS, export_query
+from .rowmapper import RowMapper
+from ..config import get_int_configuration
 
 
-def get_postgres_connection() -> psycopg2.extensions.connection:
+def create_postgres_connection() -> psycopg2.extensions.connection:
     connectionstring, connectionname = get_defined_database()
     if connectionname != "POSTGRES_CONNECTION_STRING":
         raise ValueError("Connection string is not for Postgres")
     if not connectionstring:
         raise ValueError("Connection string is empty")
 
-    info = parse_connection_string_to_dict(connectionstring, {"host" : "", "port" : "\\d+", "user" : "", "password" : "", "database" : ""})
+    info = get_connection_parameters(connectionstring, {"host" : "", "port" : "\\d+", "user" : "", "password" : "", "database" : ""})
     if "host" not in info or "port" not in info or "user" not in info or "password" not in info or "database" not in info:
         raise ValueError("Connection string is missing required parameters (host, port, user, password, database)")
     info["port"] = int(info["port"])
@@ -24,6 +33,289 @@ def get_postgres_connection() -> psycopg2.extensions.connection:
     return psycopg2.connect(host=info["host"], port=info["port"], user=info["user"], password=info["password"], database=info["database"])
 
 
+def _ping_postgres_connection(connection : psycopg2.extensions.connection):
+    cursor = connection.cursor()
+    cursor.execute("SELECT 1")
+    cursor.fetchall()
+    cursor.close()
+    # the ping opened a transaction, don't leave it hanging
+    connection.rollback()
+
+def _reset_postgres_connection(connection : psycopg2.extensions.connection):
+    # rollback is a no-op on the wire when no transaction is open
+    connection.rollback()
+
+_pool = None
+_poolConnectionString = None
+_poolLock = threading.Lock()
+
+def get_postgres_pool() -> ConnectionPool:
+    global _pool, _poolConnectionString
+    connectionstring, connectionname = get_defined_database()
+    if _pool is None or _poolConnectionString != connectionstring:
+        with _poolLock:
+            if _pool is not None and _poolConnectionString != connectionstring:
+                # connection string was rotated, drain the pool so new checkouts use the new credentials
+                _pool.dispose()
+                _pool = None
+            if _pool is None:
+                _pool = create_configured_pool(
+                    create_postgres_connection,
+                    ping=_ping_postgres_connection,
+                    reset=_reset_postgres_connection,
+                    isClosed=lambda connection: connection.closed != 0
+                )
+                _poolConnectionString = connectionstring
+    return _pool
+
+def get_postgres_connection() -> PooledConnection:
+    # the returned connection goes back to the pool on close()
+    return get_postgres_pool().acquire()
+
+def get_pool_stats() -> Dict[str, Union[int, float]]:
+    return get_postgres_pool().getStats()
+
+
+# sequences created by the SERIAL primary keys -> (table, primary key)
+_sequenceColumns = {
+    "hotels_hotelid_seq" : ("hotels", "hotelId"),
+    "visitors_visitorid_seq" : ("visitors", "visitorId"),
+    "bookings_bookingid_seq" : ("bookings", "bookingId")
+}
+
+def _synchronize_postgres_sequence(sequenceName : str):
+    tableName, columnName = _sequenceColumns[sequenceName]
+    # a dedicated connection, like the mssql layer (the pool might have no connection left while the caller holds one)
+    connection = create_postgres_connection()
+    try:
+        connection.autocommit = True
+        cursor = connection.cursor()
+        # only ever moves the sequence forward, setval is not transactional
+        cursor.execute(
+            "SELECT setval(%s, t.maxId) FROM (SELECT max(" + columnName + ") AS maxId FROM " + tableName + ") AS t " +
+            "WHERE t.maxId >= (SELECT CASE WHEN is_called THEN last_value + 1 ELSE last_value END FROM " + sequenceName + ")",
+            (sequenceName,)
+        )
+        cursor.close()
+    finally:
+        connection.close()
+
+def _reserve_postgres_ids(connection : psycopg2.extensions.connection, sequenceName : str, count : int) -> Iterable[int]:
+    cursor = connection.cursor()
+    cursor.execute("SELECT nextval(%s) FROM generate_series(1, %s)", (sequenceName, count))
+    ids = [row[0] for row in cursor.fetchall()]
+    cursor.close()
+    return ids
+
+_idAllocator = None
+
+def get_postgres_id_allocator() -> IdAllocator:
+    global _idAllocator
+    if _idAllocator is None:
+        with _poolLock:
+            if _idAllocator is None:
+                _idAllocator = create_configured_id_allocator(_reserve_postgres_ids, _synchronize_postgres_sequence)
+    return _idAllocator
+
+
+_occupancyBookingsSelect = "SELECT bookingId, hotelId, checkin - DATE '1970-01-01', checkout - DATE '1970-01-01', rooms FROM bookings"
+
+def _load_postgres_occupancy() -> Tuple[List[Tuple[int, int]], List[Tuple[int, int, int, int, int]], Tuple[int, float]]:
+    connection = get_postgres_connection()
+    cursor = connection.cursor()
+    # the position in the change log is read before the tables (like the token of get_booking_changes)
+    cursor.execute("SELECT txid_snapshot_xmin(txid_current_snapshot())")
+    position = (cursor.fetchone()[0], time.time())
+    cursor.execute("SELECT hotelId, totalRooms FROM hotels ORDER BY hotelId")
+    hotels = cursor.fetchall()
+    cursor.execute(_occupancyBookingsSelect)
+    bookings = cursor.fetchall()
+    cursor.close()
+    connection.close()
+    return hotels, bookings, position
+
+def _load_postgres_occupancy_changes(position : Tuple[int, float]) -> Union[Tuple[List[Tuple[int, int, int, int, int]], List[int], Tuple[int, float]], None]:
+    # the bookings changed after position, None when the change log was reset or pruned since then
+    retention = get_int_configuration("BOOKING_CHANGES_RETENTION_SECONDS", 86400)
+    if position is None or position[1] < time.time() - retention:
+        return None
+    connection = get_postgres_connection()
+    cursor = connection.cursor()
+    cursor.execute("SELECT txid_snapshot_xmin(txid_current_snapshot())")
+    watermark = cursor.fetchone()[0]
+    cursor.execute("SELECT DISTINCT bookingId FROM booking_changes WHERE txId >= %s AND txId < %s", (position[0], watermark))
+    bookingIds = [row[0] for row in cursor.fetchall()]
+    bookings = []
+    if len(bookingIds) > 0 and None not in bookingIds:
+        cursor.execute(_occupancyBookingsSelect + " WHERE bookingId = ANY(%s)", (bookingIds,))
+        bookings = cursor.fetchall()
+    cursor.close()
+    connection.close()
+    if None in bookingIds:
+        # setupDb dropped or populated the tables
+        return None
+    found = set(booking[0] for booking in bookings)
+    return bookings, [bookingId for bookingId in bookingIds if bookingId not in found], (watermark, time.time())
+
+_occupancyEngine = None
+
+def get_postgres_occupancy_engine() -> OccupancyEngine:
+    global _occupancyEngine
+    if _occupancyEngine is None:
+        with _poolLock:
+            if _occupancyEngine is None:
+                _occupancyEngine = create_configured_occupancy_engine(_load_postgres_occupancy, _load_postgres_occupancy_changes, get_data_versions)
+    return _occupancyEngine
+
+def get_availability(hotelId : int, fromdate : datetime, untildate : datetime) -> Dict[str, Any]:
+    return get_postgres_occupancy_engine().get_availability(hotelId, fromdate, untildate)
+
+
+# one sequence per table, they survive drop_schema so a recreated database never repeats an old version
+_dataVersionSequences = { tableName : "data_version_" + tableName for tableName in DATA_VERSION_TABLES }
+
+def _read_postgres_data_versions() -> Dict[str, int]:
+    connection = get_postgres_connection()
+    cursor = connection.cursor()
+    cursor.execute("SELECT " + ", ".join(
+        "(SELECT CASE WHEN is_called THEN last_value ELSE 0 END FROM " + _dataVersionSequences[tableName] + ")" for tableName in DATA_VERSION_TABLES
+    ))
+    row = cursor.fetchone()
+    cursor.close()
+    connection.close()
+    return dict(zip(DATA_VERSION_TABLES, row))
+
+def _bump_postgres_data_versions(connection : psycopg2.extensions.connection, tableNames : List[str]) -> Dict[str, int]:
+    # nextval is not transactional, the new versions are visible to all workers right away
+    cursor = connection.cursor()
+    cursor.execute("SELECT " + ", ".join("nextval('" + _dataVersionSequences[tableName] + "')" for tableName in tableNames))
+    row = cursor.fetchone()
+    cursor.close()
+    return dict(zip(tableNames, row))
+
+_dataVersions = None
+
+def get_postgres_data_versions() -> DataVersions:
+    global _dataVersions
+    if _dataVersions is None:
+        with _poolLock:
+            if _dataVersions is None:
+                _dataVersions = create_configured_data_versions(_read_postgres_data_versions, _bump_postgres_data_versions)
+    return _dataVersions
+
+def get_data_versions() -> Union[Dict[str, int], None]:
+    return get_postgres_data_versions().get()
+
+def _apply_write_effects(connection : psycopg2.extensions.connection, effects : WriteEffects):
+    # must be called after the commit
+    if len(effects.tableNames) > 0:
+        get_postgres_data_versions().bump(connection, effects.tableNames)
+    for callback in effects.callbacks:
+        callback()
+
+def _run_write(write : Callable[[psycopg2.extensions.connection, WriteEffects], Any]) -> Any:
+    # runs write in a transaction of its own
+    effects = WriteEffects()
+    connection = get_postgres_connection()
+    try:
+        result = write(connection, effects)
+        connection.commit()
+        _apply_write_effects(connection, effects)
+    finally:
+        # a failed write is rolled back when the connection returns to the pool
+        connection.close()
+    return result
+
+def _postgres_savepoint(connection : psycopg2.extensions.connection):
+    cursor = connection.cursor()
+    cursor.execute("SAVEPOINT batch_operation")
+    cursor.close()
+
+def _rollback_postgres_savepoint(connection : psycopg2.extensions.connection) -> bool:
+    cursor = connection.cursor()
+    cursor.execute("ROLLBACK TO SAVEPOINT batch_operation")
+    cursor.close()
+    return True
+
+def _release_postgres_savepoint(connection : psycopg2.extensions.connection):
+    cursor = connection.cursor()
+    cursor.execute("RELEASE SAVEPOINT batch_operation")
+    cursor.close()
+
+# the data of the operations is validated and converted by the view, the keys are the parameter names of the write functions
+_batchHandlers = {
+    ("create", "booking") : lambda connection, effects, data: _create_booking(connection, effects, **data),
+    ("delete", "booking") : lambda connection, effects, data: { "deleted" : _delete_booking(connection, effects, data["bookingId"]), "bookingId" : data["bookingId"] },
+    ("create", "visitor") : lambda connection, effects, data: _manage_visitor(connection, effects, sqlmode=SQLMode.INSERT, **data),
+    ("update", "visitor") : lambda connection, effects, data: _manage_visitor(connection, effects, sqlmode=SQLMode.UPDATE, **data),
+    ("delete", "visitor") : lambda connection, effects, data: { "deleted" : _delete_visitor(connection, effects, data["visitorId"]), "visitorId" : data["visitorId"] },
+    ("create", "hotel") : lambda connection, effects, data: _manage_hotel(connection, effects, sqlmode=SQLMode.INSERT, **data),
+    ("update", "hotel") : lambda connection, effects, data: _manage_hotel(connection, effects, sqlmode=SQLMode.UPDATE, **data),
+    ("delete", "hotel") : lambda connection, effects, data: { "deleted" : _delete_hotel(connection, effects, data["hotelId"]), "hotelId" : data["hotelId"] }
+}
+
+def execute_batch(operations : List[Dict[str, Any]], atomic : bool = True) -> Dict[str, Any]:
+    # all operations run on one connection in one transaction
+    connection = get_postgres_connection()
+    try:
+        results, commit, effects = run_batch(
+            connection, operations, _batchHandlers,
+            _postgres_savepoint, _rollback_postgres_savepoint, _release_postgres_savepoint,
+            atomic
+        )
+        if commit:
+            connection.commit()
+            _apply_write_effects(connection, effects)
+    finally:
+        connection.close()
+    return { "success" : all(result["success"] for result in results), "atomic" : atomic, "committed" : commit, "results" : results }
+
+
+def bulk_insert(connection : psycopg2.extensions.connection, tableName : str, columns : List[str], rows : Iterable[Tuple], chunkSize : int = None) -> int:
+    if chunkSize is None:
+        chunkSize = get_int_configuration("DB_BULK_CHUNK_SIZE", 10000)
+    return bulk_insert_chunks(connection, tableName, columns, chunked(rows, chunkSize))
+
+
+def bulk_insert_chunks(connection : psycopg2.extensions.connection, tableName : str, columns : List[str], chunks : Iterable[List[Tuple]]) -> int:
+    # COPY FROM STDIN fed from an in-memory CSV buffer, one round trip per chunk instead of one per row
+    copyStmt = "COPY " + tableName + " (" + ", ".join(columns) + ") FROM STDIN WITH (FORMAT csv)"
+    cursor = connection.cursor()
+    count = 0
+    for chunk in chunks:
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator="\n").writerows(chunk)
+        buffer.seek(0)
+        cursor.copy_expert(copyStmt, buffer)
+        count += len(chunk)
+    cursor.close()
+    return count
+
+
+def _stream_rows(query : str, params : List[Any], mapper : RowMapper) -> Iterator[Dict[str, Union[int, str, float, bool]]]:
+    # named (server side) cursor, rows are transferred in batches of DB_STREAM_BATCH_SIZE instead of all at once
+    connection = get_postgres_connection()
+    cursor = None
+    try:
+        cursor = connection.cursor(name="contoso_stream")
+        cursor.itersize = max(1, get_int_configuration("DB_STREAM_BATCH_SIZE", 1000))
+        cursor.execute(query, params)
+        mapRow = None
+        for row in cursor:
+            if mapRow is None:
+                # a named cursor knows its columns once the first rows arrived
+                mapRow = mapper.compile(cursor.description)
+            yield mapRow(row)
+    finally:
+        # also runs when the client disconnects and the generator gets closed early
+        if cursor is not None:
+            try:
+                cursor.close()
+            except Exception:
+                pass
+        connection.close()
+
+
 def longsqlrequest() -> int:
     connection = get_postgres_connection()
     cursor = connection.cursor()
@@ -38,98 +330,103 @@ def longsqlrequest() -> int:
     return 10 + 10
 
 def create_booking(hotelId : int, visitorId : int, checkin : datetime, checkout : datetime, adults : int, kids : int, babies : int, rooms : int = None, price : float = None, bookingId : int = None) -> Dict[str, Union[int, str, float, bool]]:
-    if adults <= 0:
-        raise ValueError("At least one adult is required")
-    if checkin >= checkout:
-        raise ValueError("Checkin date must be before checkout date")
-    if rooms is None:
-        rooms = int(math.ceil((adults / 2) + (kids / 4) + (babies / 8)))
-    elif rooms < int(math.ceil((adults / 2) + (kids / 4) + (babies / 8))):
-        raise ValueError("Not enough rooms for the number of guests")
+    return _run_write(lambda connection, effects: _create_booking(connection, effects, hotelId, visitorId, checkin, checkout, adults, kids, babies, rooms, price, bookingId))
 
-    connection = get_postgres_connection()
-    # checking hotel exists
-    cursor = connection.cursor(cursor_factory=RealDictCursor)
-    cursor.execute("SELECT hotelId, pricePerNight FROM hotels WHERE hotelId = %s", (hotelId,))
-    row = cursor.fetchone()
-    if row is not None:
-        hotelExists = True
-        if price is None or price <= 0:
-            price = row['pricepernight'] * (checkout - checkin).days * rooms
-    else:
-        hotelExists = False
-    cursor.close()
-    if not hotelExists:
-        raise ValueError("Hotel does not exist")
-    # checking visitor exists
+def _create_booking(connection : psycopg2.extensions.connection, effects : WriteEffects, hotelId : int, visitorId : int, checkin : datetime, checkout : datetime, adults : int, kids : int, babies : int, rooms : int = None, price : float = None, bookingId : int = None, newBookingId : int = None) -> Dict[str, Union[int, str, float, bool]]:
+    # bookingId is only checked for duplicates, newBookingId is the id to insert (a new one from the sequence without it)
+    rooms = check_booking_values(checkin, checkout, adults, kids, babies, rooms)
+
+    # one round trip: hotel / visitor existence, duplicate check, price calculation and insert are done server side
+    if newBookingId is None:
+        newBookingId = get_postgres_id_allocator().next_id(connection, "bookings_bookingid_seq")
     cursor = connection.cursor()
-    cursor.execute("SELECT count(*) as num FROM visitors WHERE visitorId = %s", (visitorId,))
+    try:
+        cursor.execute("""
+            WITH
+                hotel AS (
+                    SELECT hotelId, pricePerNight FROM hotels WHERE hotelId = %(hotelId)s
+                ),
+                visitor AS (
+                    SELECT visitorId FROM visitors WHERE visitorId = %(visitorId)s
+                ),
+                duplicate AS (
+                    SELECT count(*) AS num FROM bookings
+                    WHERE bookingId = %(bookingId)s
+                       OR (hotelId = %(hotelId)s AND visitorId = %(visitorId)s AND checkin = %(checkin)s AND checkout = %(checkout)s)
+                ),
+                inserted AS (
+                    INSERT INTO bookings (bookingId, hotelId, visitorId, checkin, checkout, adults, kids, babies, rooms, price)
+                    SELECT
+                        COALESCE(%(newBookingId)s, nextval('bookings_bookingid_seq')),
+                        hotel.hotelId,
+                        visitor.visitorId,
+                        %(checkin)s, %(checkout)s, %(adults)s, %(kids)s, %(babies)s, %(rooms)s,
+                        CASE WHEN %(price)s::float IS NULL OR %(price)s::float <= 0 THEN hotel.pricePerNight * %(nights)s * %(rooms)s ELSE %(price)s::float END
+                    FROM hotel, visitor, duplicate
+                    WHERE duplicate.num = 0
+                    RETURNING bookingId, price
+                )
+            SELECT
+                (SELECT count(*) FROM hotel) AS hotelExists,
+                (SELECT count(*) FROM visitor) AS visitorExists,
+                (SELECT num FROM duplicate) AS duplicates,
+                inserted.bookingId,
+                inserted.price
+            FROM (SELECT 1) AS one
+            LEFT JOIN inserted ON true
+        """, {
+            "hotelId" : hotelId, "visitorId" : visitorId, "bookingId" : bookingId, "newBookingId" : newBookingId,
+            "checkin" : checkin.strftime('%Y-%m-%d'), "checkout" : checkout.strftime('%Y-%m-%d'), "nights" : (checkout - checkin).days,
+            "adults" : adults, "kids" : kids, "babies" : babies, "rooms" : rooms, "price" : price
+        })
+    except psycopg2.errors.CheckViolation as e:
+        # raised by the day usage trigger
+        cursor.close()
+        if e.diag.constraint_name == _capacityConstraint:
+            raise ValueError("Not enough rooms available")
+        raise
     row = cursor.fetchone()
-    visitorExists = row[0] > 0
     cursor.close()
-    if not visitorExists:
+    if row[0] <= 0:
+        raise ValueError("Hotel does not exist")
+    if row[1] <= 0:
         raise ValueError("Visitor does not exist")
-    # checking if booking already exists and getting next bookingId
-    cursor = connection.cursor()
-    if bookingId is None:
-        cursor.execute("SELECT count(*) as num, (select max(b.bookingId) from bookings as b) as currentMaxId FROM bookings WHERE hotelId = %s and visitorId = %s and checkin = %s and checkout = %s", (hotelId, visitorId, checkin.strftime('%Y-%m-%d'), checkout.strftime('%Y-%m-%d')))
-    else:
-        cursor.execute("SELECT count(*) as num, (select max(b.bookingId) from bookings as b) as currentMaxId FROM bookings WHERE bookingId = %s or (hotelId = %s and visitorId = %s and checkin = %s and checkout = %s)", (bookingId, hotelId, visitorId, checkin.strftime('%Y-%m-%d'), checkout.strftime('%Y-%m-%d')))
-    row = cursor.fetchone()
-    alreadyExists = row[0] > 0
-    nextId = row[1] + 1
-    cursor.close()
-    
-    if alreadyExists:
+    if row[2] > 0:
         raise RuntimeError("Booking already exists")
+    nextId = row[3]
+    price = row[4]
+    effects.touch("bookings")
+    effects.after_commit(lambda: get_postgres_occupancy_engine().add_booking(nextId, hotelId, checkin, checkout, rooms))
+    return { "bookingId" : nextId, "hotelId" : hotelId, "visitorId" : visitorId, "checkin" : checkin.strftime('%Y-%m-%d'), "checkout" : checkout.strftime('%Y-%m-%d'), "adults" : adults, "kids" : kids, "babies" : babies, "rooms" : rooms, "price" : price }
 
-    if nextId <= 0:
-        nextId = 1
-    
+def delete_booking(bookingId : int) -> bool:
+    return _run_write(lambda connection, effects: _delete_booking(connection, effects, bookingId))
+
+def _delete_booking(connection : psycopg2.extensions.connection, effects : WriteEffects, bookingId : int) -> bool:
     cursor = connection.cursor()
-    cursor.execute("INSERT INTO bookings (bookingId, hotelId, visitorId, checkin, checkout, adults, kids, babies, rooms, price) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)", (nextId, hotelId, visitorId, checkin.strftime('%Y-%m-%d'), checkout.strftime('%Y-%m-%d'), adults, kids, babies, rooms, price))
+    cursor.execute("DELETE FROM bookings WHERE bookingId = %s RETURNING hotelId, checkin, checkout, rooms", (bookingId,))
+    row = cursor.fetchone()
     cursor.close()
-    connection.commit()
-    connection.close()
-    return { "bookingId" : nextId, "hotelId" : hotelId, "visitorId" : visitorId, "checkin" : checkin.strftime('%Y-%m-%d'), "checkout" : checkout.strftime('%Y-%m-%d'), "adults" : adults, "kids" : kids, "babies" : babies, "rooms" : rooms, "price" : price }
+    if row is None:
+        return False
+    effects.touch("bookings")
+    effects.after_commit(lambda: get_postgres_occupancy_engine().remove_booking(bookingId))
+    return True
 
-def delete_booking(bookingId : int) -> bool:
-    connection = get_postgres_connection()
-    requiresDeletion = tablePrimaryKeyExists(connection, "bookings", bookingId)
-    if requiresDeletion:
-        cursor = connection.cursor()
-        cursor.execute("DELETE FROM bookings WHERE bookingId = %s", (bookingId,))
-        cursor.close()
-        connection.commit()
-    connection.close()
-    return requiresDeletion
+_bookingMapper = RowMapper("bookingId", "hotelId", "visitorId", "checkin", "checkout", "adults", "kids", "babies", "rooms", "price")
 
 def get_booking(bookingId : int) -> Dict[str, Union[int, str, float, bool]]:
     connection = get_postgres_connection()
-    cursor = connection.cursor(cursor_factory=RealDictCursor)
-    cursor.execute("select bookingId, hotelId, visitorId, checkin, checkout, adults, kids, babies, rooms, price from bookings where bookingId = %s", (bookingId,))
-    row = cursor.fetchone()
-    if row is None:
-        return {}
-    booking = {
-        "bookingId" : row['bookingid'],
-        "hotelId" : row['hotelid'],
-        "visitorId" : row['visitorid'],
-        "checkin" :  row['checkin'].strftime('%Y-%m-%d'),
-        "checkout" : row['checkout'].strftime('%Y-%m-%d'),
-        "adults" : row['adults'],
-        "kids" :   row['kids'],
-        "babies" : row['babies'],
-        "rooms" : row['rooms'],
-        "price" : row['price']
-    }
+    cursor = connection.cursor()
+    cursor.execute("select " + _bookingMapper.columns + " from bookings where bookingId = %s", (bookingId,))
+    booking = _bookingMapper.fetchone(cursor)
     cursor.close()
     connection.close()
+    if booking is None:
+        return {}
     return booking
 
-def get_bookings(visitorId : int = None, hotelId : int = None, fromdate : datetime = None, untildate : datetime = None) -> Iterable[Dict[str, Union[int, str, float, bool]]]:
-    params = []
-    query = """
+_bookingsSelect = """
     select
         bookings.bookingId,
         bookings.checkin,
@@ -147,6 +444,10 @@ def get_bookings(visitorId : int = None, hotelId : int = None, fromdate : dateti
     from bookings
     left join visitors on visitors.visitorId = bookings.visitorId
     """
+
+def _bookings_query(visitorId : int = None, hotelId : int = None, fromdate : datetime = None, untildate : datetime = None, limit : int = None, cursor : str = None) -> Tuple[str, List[Any], Union[int, None]]:
+    params = []
+    query = _bookingsSelect
     if visitorId is not None:
         if len(params) <= 0:
             query += "where "
@@ -175,48 +476,218 @@ def get_bookings(visitorId : int = None, hotelId : int = None, fromdate : dateti
             query += " and "
         query += "bookings.checkin <= %s"
         params.append(untildate.strftime('%Y-%m-%d'))
+    # keyset pagination on the sort order, every page costs the same no matter how deep the client pages
+    limit = get_page_limit(limit, cursor)
+    after = decode_cursor("bookings", cursor, [cursor_date, cursor_date, int])
+    if after is not None:
+        if len(params) <= 0:
+            query += "where "
+        else:
+            query += " and "
+        query += "(bookings.checkin, bookings.checkout, bookings.bookingId) < (%s, %s, %s)"
+        params.extend(after)
     query += " order by bookings.checkin desc, bookings.checkout desc, bookings.bookingId desc"
+    if limit is not None:
+        query += " limit %s"
+        params.append(limit + 1)
+    return query, params, limit
+
+# the rows of _bookingsSelect
+_bookingListMapper = RowMapper("bookingId", "checkin", "checkout", "adults", "kids", "babies", "rooms", "price", "hotelId", "hotelname", "visitorId", "firstname", "lastname")
+
+def get_bookings(visitorId : int = None, hotelId : int = None, fromdate : datetime = None, untildate : datetime = None, limit : int = None, cursor : str = None) -> Union[Iterable[Dict[str, Union[int, str, float, bool]]], Dict[str, Any]]:
+    query, params, limit = _bookings_query(visitorId, hotelId, fromdate, untildate, limit, cursor)
     connection = get_postgres_connection()
-    cursor = connection.cursor(cursor_factory=RealDictCursor)
+    cursor = connection.cursor()
     cursor.execute(query, params)
-    bookings = []
-    for row in cursor.fetchall():
-        bookings.append({
-            "bookingId" : row['bookingid'],
-            "checkin" : row['checkin'].strftime('%Y-%m-%d'),
-            "checkout" : row['checkout'].strftime('%Y-%m-%d'),
-            "adults" : row['adults'],
-            "kids" : row['kids'],
-            "babies" : row['babies'],
-            "rooms" : row['rooms'],
-            "price" : row['price'],
-            "hotelId" : row['hotelid'],
-            "hotelname" : row['hotelname'],
-            "visitorId" : row['visitorid'],
-            "firstname" : row['firstname'],
-            "lastname" : row['lastname']
-        })
+    bookings = _bookingListMapper.fetchall(cursor)
     cursor.close()
     connection.close()
+    if limit is not None:
+        return build_page(bookings, limit, "bookings", ["checkin", "checkout", "bookingId"])
     return bookings
 
+def stream_bookings(visitorId : int = None, hotelId : int = None, fromdate : datetime = None, untildate : datetime = None) -> Iterator[Dict[str, Union[int, str, float, bool]]]:
+    query, params, limit = _bookings_query(visitorId, hotelId, fromdate, untildate)
+    return _stream_rows(query, params, _bookingListMapper)
+
+_lastChangesPrune = 0.0
+
+def get_booking_changes(since : str = None) -> Dict[str, Any]:
+    global _lastChangesPrune
+    # the token holds the low watermark of the previous call: all transactions below it had finished,
+    # so rows of transactions that commit out of order are never skipped, they just show up one call later
+    retention = get_int_configuration("BOOKING_CHANGES_RETENTION_SECONDS", 86400)
+    after = decode_cursor("bookingchanges", since, [int, float])
+    # without a token, or with one older than the change log, the client gets all bookings and has to replace its list
+    reset = after is None or after[1] < time.time() - retention
+    connection = get_postgres_connection()
+    cursor = connection.cursor()
+    cursor.execute("SELECT txid_snapshot_xmin(txid_current_snapshot())")
+    watermark = cursor.fetchone()[0]
+    changes = []
+    if not reset:
+        cursor.execute("SELECT bookingId, operation FROM booking_changes WHERE txId >= %s AND txId < %s ORDER BY changeId", (after[0], watermark))
+        operations = {}
+        for bookingId, operation in cursor.fetchall():
+            if operation == 'R':
+                # setupDb dropped or populated the tables
+                reset = True
+                break
+            # the first operation tells whether the client can know the booking already, the position is the last change
+            first = operations.pop(bookingId, operation)
+            operations[bookingId] = first
+    if reset:
+        cursor.execute(_bookingsSelect + " order by bookings.checkin desc, bookings.checkout desc, bookings.bookingId desc")
+        changes = [{ "operation" : "insert", "bookingId" : booking["bookingId"], "booking" : booking } for booking in _bookingListMapper.fetchall(cursor)]
+    elif len(operations) > 0:
+        cursor.execute(_bookingsSelect + " where bookings.bookingId = ANY(%s)", (list(operations),))
+        bookings = { booking["bookingId"] : booking for booking in _bookingListMapper.fetchall(cursor) }
+        for bookingId, first in operations.items():
+            if bookingId not in bookings:
+                if first == 'I':
+                    # created and deleted again since the last call, the client never saw it
+                    continue
+                changes.append({ "operation" : "delete", "bookingId" : bookingId, "booking" : None })
+            else:
+                changes.append({ "operation" : "insert" if first == 'I' else "update", "bookingId" : bookingId, "booking" : bookings[bookingId] })
+    cursor.close()
+    if time.monotonic() - _lastChangesPrune > 60:
+        # every worker prunes the change log at most once a minute
+        _lastChangesPrune = time.monotonic()
+        cursor = connection.cursor()
+        cursor.execute("DELETE FROM booking_changes WHERE changedAt < now() - %s * interval '1 second'", (retention,))
+        cursor.close()
+        connection.commit()
+    connection.close()
+    return { "reset" : reset, "changes" : changes, "next" : encode_cursor("bookingchanges", [watermark, time.time()]) }
+
+def _listen_postgres_booking_changes(notify : Callable[[], None], running : Callable[[], bool]):
+    # a dedicated connection outside of the pool, LISTEN needs it for the whole lifetime of the hub
+    connection = create_postgres_connection()
+    try:
+        connection.autocommit = True
+        cursor = connection.cursor()
+        cursor.execute("LISTEN booking_changes")
+        cursor.close()
+        # changes committed before the LISTEN
+        notify()
+        while running():
+            if select.select([connection], [], [], 5.0) == ([], [], []):
+                continue
+            connection.poll()
+            if len(connection.notifies) > 0:
+                connection.notifies.clear()
+                notify()
+    finally:
+        connection.close()
+
+_changeHub = None
+
+def get_postgres_change_hub() -> ChangeHub:
+    global _changeHub
+    if _changeHub is None:
+        with _poolLock:
+            if _changeHub is None:
+                _changeHub = create_configured_change_hub(get_booking_changes, _listen_postgres_booking_changes)
+    return _changeHub
+
+def get_booking_change_hub() -> ChangeHub:
+    return get_postgres_change_hub()
+
+
+def _plan_postgres_booking_import(connection : psycopg2.extensions.connection, records : List[Dict[str, Any]]) -> Tuple[List[Union[str, None]], List[Tuple[int, List[Any]]]]:
+    # everything create_booking checks per booking, loaded with one query per table for the whole batch
+    stays = booking_import_stays(records)
+    cursor = connection.cursor()
+    cursor.execute("SELECT hotelId, pricePerNight, totalRooms FROM hotels WHERE hotelId = ANY(%s)", (list(set(r["hotelId"] for r in records)),))
+    hotels = { row[0] : (row[1], row[2]) for row in cursor.fetchall() }
+    cursor.execute("SELECT visitorId FROM visitors WHERE visitorId = ANY(%s)", (list(set(r["visitorId"] for r in records)),))
+    visitorIds = set(row[0] for row in cursor.fetchall())
+    cursor.execute("SELECT bookingId FROM bookings WHERE bookingId = ANY(%s)", (list(set(r["bookingId"] for r in records if r["bookingId"] is not None)),))
+    bookingIds = set(row[0] for row in cursor.fetchall())
+    stayColumns = ([s[0] for s in stays], [s[1] for s in stays], [s[2] for s in stays], [s[3] for s in stays])
+    cursor.execute("""
+        SELECT b.hotelId, b.visitorId, b.checkin, b.checkout
+        FROM unnest(%s::int[], %s::int[], %s::date[], %s::date[]) AS s(hotelId, visitorId, checkin, checkout)
+        JOIN bookings AS b ON b.hotelId = s.hotelId AND b.visitorId = s.visitorId AND b.checkin = s.checkin AND b.checkout = s.checkout
+    """, stayColumns)
+    existingStays = set(tuple(row) for row in cursor.fetchall())
+    cursor.execute("""
+        SELECT DISTINCT u.hotelId, u.usageDate, u.usedRooms
+        FROM unnest(%s::int[], %s::date[], %s::date[]) AS s(hotelId, checkin, checkout)
+        JOIN hotel_day_usage AS u ON u.hotelId = s.hotelId AND u.usageDate >= s.checkin AND u.usageDate < s.checkout
+    """, (stayColumns[0], stayColumns[2], stayColumns[3]))
+    usedRooms = { (row[0], row[1]) : row[2] for row in cursor.fetchall() }
+    cursor.close()
+    return plan_booking_import(records, hotels, visitorIds, bookingIds, existingStays, usedRooms)
+
+def import_bookings(records : List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    # imports a batch of bookings (the keys of the records are the parameter names of create_booking) in one transaction
+    # and returns { "bookingId" } or { "error" } per record, the valid records are inserted with COPY
+    results = [None] * len(records)
+    connection = get_postgres_connection()
+    try:
+        get_postgres_id_allocator().ensure_synchronized("bookings_bookingid_seq")
+        errors, rows = _plan_postgres_booking_import(connection, records)
+        missingIds = sum(1 for index, row in rows if row[0] is None)
+        if missingIds > 0:
+            missingIds = iter(_reserve_postgres_ids(connection, "bookings_bookingid_seq", missingIds))
+            for index, row in rows:
+                if row[0] is None:
+                    row[0] = next(missingIds)
+        try:
+            bulk_insert(connection, "bookings", BOOKING_IMPORT_COLUMNS, [row for index, row in rows])
+            connection.commit()
+            for index, row in rows:
+                results[index] = { "bookingId" : row[0] }
+        except psycopg2.IntegrityError:
+            # a concurrent write changed the data after the batch was checked (a booking took the rooms, a hotel or visitor
+            # was deleted, a booking id was taken), the records are booked one by one instead and the failing ones are rejected
+            connection.rollback()
+            for index, row in rows:
+                try:
+                    # with the planned id, so a record gets the same id on both paths
+                    results[index] = { "bookingId" : _create_booking(connection, WriteEffects(), newBookingId=row[0], **records[index])["bookingId"] }
+                    connection.commit()
+                except Exception as e:
+                    connection.rollback()
+                    errors[index] = str(e)
+        for index, error in enumerate(errors):
+            if error is not None:
+                results[index] = { "error" : error }
+        imported = any("bookingId" in result for result in results)
+        if imported:
+            get_postgres_data_versions().bump(connection, ["bookings"])
+            if any(record["bookingId"] is not None for record in records):
+                # imported ids can be ahead of the sequence
+                _synchronize_postgres_sequence("bookings_bookingid_seq")
+    finally:
+        connection.close()
+    if imported:
+        occupancyEngine = get_postgres_occupancy_engine()
+        for index, row in rows:
+            if "bookingId" in results[index]:
+                occupancyEngine.add_booking(row[0], row[1], records[index]["checkin"], records[index]["checkout"], row[8])
+    return results
 
 def create_visitor(firstname : str, lastname : str, visitorId : int = None) -> Dict[str, Union[int, str, float, bool]]:
     return manage_visitor(firstname, lastname, visitorId, SQLMode.INSERT)
 def update_visitor(firstname : str, lastname : str, visitorId : int) -> Dict[str, Union[int, str, float, bool]]:
     return manage_visitor(firstname, lastname, visitorId, SQLMode.UPDATE)
 def manage_visitor(firstname : str, lastname : str, visitorId : int = None, sqlmode : SQLMode = 1) -> Dict[str, Union[int, str, float, bool]]:
-    connection = get_postgres_connection()
+    return _run_write(lambda connection, effects: _manage_visitor(connection, effects, firstname, lastname, visitorId, sqlmode))
+
+def _manage_visitor(connection : psycopg2.extensions.connection, effects : WriteEffects, firstname : str, lastname : str, visitorId : int = None, sqlmode : SQLMode = 1) -> Dict[str, Union[int, str, float, bool]]:
     cursor = connection.cursor()
     if visitorId is None:
         if sqlmode == SQLMode.UPDATE:
             raise ValueError("visitorId is required for update")
-        cursor.execute("SELECT count(*) as num, (select max(v.visitorId) from visitors as v) as currentMaxId FROM visitors WHERE firstname = %s and lastname = %s", (firstname, lastname))
+        cursor.execute("SELECT count(*) as num FROM visitors WHERE firstname = %s and lastname = %s", (firstname, lastname))
     else:
-        cursor.execute("SELECT count(*) as num, (select max(v.visitorId) from visitors as v) as currentMaxId FROM visitors WHERE visitorId = %s or (firstname = %s and lastname = %s)", (visitorId, firstname, lastname))
+        cursor.execute("SELECT count(*) as num FROM visitors WHERE visitorId = %s or (firstname = %s and lastname = %s)", (visitorId, firstname, lastname))
     row = cursor.fetchone()
     alreadyExists = row[0] > 0
-    nextId = row[1] + 1
     cursor.close()
     
     if alreadyExists:
@@ -229,73 +700,93 @@ def manage_visitor(firstname : str, lastname : str, visitorId : int = None, sqlm
         if sqlmode == SQLMode.UPDATE:
             raise RuntimeError("Visitor does not exist")
 
-    if nextId <= 0:
-        nextId = 1
-    
     cursor = connection.cursor()
     if sqlmode == SQLMode.UPDATE:
         nextId = visitorId
         cursor.execute("UPDATE visitors SET firstname = %s, lastname = %s WHERE visitorId = %s", (firstname, lastname, visitorId))
     elif sqlmode == SQLMode.INSERT:
-        cursor.execute("INSERT INTO visitors (visitorId, firstname, lastname) VALUES (%s, %s, %s)", (nextId, firstname, lastname))
+        nextId = get_postgres_id_allocator().next_id(connection, "visitors_visitorid_seq")
+        cursor.execute("INSERT INTO visitors (visitorId, firstname, lastname) VALUES (COALESCE(%s, nextval('visitors_visitorid_seq')), %s, %s) RETURNING visitorId", (nextId, firstname, lastname))
+        nextId = cursor.fetchone()[0]
     else:
         raise ValueError("Invalid SQL mode")
     cursor.close()
-    connection.commit()
-    connection.close()
+    effects.touch("visitors")
     return { "visitorId" : nextId, "firstname" : firstname, "lastname" : lastname }
 
 
 def delete_visitor(visitorId : int) -> bool:
-    connection = get_postgres_connection()
+    return _run_write(lambda connection, effects: _delete_visitor(connection, effects, visitorId))
+
+def _delete_visitor(connection : psycopg2.extensions.connection, effects : WriteEffects, visitorId : int) -> bool:
     requiresDeletion = tablePrimaryKeyExists(connection, "visitors", visitorId)
     if requiresDeletion:
         cursor = connection.cursor()
         cursor.execute("DELETE FROM visitors WHERE visitorId = %s", (visitorId,))
         cursor.close()
-        connection.commit()
-    connection.close()
+        # the bookings of the visitor were removed by the cascade, the occupancy reads them from the change log
+        effects.touch("visitors", "bookings")
     return requiresDeletion
 
+_visitorMapper = RowMapper("visitorId", "firstname", "lastname")
+
 def get_visitor(visitorId : int) -> Dict[str, Union[int, str, float, bool]]:
     connection = get_postgres_connection()
-    cursor = connection.cursor(cursor_factory=RealDictCursor)
-    cursor.execute("SELECT visitorId, firstname, lastname FROM visitors WHERE visitorId = %s", (visitorId,))
-    row = cursor.fetchone()
-    if row is None:
-        return {}
-    visitor = {
-        "visitorId" : row['visitorid'],
-        "firstname" : row['firstname'],
-        "lastname" : row['lastname']
-    }
+    cursor = connection.cursor()
+    cursor.execute("SELECT " + _visitorMapper.columns + " FROM visitors WHERE visitorId = %s", (visitorId,))
+    visitor = _visitorMapper.fetchone(cursor)
     cursor.close()
     connection.close()
+    if visitor is None:
+        return {}
     return visitor
 
-def get_visitors(name : str = "", exactMatch : bool = False) -> Iterable[Dict[str, Union[int, str, float, bool]]]:
-    connection = get_postgres_connection()
-    cursor = connection.cursor(cursor_factory=RealDictCursor)
+def _visitors_query(name : str = "", exactMatch : bool = False, limit : int = None, cursor : str = None) -> Tuple[str, List[Any], Union[int, None]]:
     name = str(name).strip()
+    limit = get_page_limit(limit, cursor)
+    after = decode_cursor("visitors", cursor, [int])
+    query = "SELECT " + _visitorMapper.columns + " FROM visitors"
+    conditions = []
+    params = []
     if name != "":
         if exactMatch:
-            cursor.execute("SELECT visitorId, firstname, lastname FROM visitors WHERE firstname = %s or lastname = %s order by visitorId desc", (name, name))
+            conditions.append("(firstname = %s or lastname = %s)")
         else:
-            name = "%" + name + "%"
-            cursor.execute("SELECT visitorId, firstname, lastname FROM visitors WHERE firstname like %s or lastname like %s order by visitorId desc", (name, name))
-    else:
-        cursor.execute("SELECT visitorId, firstname, lastname FROM visitors order by visitorId desc")
-    visitors = []
-    for row in cursor.fetchall():
-        visitors.append({
-            "visitorId" : row['visitorid'],
-            "firstname" : row['firstname'],
-            "lastname" : row['lastname']
-        })
+            # case insensitive substring search, served by the pg_trgm indexes when the extension is available
+            name = "%" + escape_like(name) + "%"
+            conditions.append("(firstname ilike %s or lastname ilike %s)")
+        params.extend([name, name])
+    if after is not None:
+        conditions.append("visitorId < %s")
+        params.append(after[0])
+    if len(conditions) > 0:
+        query += " WHERE " + " and ".join(conditions)
+    query += " order by visitorId desc"
+    if limit is not None:
+        query += " limit %s"
+        params.append(limit + 1)
+    elif name != "" and not exactMatch:
+        # substring searches (autocomplete) are capped
+        query += " limit %s"
+        params.append(get_int_configuration("SEARCH_RESULT_LIMIT", 100))
+    return query, params, limit
+
+def get_visitors(name : str = "", exactMatch : bool = False, limit : int = None, cursor : str = None) -> Union[Iterable[Dict[str, Union[int, str, float, bool]]], Dict[str, Any]]:
+    query, params, limit = _visitors_query(name, exactMatch, limit, cursor)
+    connection = get_postgres_connection()
+    cursor = connection.cursor()
+    cursor.execute(query, params)
+    visitors = _visitorMapper.fetchall(cursor)
     cursor.close()
     connection.close()
+    if limit is not None:
+        return build_page(visitors, limit, "visitors", ["visitorId"])
     return visitors
 
+def stream_visitors(name : str = "", exactMatch : bool = False) -> Iterator[Dict[str, Union[int, str, float, bool]]]:
+    query, params, limit = _visitors_query(name, exactMatch)
+    return _stream_rows(query, params, _visitorMapper)
+
 
 def create_hotel(
     hotelname : str,
@@ -420,17 +911,69 @@ def manage_hotel(
     bathroomEssentials : bool = None,
     sqlmode : SQLMode = 1
 ) -> Dict[str, Union[int, str, float, bool]]:
-    connection = get_postgres_connection()
+    return _run_write(lambda connection, effects: _manage_hotel(
+        connection,
+        effects,
+        hotelname,
+        pricePerNight,
+        totalRooms,
+        hotelId,
+        country,
+        skiing,
+        suites,
+        inRoomEntertainment,
+        conciergeServices,
+        housekeeping,
+        petFriendlyOptions,
+        laundryServices,
+        roomService,
+        indoorPool,
+        outdoorPool,
+        fitnessCenter,
+        complimentaryBreakfast,
+        businessCenter,
+        freeGuestParking,
+        complimentaryCoffeaAndTea,
+        climateControl,
+        bathroomEssentials,
+        sqlmode
+    ))
+def _manage_hotel(
+    connection : psycopg2.extensions.connection,
+    effects : WriteEffects,
+    hotelname : str,
+    pricePerNight : float,
+    totalRooms : int,
+    hotelId : int = None,
+    country : str = None,
+    skiing : bool = None,
+    suites : bool = None,
+    inRoomEntertainment : bool = None,
+    conciergeServices : bool = None,
+    housekeeping : bool = None,
+    petFriendlyOptions : bool = None,
+    laundryServices : bool = None,
+    roomService : bool = None,
+    indoorPool : bool = None,
+    outdoorPool : bool = None,
+    fitnessCenter : bool = None,
+    complimentaryBreakfast : bool = None,
+    businessCenter : bool = None,
+    freeGuestParking : bool = None,
+    complimentaryCoffeaAndTea : bool = None,
+    climateControl : bool = None,
+    bathroomEssentials : bool = None,
+    sqlmode : SQLMode = 1
+) -> Dict[str, Union[int, str, float, bool]]:
     cursor = connection.cursor()
     if hotelId is None:
         if sqlmode == SQLMode.UPDATE:
             raise ValueError("hotelId is required for update")
-        cursor.execute("SELECT count(*) as num, (select max(h.hotelId) from hotels as h) as currentMaxId FROM hotels WHERE hotelname = %s", (hotelname,))
+        cursor.execute("SELECT count(*) as num FROM hotels WHERE hotelname = %s", (hotelname,))
     else:
-        cursor.execute("SELECT count(*) as num, (select max(h.hotelId) from hotels as h) as currentMaxId FROM hotels WHERE hotelId = %s or hotelname = %s", (hotelId, hotelname))    
+        cursor.execute("SELECT count(*) as num FROM hotels WHERE hotelId = %s or hotelname = %s", (hotelId, hotelname))
     row = cursor.fetchone()
     alreadyExists = row[0] > 0
-    nextId = row[1] + 1
     cursor.close()
     
     if alreadyExists:
@@ -443,14 +986,10 @@ def manage_hotel(
         if sqlmode == SQLMode.UPDATE:
             raise RuntimeError("Hotel does not exist")
 
-    if nextId <= 0:
-        nextId = 1
-    
     hotelname = str(hotelname).strip()
 
     if sqlmode == SQLMode.UPDATE:
         cursor = connection.cursor()
-        nextId = hotelId
         parts = [ hotelname, pricePerNight, totalRooms ]
         setPartStmt = ""
         if country is not None:
@@ -510,12 +1049,10 @@ def manage_hotel(
         parts.append(hotelId)
         cursor.execute("UPDATE hotels SET hotelname = %s, pricePerNight = %s, totalRooms = %s " + setPartStmt + " WHERE hotelId = %s", tuple(parts))
         cursor.close()
-        connection.commit()
-        connection.close()
-        hotelResult = get_hotel(hotelId)
+        hotelResult = _get_hotel(connection, hotelId)
     elif sqlmode == SQLMode.INSERT:
         cursor = connection.cursor()
-        hotelId = nextId
+        hotelId = get_postgres_id_allocator().next_id(connection, "hotels_hotelid_seq")
         if country is None:
             country = 'Unknown'
         country = str(country).strip()
@@ -537,12 +1074,11 @@ def manage_hotel(
         climateControl = get_bool_value(climateControl)
         bathroomEssentials = get_bool_value(bathroomEssentials)
         cursor.execute(
-            "INSERT INTO hotels (hotelId, hotelname, pricePerNight, totalRooms, country, skiing, suites, inRoomEntertainment, conciergeServices, housekeeping, petFriendlyOptions, laundryServices, roomService, indoorPool, outdoorPool, fitnessCenter, complimentaryBreakfast, businessCenter, freeGuestParking, complimentaryCoffeaAndTea, climateControl, bathroomEssentials) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
+            "INSERT INTO hotels (hotelId, hotelname, pricePerNight, totalRooms, country, skiing, suites, inRoomEntertainment, conciergeServices, housekeeping, petFriendlyOptions, laundryServices, roomService, indoorPool, outdoorPool, fitnessCenter, complimentaryBreakfast, businessCenter, freeGuestParking, complimentaryCoffeaAndTea, climateControl, bathroomEssentials) VALUES (COALESCE(%s, nextval('hotels_hotelid_seq')), %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) RETURNING hotelId",
             (hotelId, hotelname, pricePerNight, totalRooms, country, skiing, suites, inRoomEntertainment, conciergeServices, housekeeping, petFriendlyOptions, laundryServices, roomService, indoorPool, outdoorPool, fitnessCenter, complimentaryBreakfast, businessCenter, freeGuestParking, complimentaryCoffeaAndTea, climateControl, bathroomEssentials)
         )
+        hotelId = cursor.fetchone()[0]
         cursor.close()
-        connection.commit()
-        connection.close()
         hotelResult = {
             "hotelId" : hotelId,
             "hotelname" : hotelname,
@@ -568,84 +1104,359 @@ def manage_hotel(
             "bathroomEssentials" : bathroomEssentials
         }
     else:
-        connection.close()
         raise ValueError("Invalid SQL mode")
+    effects.touch("hotels")
+    # totalRooms might have changed
+    effects.after_commit(get_postgres_occupancy_engine().invalidate)
     return hotelResult
 
 
 def delete_hotel(hotelId : int) -> bool:
-    connection = get_postgres_connection()
+    return _run_write(lambda connection, effects: _delete_hotel(connection, effects, hotelId))
+
+def _delete_hotel(connection : psycopg2.extensions.connection, effects : WriteEffects, hotelId : int) -> bool:
     requiresDeletion = tablePrimaryKeyExists(connection, "hotels", hotelId)
     if requiresDeletion:
         cursor = connection.cursor()
         cursor.execute("DELETE FROM hotels WHERE hotelId = %s", (hotelId,))
         cursor.close()
-        connection.commit()
-    connection.close()
+        effects.touch("hotels", "bookings")
+        # the bookings of the hotel were removed by the cascade
+        effects.after_commit(get_postgres_occupancy_engine().invalidate)
     return requiresDeletion
 
 def get_hotel(hotelId : int) -> Dict[str, Union[int, str, float, bool]]:
     connection = get_postgres_connection()
-    cursor = connection.cursor(cursor_factory=RealDictCursor)
-    cursor.execute("SELECT * FROM hotels WHERE hotelId = %s", (hotelId,))
-    row = cursor.fetchone()
-    if row is None:
-        return {}
-    hotel = {
-        "hotelId" : row['hotelid'],
-        "hotelname" : row['hotelname'],
-        "pricePerNight" : row['pricepernight'],
-        "totalRooms" : row['totalrooms'],
-        "country" : row['country'],
-        "skiing" : get_bool_value(row['skiing']),
-        "suites" : get_bool_value(row['suites']),
-        "inRoomEntertainment" : get_bool_value(row['inroomentertainment']),
-        "conciergeServices" : get_bool_value(row['conciergeservices']),
-        "housekeeping" : get_bool_value(row['housekeeping']),
-        "petFriendlyOptions" : get_bool_value(row['petfriendlyoptions']),
-        "laundryServices" : get_bool_value(row['laundryservices']),
-        "roomService" : get_bool_value(row['roomservice']),
-        "indoorPool" : get_bool_value(row['indoorpool']),
-        "outdoorPool" : get_bool_value(row['outdoorpool']),
-        "fitnessCenter" : get_bool_value(row['fitnesscenter']),
-        "complimentaryBreakfast" : get_bool_value(row['complimentarybreakfast']),
-        "businessCenter" : get_bool_value(row['businesscenter']),
-        "freeGuestParking" : get_bool_value(row['freeguestparking']),
-        "complimentaryCoffeaAndTea" : get_bool_value(row['complimentarycoffeaandtea']),
-        "climateControl" : get_bool_value(row['climatecontrol']),
-        "bathroomEssentials" : get_bool_value(row['bathroomessentials'])
-    }
+    hotel = _get_hotel(connection, hotelId)
+    connection.close()
+    return hotel
+
+# the booleans come from NOT NULL columns, they need no conversion
+_hotelDetailsMapper = RowMapper("hotelId", "hotelname", "pricePerNight", "totalRooms", "country", *get_amenities().keys())
 
+def _get_hotel(connection : psycopg2.extensions.connection, hotelId : int) -> Dict[str, Union[int, str, float, bool]]:
+    cursor = connection.cursor()
+    cursor.execute("SELECT " + _hotelDetailsMapper.columns + " FROM hotels WHERE hotelId = %s", (hotelId,))
+    hotel = _hotelDetailsMapper.fetchone(cursor)
     cursor.close()
-    connection.close()
+    if hotel is None:
+        return {}
     return hotel
 
-def get_hotels(name : str = "", exactMatch : bool = False) -> Iterable[Dict[str, Union[int, str, float, bool]]]:
-    connection = get_postgres_connection()
-    cursor = connection.cursor(cursor_factory=RealDictCursor)
+_hotelMapper = RowMapper("hotelId", "hotelname", "pricePerNight", "totalRooms", "country")
+
+def _hotels_query(name : str = "", exactMatch : bool = False, limit : int = None, cursor : str = None) -> Tuple[str, List[Any], Union[int, None]]:
     name = str(name).strip()
+    limit = get_page_limit(limit, cursor)
+    after = decode_cursor("hotels", cursor, [int])
+    query = "SELECT " + _hotelMapper.columns + " FROM hotels"
+    conditions = []
+    params = []
     if name != "":
         if exactMatch:
-            cursor.execute("SELECT hotelId, hotelname, pricePerNight, totalRooms, country FROM hotels WHERE hotelname = %s order by hotelId desc", (name,))
+            conditions.append("hotelname = %s")
         else:
-            name = "%" + name + "%"
-            cursor.execute("SELECT hotelId, hotelname, pricePerNight, totalRooms, country FROM hotels WHERE hotelname like %s order by hotelId desc", (name,))
-    else:
-        cursor.execute("SELECT hotelId, hotelname, pricePerNight, totalRooms, country FROM hotels order by hotelId desc")
+            # case insensitive substring search, served by the pg_trgm index when the extension is available
+            name = "%" + escape_like(name) + "%"
+            conditions.append("hotelname ilike %s")
+        params.append(name)
+    if after is not None:
+        conditions.append("hotelId < %s")
+        params.append(after[0])
+    if len(conditions) > 0:
+        query += " WHERE " + " and ".join(conditions)
+    query += " order by hotelId desc"
+    if limit is not None:
+        query += " limit %s"
+        params.append(limit + 1)
+    elif name != "" and not exactMatch:
+        # substring searches (autocomplete) are capped
+        query += " limit %s"
+        params.append(get_int_configuration("SEARCH_RESULT_LIMIT", 100))
+    return query, params, limit
+
+def get_hotels(name : str = "", exactMatch : bool = False, limit : int = None, cursor : str = None) -> Union[Iterable[Dict[str, Union[int, str, float, bool]]], Dict[str, Any]]:
+    query, params, limit = _hotels_query(name, exactMatch, limit, cursor)
+    connection = get_postgres_connection()
+    cursor = connection.cursor()
+    cursor.execute(query, params)
+    hotels = _hotelMapper.fetchall(cursor)
+    cursor.close()
+    connection.close()
+    if limit is not None:
+        return build_page(hotels, limit, "hotels", ["hotelId"])
+    return hotels
+
+def stream_hotels(name : str = "", exactMatch : bool = False) -> Iterator[Dict[str, Union[int, str, float, bool]]]:
+    query, params, limit = _hotels_query(name, exactMatch)
+    return _stream_rows(query, params, _hotelMapper)
+
+def get_available_hotels(checkin : datetime, checkout : datetime, rooms : int = 1, amenities : Union[str, List[str]] = None) -> List[Dict[str, Union[int, str, float, bool]]]:
+    amenities = parse_amenities(amenities)
+    rooms = int(rooms)
+    # the room check runs against the in-memory occupancy, the database only filters by amenities
+    freeRooms = get_postgres_occupancy_engine().find_available_hotels(checkin, checkout, rooms)
+    if len(freeRooms) == 0:
+        return []
+    query = "SELECT " + _hotelMapper.columns + " FROM hotels"
+    if len(amenities) > 0:
+        # the names were validated against get_amenities, so they can be used as column names
+        query += " WHERE " + " and ".join(amenity + " = TRUE" for amenity in amenities)
+    query += " order by hotelId desc"
+    connection = get_postgres_connection()
+    cursor = connection.cursor()
+    cursor.execute(query)
+    nights = (checkout - checkin).days
     hotels = []
-    for row in cursor.fetchall():
-        hotels.append({
-            "hotelId" : row['hotelid'],
-            "hotelname" : row['hotelname'],
-            "pricePerNight" : row['pricepernight'],
-            "totalRooms" : row['totalrooms'],
-            "country" : row['country']
-        })
+    for hotel in _hotelMapper.fetchall(cursor):
+        if hotel["hotelId"] not in freeRooms:
+            continue
+        hotel["freeRooms"] = freeRooms[hotel["hotelId"]]
+        hotel["price"] = hotel["pricePerNight"] * nights * rooms
+        hotels.append(hotel)
     cursor.close()
     connection.close()
     return hotels
 
 
+class _CopyChunks(io.TextIOBase):
+    # the file COPY TO STDOUT writes into (as text, it is a TextIOBase), hands the data to the exporting generator in chunks
+    def __init__(self, put : Callable[[Any], bool], chunkSize : int):
+        self._put = put
+        self._chunkSize = chunkSize
+        self._parts = []
+        self._size = 0
+
+    def write(self, data : str) -> int:
+        self._parts.append(data)
+        self._size += len(data)
+        if self._size >= self._chunkSize:
+            self.send()
+        return len(data)
+
+    def send(self):
+        if self._size > 0:
+            if not self._put("".join(self._parts)):
+                # aborts the COPY
+                raise RuntimeError("Export cancelled")
+            self._parts = []
+            self._size = 0
+
+
+def export_table(tableName : str, format : str, visitorId : int = None, hotelId : int = None, fromdate : datetime = None, untildate : datetime = None, chunkSize : int = 65536) -> Iterator[str]:
+    # COPY TO STDOUT runs in a thread of its own and blocks while the client has not taken the previous chunks yet,
+    # so the export needs constant memory no matter how large the table is
+    query, params = export_query(tableName, "%s", visitorId, hotelId, fromdate, untildate)
+    columns = EXPORT_COLUMNS[tableName]
+    if format == "csv":
+        # booleans as true / false instead of t / f
+        query = "SELECT " + ", ".join(c + ("::text" if c in EXPORT_BOOLEAN_COLUMNS else "") + ' AS "' + c + '"' for c in columns) + query
+        options = "FORMAT csv, HEADER"
+    else:
+        # csv without any quoting passes the json through unchanged (json escapes all control characters)
+        query = "SELECT json_build_object(" + ", ".join("'" + c + "', " + c for c in columns) + ")::text" + query
+        options = "FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02'"
+    chunks = queue.Queue(maxsize=4)
+    cancelled = threading.Event()
+    def put(item : Any) -> bool:
+        # False when the generator is gone
+        while not cancelled.is_set():
+            try:
+                chunks.put(item, timeout=1.0)
+                return True
+            except queue.Full:
+                pass
+        return False
+    def copy():
+        connection = get_postgres_connection()
+        try:
+            cursor = connection.cursor()
+            statement = cursor.mogrify(query, params).decode("utf-8")
+            writer = _CopyChunks(put, chunkSize)
+            cursor.copy_expert("COPY (" + statement + ") TO STDOUT WITH (" + options + ")", writer)
+            cursor.close()
+            writer.send()
+            put(None)
+        except Exception as e:
+            put(e)
+        finally:
+            connection.close()
+    threading.Thread(target=copy, name="export-" + tableName, daemon=True).start()
+    try:
+        while True:
+            item = chunks.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # the client went away (or the export is done), a waiting COPY gives up
+        cancelled.set()
+
+
+# indexes backing get_bookings (filters + sort order + keyset pagination) and GetRoomsUsageWithinTimeSpan (hotelId + date range)
+_bookingIndexes = {
+    "ix_bookings_order" : "CREATE INDEX ix_bookings_order ON bookings (checkin DESC, checkout DESC, bookingId DESC)",
+    "ix_bookings_visitor" : "CREATE INDEX ix_bookings_visitor ON bookings (visitorId, checkin DESC, checkout DESC, bookingId DESC)",
+    "ix_bookings_hotel" : "CREATE INDEX ix_bookings_hotel ON bookings (hotelId, checkin DESC, checkout DESC, bookingId DESC) INCLUDE (rooms)"
+}
+
+# trigram indexes for the substring searches in get_visitors / get_hotels (require the pg_trgm extension)
+_searchIndexes = {
+    "ix_visitors_firstname_trgm" : ("visitors", "CREATE INDEX ix_visitors_firstname_trgm ON visitors USING gin (firstname gin_trgm_ops)"),
+    "ix_visitors_lastname_trgm" : ("visitors", "CREATE INDEX ix_visitors_lastname_trgm ON visitors USING gin (lastname gin_trgm_ops)"),
+    "ix_hotels_hotelname_trgm" : ("hotels", "CREATE INDEX ix_hotels_hotelname_trgm ON hotels USING gin (hotelname gin_trgm_ops)")
+}
+
+# used rooms per hotel and night (checkin..checkout-1), maintained by a trigger on bookings
+_dayUsageTrigger = "trg_bookings_day_usage"
+
+def rebuildDayUsage(connection):
+    # set based recomputation from all bookings, i.e. after a bulk load with the trigger disabled
+    cursor = connection.cursor()
+    cursor.execute("DELETE FROM hotel_day_usage")
+    cursor.execute("""
+        INSERT INTO hotel_day_usage (hotelId, usageDate, usedRooms)
+        SELECT b.hotelId, d.night::date, SUM(b.rooms)
+        FROM bookings AS b
+        CROSS JOIN LATERAL generate_series(b.checkin, b.checkout - 1, '1 day'::interval) AS d(night)
+        GROUP BY b.hotelId, d.night::date
+    """)
+    cursor.close()
+
+# name of the violated constraint when a booking does not fit into the remaining rooms of its hotel
+_capacityConstraint = "hotel_capacity"
+
+def createDayUsage(connection, responseDict : Dict[str, Any]):
+    cursor = connection.cursor()
+    # replaced on every schema creation, so existing deployments pick up the capacity check
+    # the nights are upserted in ascending order, so concurrent bookings of a hotel lock the rows in the same order and never deadlock,
+    # only bookings sharing a night wait for each other, the hotel row itself is not locked
+    cursor.execute("""
+        CREATE OR REPLACE FUNCTION bookings_day_usage() RETURNS trigger AS $$
+        DECLARE
+            maxUsedRooms INT;
+            hotelRooms INT;
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                UPDATE hotel_day_usage SET usedRooms = usedRooms - OLD.rooms
+                WHERE hotelId = OLD.hotelId AND usageDate >= OLD.checkin AND usageDate < OLD.checkout;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                WITH upserted AS (
+                    INSERT INTO hotel_day_usage (hotelId, usageDate, usedRooms)
+                    SELECT NEW.hotelId, d.night::date, NEW.rooms
+                    FROM generate_series(NEW.checkin, NEW.checkout - 1, '1 day'::interval) AS d(night)
+                    ORDER BY d.night
+                    ON CONFLICT (hotelId, usageDate) DO UPDATE SET usedRooms = hotel_day_usage.usedRooms + EXCLUDED.usedRooms
+                    RETURNING usedRooms
+                )
+                SELECT max(usedRooms) INTO maxUsedRooms FROM upserted;
+                SELECT totalRooms INTO hotelRooms FROM hotels WHERE hotelId = NEW.hotelId;
+                IF maxUsedRooms > hotelRooms THEN
+                    RAISE EXCEPTION 'Not enough rooms available' USING ERRCODE = 'check_violation', CONSTRAINT = '""" + _capacityConstraint + """';
+                END IF;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+    """)
+    if doesTableExist(connection, "hotel_day_usage"):
+        cursor.close()
+        return
+    responseDict["create_schema"]["hotel_day_usage"] = True
+    cursor.execute("""
+        CREATE TABLE hotel_day_usage (
+            hotelId INT NOT NULL,
+            usageDate DATE NOT NULL,
+            usedRooms INT NOT NULL,
+            PRIMARY KEY (hotelId, usageDate),
+            FOREIGN KEY (hotelId) REFERENCES hotels(hotelId) ON DELETE CASCADE
+        )
+    """)
+    cursor.execute("CREATE TRIGGER " + _dayUsageTrigger + " AFTER INSERT OR UPDATE OR DELETE ON bookings FOR EACH ROW EXECUTE PROCEDURE bookings_day_usage()")
+    # older deployments computed GetRoomsUsageWithinTimeSpan from the bookings, it is recreated on top of the new table
+    cursor.execute("DROP FUNCTION IF EXISTS GetRoomsUsageWithinTimeSpan")
+    cursor.close()
+    # bookings that existed before the table
+    rebuildDayUsage(connection)
+
+def createBookingChanges(connection, responseDict : Dict[str, Any]):
+    # change log behind /api/bookings/changes, txId orders the rows by the transaction that wrote them
+    cursor = connection.cursor()
+    if not doesTableExist(connection, "booking_changes"):
+        responseDict["create_schema"]["booking_changes"] = True
+        cursor.execute("""
+            CREATE TABLE booking_changes (
+                changeId BIGSERIAL PRIMARY KEY,
+                txId BIGINT NOT NULL DEFAULT txid_current(),
+                bookingId INT NULL,
+                operation CHAR(1) NOT NULL,
+                changedAt TIMESTAMP NOT NULL DEFAULT now()
+            )
+        """)
+        cursor.execute("CREATE INDEX ix_booking_changes_txid ON booking_changes (txId)")
+        cursor.execute("CREATE INDEX ix_booking_changes_changedat ON booking_changes (changedAt)")
+        cursor.execute("""
+            CREATE OR REPLACE FUNCTION bookings_changes() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP = 'DELETE' THEN
+                    INSERT INTO booking_changes (bookingId, operation) VALUES (OLD.bookingId, 'D');
+                ELSE
+                    INSERT INTO booking_changes (bookingId, operation) VALUES (NEW.bookingId, LEFT(TG_OP, 1));
+                END IF;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+        """)
+        cursor.execute("CREATE TRIGGER trg_bookings_changes AFTER INSERT OR UPDATE OR DELETE ON bookings FOR EACH ROW EXECUTE PROCEDURE bookings_changes()")
+        # the bookings contain the names of the hotel and the visitor
+        cursor.execute("""
+            CREATE OR REPLACE FUNCTION hotels_booking_changes() RETURNS trigger AS $$
+            BEGIN
+                INSERT INTO booking_changes (bookingId, operation) SELECT bookingId, 'U' FROM bookings WHERE hotelId = NEW.hotelId;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+        """)
+        cursor.execute("CREATE TRIGGER trg_hotels_booking_changes AFTER UPDATE ON hotels FOR EACH ROW WHEN (OLD.hotelname IS DISTINCT FROM NEW.hotelname) EXECUTE PROCEDURE hotels_booking_changes()")
+        cursor.execute("""
+            CREATE OR REPLACE FUNCTION visitors_booking_changes() RETURNS trigger AS $$
+            BEGIN
+                INSERT INTO booking_changes (bookingId, operation) SELECT bookingId, 'U' FROM bookings WHERE visitorId = NEW.visitorId;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+        """)
+        cursor.execute("CREATE TRIGGER trg_visitors_booking_changes AFTER UPDATE ON visitors FOR EACH ROW WHEN (OLD.firstname IS DISTINCT FROM NEW.firstname OR OLD.lastname IS DISTINCT FROM NEW.lastname) EXECUTE PROCEDURE visitors_booking_changes()")
+    # wakes up the /api/bookings/stream listeners of all workers, a transaction sends a single notification at its commit
+    cursor.execute("""
+        CREATE OR REPLACE FUNCTION booking_changes_notify() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('booking_changes', '');
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+    """)
+    cursor.execute("DROP TRIGGER IF EXISTS trg_booking_changes_notify ON booking_changes")
+    cursor.execute("CREATE TRIGGER trg_booking_changes_notify AFTER INSERT ON booking_changes FOR EACH STATEMENT EXECUTE PROCEDURE booking_changes_notify()")
+    cursor.close()
+
+def enableTrigramExtension(connection) -> bool:
+    # creating an extension requires elevated permissions, without it substring search just falls back to a scan
+    cursor = connection.cursor()
+    cursor.execute("SAVEPOINT enable_pg_trgm")
+    try:
+        cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        cursor.execute("RELEASE SAVEPOINT enable_pg_trgm")
+    except psycopg2.Error:
+        cursor.execute("ROLLBACK TO SAVEPOINT enable_pg_trgm")
+    cursor.execute("SELECT count(*) as num FROM pg_extension WHERE extname = 'pg_trgm'")
+    enabled = cursor.fetchone()[0] > 0
+    cursor.close()
+    return enabled
+
 def tablePrimaryKeyExists(connection, tableName : str, primaryKey : str) -> bool:
     if tableName == "hotels":
         query = "SELECT count(*) as num from hotels where hotelId = %s"
@@ -685,6 +1496,13 @@ def doesFunctionExist(connection, functionName : str) -> bool:
     cursor.close()
     return exists
 
+def doesIndexExist(connection, tableName : str, indexName : str) -> bool:
+    cursor = connection.cursor()
+    cursor.execute("SELECT count(*) as num FROM pg_indexes WHERE tablename = %s and indexname = %s", (str(tableName).strip().lower(), str(indexName).strip().lower()))
+    exists = cursor.fetchone()[0] > 0
+    cursor.close()
+    return exists
+
 def allTablesExists() -> bool:
     try:
         connection = get_postgres_connection()
@@ -697,14 +1515,14 @@ def allTablesExists() -> bool:
     except Exception as e:
         return False
 
-def setupDb(drop_schema : bool, create_schema : bool, populate_data : bool, number_of_visitors : int, min_bookings_per_visitor : int, max_bookings_per_visitor : int):
+def setupDb(drop_schema : bool, create_schema : bool, populate_data : bool, number_of_visitors : int, min_bookings_per_visitor : int, max_bookings_per_visitor : int, seed : Union[int, None] = None, target_occupancy : Union[float, None] = None):
     number_of_visitors = int(number_of_visitors)
     min_bookings_per_visitor = int(min_bookings_per_visitor)
     max_bookings_per_visitor = int(max_bookings_per_visitor)
     if number_of_visitors < 2:
         number_of_visitors = 2
-    if number_of_visitors > 10000:
-        number_of_visitors = 10000
+    if number_of_visitors > 1000000:
+        number_of_visitors = 1000000
     if min_bookings_per_visitor < 0:
         min_bookings_per_visitor = 0
     if min_bookings_per_visitor > 10:
@@ -715,25 +1533,36 @@ def setupDb(drop_schema : bool, create_schema : bool, populate_data : bool, numb
         max_bookings_per_visitor = 1
     if max_bookings_per_visitor > 20:
         max_bookings_per_visitor = 20
+    # bookings are rejected once a night of a hotel is full, so the generated data has to respect the rooms as well
+    if target_occupancy is None:
+        target_occupancy = 1.0
+    target_occupancy = min(1.0, max(0.01, float(target_occupancy)))
     if drop_schema and not create_schema:
         raise Exception("Cannot drop schema without creating schema")
     responseDict = {
         "success" : True,
         "drop_schema" : False,
-        "create_schema" : { "hotels" : False, "visitors" : False, "bookings" : False, "GetRoomsUsageWithinTimeSpan" : False },
+        "create_schema" : { "hotels" : False, "visitors" : False, "bookings" : False, "hotel_day_usage" : False, "booking_changes" : False, "GetRoomsUsageWithinTimeSpan" : False },
+        "create_indexes" : { indexName : False for indexName in list(_bookingIndexes) + list(_searchIndexes) },
         "populate_data" : { "hotels" : False, "visitors" : False, "bookings" : False },
         "number_of_visitors" : number_of_visitors,
         "min_bookings_per_visitor" : min_bookings_per_visitor,
-        "max_bookings_per_visitor" : max_bookings_per_visitor
+        "max_bookings_per_visitor" : max_bookings_per_visitor,
+        "seed" : seed,
+        "target_occupancy" : target_occupancy
     }
     connection = get_postgres_connection()
     if drop_schema:
         responseDict["drop_schema"] = True
         cursor = connection.cursor()
-        cursor.execute("DROP TABLE IF EXISTS bookings, hotels, visitors")
+        cursor.execute("DROP TABLE IF EXISTS booking_changes, hotel_day_usage, bookings, hotels, visitors")
         cursor.execute("DROP FUNCTION IF EXISTS GetRoomsUsageWithinTimeSpan")
+        cursor.execute("DROP FUNCTION IF EXISTS bookings_day_usage")
+        cursor.execute("DROP FUNCTION IF EXISTS bookings_changes, hotels_booking_changes, visitors_booking_changes, booking_changes_notify")
         cursor.close()
         connection.commit()
+        # the sequences were dropped together with the tables
+        get_postgres_id_allocator().invalidate()
     if create_schema:     
         if not doesTableExist(connection, "hotels"):
             responseDict["create_schema"]["hotels"] = True
@@ -806,6 +1635,12 @@ def setupDb(drop_schema : bool, create_schema : bool, populate_data : bool, numb
                 )
             """)
             cursor.close()
+        createDayUsage(connection, responseDict)
+        createBookingChanges(connection, responseDict)
+        cursor = connection.cursor()
+        for sequenceName in _dataVersionSequences.values():
+            cursor.execute("CREATE SEQUENCE IF NOT EXISTS " + sequenceName)
+        cursor.close()
         if not doesFunctionExist(connection, "GetRoomsUsageWithinTimeSpan"):
             responseDict["create_schema"]["GetRoomsUsageWithinTimeSpan"] = True
             cursor = connection.cursor()
@@ -826,21 +1661,40 @@ def setupDb(drop_schema : bool, create_schema : bool, populate_data : bool, numb
                         h.hotelname,
                         h.country,
                         d.Date::date,
-                        COALESCE(SUM(b.rooms), 0)::int AS usedRooms,
-                        (h.totalRooms - COALESCE(SUM(b.rooms), 0))::int AS freeRooms
+                        COALESCE(u.usedRooms, 0)::int AS usedRooms,
+                        (h.totalRooms - COALESCE(u.usedRooms, 0))::int AS freeRooms
                     FROM 
                         hotels h
                     CROSS JOIN 
                         generate_series(StartDate, EndDate, '1 day'::interval) AS d(Date)
                     LEFT JOIN 
-                        bookings b ON h.hotelId = b.hotelId AND d.Date::date BETWEEN b.checkin AND b.checkout
-                    GROUP BY 
-                        h.hotelId, h.hotelname, h.country, d.Date::date, h.totalRooms;
+                        hotel_day_usage u ON u.hotelId = h.hotelId AND u.usageDate = d.Date::date;
                 END;
                 $$ LANGUAGE plpgsql;
             """)
             cursor.close()
+        for indexName, createStmt in _bookingIndexes.items():
+            if not doesIndexExist(connection, "bookings", indexName):
+                responseDict["create_indexes"][indexName] = True
+                cursor = connection.cursor()
+                cursor.execute(createStmt)
+                cursor.close()
+        searchIndexes = {}
+        if enableTrigramExtension(connection):
+            searchIndexes = _searchIndexes
+        for indexName, (tableName, createStmt) in searchIndexes.items():
+            if not doesIndexExist(connection, tableName, indexName):
+                responseDict["create_indexes"][indexName] = True
+                cursor = connection.cursor()
+                cursor.execute(createStmt)
+                cursor.close()
         connection.commit()
+        for indexName in _bookingIndexes:
+            if not doesIndexExist(connection, "bookings", indexName):
+                raise RuntimeError("Index " + indexName + " could not be created")
+        for indexName, (tableName, createStmt) in searchIndexes.items():
+            if not doesIndexExist(connection, tableName, indexName):
+                raise RuntimeError("Index " + indexName + " could not be created")
     if populate_data:
         if not doesTableHaveRows(connection, "hotels"):
             responseDict["populate_data"]["hotels"] = True
@@ -889,31 +1743,58 @@ def setupDb(drop_schema : bool, create_schema : bool, populate_data : bool, numb
             cursor.close()
         if not doesTableHaveRows(connection, "visitors"):
             responseDict["populate_data"]["visitors"] = True
-            cursor = connection.cursor()
-            from .datagenerators import generateVisitorData
-            nextId = 1
-            for visitor in generateVisitorData(number_of_visitors):
-                cursor.execute("INSERT INTO visitors (visitorId, firstname, lastname) VALUES (%s, %s, %s)", (nextId, visitor["firstname"], visitor["lastname"]))
-                nextId += 1
-            cursor.close()
+            from .datagenerators import generateVisitorChunks, visitorColumns
+            bulk_insert_chunks(connection, "visitors", visitorColumns, generateVisitorChunks(number_of_visitors, seed, get_int_configuration("DB_BULK_CHUNK_SIZE", 10000)))
         if not doesTableHaveRows(connection, "bookings"):
             responseDict["populate_data"]["bookings"] = True
             cursor = connection.cursor()
             # getting required data
             startDate = datetime.now() + timedelta(days=4)
-            cursor.execute("SELECT hotelId FROM hotels where hotelId <= 1000")
-            hotelIds = [h[0] for h in cursor.fetchall()]
-            cursor.execute("SELECT visitorId FROM visitors where visitorId <= 10000")
+            cursor.execute("SELECT hotelId, totalRooms FROM hotels where hotelId <= 1000")
+            hotels = cursor.fetchall()
+            hotelIds = [h[0] for h in hotels]
+            hotelCapacities = [h[1] for h in hotels]
+            cursor.execute("SELECT visitorId FROM visitors")
             visitorIds = [v[0] for v in cursor.fetchall()]
-            # generating bookings
-            from .datagenerators import generateBookings
-            bookingId = 1
-            for visitorId in visitorIds:
-                for booking in generateBookings(visitorId, hotelIds, min_bookings_per_visitor, max_bookings_per_visitor):
-                    cursor.execute("INSERT INTO bookings (bookingId, hotelId, visitorId, checkin, checkout, adults, kids, babies, rooms, price) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)", (bookingId, booking["hotelid"], booking["visitorid"], booking["checkin"], booking["checkout"], booking["adults"], booking["kids"], booking["babies"], booking["rooms"], booking["price"]))
-                    bookingId += 1
             cursor.close()
+            # generating bookings, the day usage and change log triggers would fire per row,
+            # the day usage is rebuilt set based after the load instead and the change log gets a single reset marker
+            from .datagenerators import generateBookingChunks, bookingColumns
+            dayUsage = doesTableExist(connection, "hotel_day_usage")
+            cursor = connection.cursor()
+            cursor.execute("ALTER TABLE bookings DISABLE TRIGGER USER")
+            cursor.close()
+            bulk_insert_chunks(
+                connection,
+                "bookings",
+                bookingColumns,
+                generateBookingChunks(
+                    visitorIds, hotelIds, min_bookings_per_visitor, max_bookings_per_visitor, startDate, seed,
+                    chunkSize=get_int_configuration("DB_BULK_CHUNK_SIZE", 10000),
+                    hotelCapacities=hotelCapacities,
+                    targetOccupancy=target_occupancy
+                )
+            )
+            cursor = connection.cursor()
+            cursor.execute("ALTER TABLE bookings ENABLE TRIGGER USER")
+            cursor.close()
+            if dayUsage:
+                rebuildDayUsage(connection)
         connection.commit()
+        # the data was inserted with explicit ids, move the sequences past them
+        idAllocator = get_postgres_id_allocator()
+        idAllocator.invalidate()
+        for sequenceName in _sequenceColumns:
+            idAllocator.ensure_synchronized(sequenceName)
+    if drop_schema or populate_data:
+        if doesTableExist(connection, "booking_changes"):
+            # clients of /api/bookings/changes have to reload all bookings
+            cursor = connection.cursor()
+            cursor.execute("INSERT INTO booking_changes (bookingId, operation) VALUES (NULL, 'R')")
+            cursor.close()
+            connection.commit()
+        get_postgres_data_versions().bump(connection, DATA_VERSION_TABLES)
     connection.close()
+    get_postgres_occupancy_engine().invalidate()
     return responseDict
 
@@ -0,0 +1,59 @@
+from operator import itemgetter
+from typing import Any, Callable, Dict, List, Sequence, Tuple, Union
+
+
+class RowMapper:
+    # turns the tuples of a plain cursor into the dicts of the api: which column index goes to which key (and through which
+    # converter) is worked out once per query from cursor.description, so a row costs a single dict and no lookups by name
+    def __init__(self, *fields : Union[str, Tuple[str, Callable[[Any], Any]]]):
+        # a field is the key (which is also the column name) or (key, converter)
+        self.keys = tuple(field if isinstance(field, str) else field[0] for field in fields)
+        self._converters = { field[0] : field[1] for field in fields if not isinstance(field, str) }
+        # the select list in the order of the keys, queries using it get the fastest mapping
+        self.columns = ", ".join(self.keys)
+        # column names of the query -> compiled mapping (both drivers report the names, psycopg2 in lower case)
+        self._compiled : Dict[Tuple[str, ...], Callable[[Sequence[Any]], Dict[str, Any]]] = {}
+
+    def compile(self, description : Sequence[Sequence[Any]]) -> Callable[[Sequence[Any]], Dict[str, Any]]:
+        names = tuple(column[0].lower() for column in description)
+        mapRow = self._compiled.get(names)
+        if mapRow is None:
+            mapRow = self._build(names)
+            self._compiled[names] = mapRow
+        return mapRow
+
+    def fetchall(self, cursor : Any) -> List[Dict[str, Any]]:
+        rows = cursor.fetchall()
+        mapRow = self.compile(cursor.description)
+        return [mapRow(row) for row in rows]
+
+    def fetchone(self, cursor : Any) -> Union[Dict[str, Any], None]:
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return self.compile(cursor.description)(row)
+
+    def _build(self, names : Tuple[str, ...]) -> Callable[[Sequence[Any]], Dict[str, Any]]:
+        keys = self.keys
+        indexes = []
+        for key in keys:
+            if key.lower() not in names:
+                raise ValueError("Column " + key + " is missing in the query")
+            indexes.append(names.index(key.lower()))
+        converters = [(position, self._converters[key]) for position, key in enumerate(keys) if key in self._converters]
+        if indexes == list(range(len(keys))) and len(converters) == 0:
+            # the query selects the keys in their order
+            return lambda row: dict(zip(keys, row))
+        if len(indexes) == 1:
+            index = indexes[0]
+            values = lambda row: (row[index],)
+        else:
+            values = itemgetter(*indexes)
+        if len(converters) == 0:
+            return lambda row: dict(zip(keys, values(row)))
+        def mapRow(row : Sequence[Any]) -> Dict[str, Any]:
+            converted = list(values(row))
+            for position, converter in converters:
+                converted[position] = converter(converted[position])
+            return dict(zip(keys, converted))
+        return mapRow
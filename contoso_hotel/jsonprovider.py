@@ -0,0 +1,88 @@
+import decimal
+from datetime import date
+from typing import Any
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider, JSONProvider
+
+from .config import get_configuration
+
+# the fast encoders are optional, without them the standard library encoder is used
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+
+JSON_PROVIDERS = ["auto", "orjson", "msgspec", "stdlib"]
+
+
+def _default(o : Any) -> Any:
+    # dates (and datetimes) are written as iso strings by every provider, i.e. 2024-07-05 for the checkin of a booking
+    if isinstance(o, date):
+        return o.isoformat()
+    if isinstance(o, decimal.Decimal):
+        return str(o)
+    return DefaultJSONProvider.default(o)
+
+
+class StdlibJSONProvider(DefaultJSONProvider):
+    default = staticmethod(_default)
+
+
+class OrjsonJSONProvider(JSONProvider):
+    # int keys are written as strings like the standard library does
+    _options = orjson.OPT_NON_STR_KEYS if orjson is not None else 0
+
+    def dumps(self, obj : Any, **kwargs : Any) -> str:
+        return orjson.dumps(obj, default=_default, option=self._options).decode("utf-8")
+
+    def loads(self, s : Any, **kwargs : Any) -> Any:
+        return orjson.loads(s)
+
+    def response(self, *args : Any, **kwargs : Any):
+        # the encoded bytes go into the response as they are
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=_default, option=self._options), mimetype="application/json")
+
+
+class MsgspecJSONProvider(JSONProvider):
+    def __init__(self, app : Flask):
+        super().__init__(app)
+        self._encoder = msgspec.json.Encoder(enc_hook=_default)
+        self._decoder = msgspec.json.Decoder()
+
+    def dumps(self, obj : Any, **kwargs : Any) -> str:
+        return self._encoder.encode(obj).decode("utf-8")
+
+    def loads(self, s : Any, **kwargs : Any) -> Any:
+        try:
+            return self._decoder.decode(s)
+        except msgspec.DecodeError as e:
+            # flask answers invalid request bodies with a 400 when loading raises a ValueError
+            raise ValueError(str(e)) from e
+
+    def response(self, *args : Any, **kwargs : Any):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self._encoder.encode(obj), mimetype="application/json")
+
+
+def create_json_provider(app : Flask) -> JSONProvider:
+    # JSON_PROVIDER selects the encoder of all api responses, auto uses the fastest one that is installed
+    name = get_configuration("JSON_PROVIDER").strip().lower()
+    if name == "":
+        name = "auto"
+    if name not in JSON_PROVIDERS:
+        raise ValueError("JSON_PROVIDER must be one of " + ", ".join(JSON_PROVIDERS))
+    if name == "orjson" and orjson is None:
+        raise RuntimeError("JSON_PROVIDER is orjson, but orjson is not installed")
+    if name == "msgspec" and msgspec is None:
+        raise RuntimeError("JSON_PROVIDER is msgspec, but msgspec is not installed")
+    if name == "orjson" or (name == "auto" and orjson is not None):
+        return OrjsonJSONProvider(app)
+    if name == "msgspec" or (name == "auto" and msgspec is not None):
+        return MsgspecJSONProvider(app)
+    return StdlibJSONProvider(app)
@@ -4,6 +4,9 @@ class Booking {
     #searchTimeoutId = null;
     #intervalSeconds = null;
     #data = null;
+    #bookings = new Map();
+    #since = null;
+    #eventSource = null;
     constructor(elementId) {
         this.#elementId = String(elementId);
     }
@@ -83,7 +86,10 @@ class Booking {
                 try {
                     var response = await fetch(window.getContosoUrl(window.contoso_configuration.api_baseurl, '/api/booking') + '?bookingId=' + String(entry.bookingId), {method: 'DELETE'}).then(response => response.json());
                     if(typeof(response) == "object" && "success" in response && response.success) {
-                        this.refresh();
+                        // the stream pushes the deletion anyway
+                        if(this.#eventSource === null) {
+                            this.refresh();
+                        }
                     }
                     else {
                         console.log(response);
@@ -119,14 +125,54 @@ class Booking {
         this.#renderData();
     }
 
+    #applyChanges(data) {
+        // returns false when nothing changed
+        if (data.reset) {
+            this.#bookings.clear();
+        }
+        data.changes.forEach(change => {
+            if (change.operation === 'delete') {
+                this.#bookings.delete(change.bookingId);
+            }
+            else {
+                this.#bookings.set(change.bookingId, change.booking);
+            }
+        });
+        if (!data.reset && data.changes.length === 0 && this.#data !== null) {
+            return false;
+        }
+        // same order as /api/bookings
+        this.#data = Array.from(this.#bookings.values()).sort((a, b) => {
+            if (a.checkin !== b.checkin) {
+                return a.checkin < b.checkin ? 1 : -1;
+            }
+            if (a.checkout !== b.checkout) {
+                return a.checkout < b.checkout ? 1 : -1;
+            }
+            return b.bookingId - a.bookingId;
+        });
+        return true;
+    }
+
     async refresh() {
         try {
-            var data = await fetch(window.getContosoUrl(window.contoso_configuration.api_baseurl, '/api/bookings')).then(response => response.json())
-            if (Array.isArray(data)) {
-                this.#data = data;
+            // only the bookings changed since the last call are transferred, the first call (and a reset) returns all of them
+            var url = window.getContosoUrl(window.contoso_configuration.api_baseurl, '/api/bookings/changes');
+            if (this.#since !== null) {
+                url += '?since=' + encodeURIComponent(this.#since);
+            }
+            var response = await fetch(url, {cache: 'no-store'});
+            var data = await response.json();
+            if (typeof(data) == "object" && "changes" in data) {
+                this.#since = data.next;
+                if (!this.#applyChanges(data)) {
+                    return;
+                }
             }
             else {
-                if(typeof(d) == "object" && "error" in data) {
+                // start over with the next call
+                this.#since = null;
+                if(typeof(data) == "object" && "error" in data) {
                     console.log("Received error from Rest API: " + data["error"]);
                 }
                 else {
@@ -153,6 +199,47 @@ class Booking {
         console.log("Periodic refresh stopped");
     }
 
+    listen() {
+        // the server pushes the changes, without EventSource support the list is polled every second
+        if (typeof(EventSource) === "undefined") {
+            this.setPeriodicRefresh(1);
+            return;
+        }
+        this.#eventSource = new EventSource(window.getContosoUrl(window.contoso_configuration.api_baseurl, '/api/bookings/stream'));
+        // a new connection starts with a reset event holding all bookings
+        this.#eventSource.addEventListener('reset', event => {
+            this.#applyChanges(JSON.parse(event.data));
+            this.#renderData();
+        });
+        this.#eventSource.addEventListener('changes', event => {
+            if (this.#applyChanges(JSON.parse(event.data))) {
+                this.#renderData();
+            }
+        });
+        this.#eventSource.addEventListener('error', event => {
+            if (this.#eventSource !== null && this.#eventSource.readyState === EventSource.CLOSED) {
+                // the server turned the stream down (i.e. too many streams), poll for a minute and try again
+                console.log("Booking stream not available, polling instead");
+                this.cancelListen();
+                this.setPeriodicRefresh(1);
+                setTimeout(() => {
+                    this.cancelPeriodicRefresh();
+                    this.listen();
+                }, 60000);
+                return;
+            }
+            // EventSource reconnects with the id of the last event and gets only the changes it missed
+            console.log("Booking stream interrupted, reconnecting");
+        });
+    }
+
+    cancelListen() {
+        if (this.#eventSource !== null) {
+            this.#eventSource.close();
+            this.#eventSource = null;
+        }
+    }
+
     cancelPeriodicRefresh() {
         this.#intervalSeconds = null;
     }
@@ -164,7 +251,7 @@ class Booking {
 
 var bookingObj = new Booking("bookinglist");
 document.addEventListener('DOMContentLoaded', function() {
-    bookingObj.setPeriodicRefresh(1);
+    bookingObj.listen();
 });
 
 document.getElementById('search').addEventListener('keyup', function(event) {
@@ -1,13 +1,168 @@
 from datetime import datetime, timedelta
+import csv
 import json
+import time
+import zlib
+import threading
 import requests
 import re
-from flask import Flask, render_template, request, jsonify, redirect, url_for
+from collections.abc import MutableSequence
+from flask import Flask, Response, render_template, request, jsonify, redirect, url_for, stream_with_context
 from . import app, dblayer, config
 
 
 #region -------- BACKEND API ENDPOINTS --------
 
+# streamed responses are flushed in chunks of roughly this size (in characters)
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# server sent event streams send a comment at least this often, so proxies keep the connection open and gone clients are noticed
+SSE_HEARTBEAT_SECONDS = 15
+# clients turned away because of BOOKING_STREAM_MAX_CLIENTS try the stream again after this time
+SSE_RETRY_AFTER_SECONDS = 60
+
+_hotelAmenities = [
+    "skiing", "suites", "inRoomEntertainment", "conciergeServices", "housekeeping", "petFriendlyOptions", "laundryServices",
+    "roomService", "indoorPool", "outdoorPool", "fitnessCenter", "complimentaryBreakfast", "businessCenter", "freeGuestParking",
+    "complimentaryCoffeaAndTea", "climateControl", "bathroomEssentials"
+]
+
+class InvalidRecordError(ValueError):
+    # a record of the request is incomplete, answered with 400
+    pass
+
+def _parse_booking_record(record) -> dict:
+    # the returned keys are the parameter names of dblayer.create_booking
+    if "bookingId" in record:
+        record["bookingId"] = int(record["bookingId"])
+    else:
+        record["bookingId"] = None
+    # required values
+    for k in ["visitorId", "hotelId", "adults"]:
+        if k not in record:
+            raise InvalidRecordError(f"{k} is required")
+        record[k] = int(record[k])
+    for k in ["checkin", "checkout"]:
+        if k not in record:
+            raise InvalidRecordError(f"{k} is required")
+        try:
+            record[k] = datetime.fromisoformat(record[k])
+        except ValueError:
+            # regex string starts with month/day/year
+            m = re.match(r"^(\d{1,2})/(\d{1,2})/(\d{4})", str(record[k]).strip())
+            if m:
+                record[k] = datetime.fromisoformat(f"{m.group(3)}-{m.group(1).zfill(2)}-{m.group(2).zfill(2)}")
+            else:
+                raise InvalidRecordError(f"{k} has an invalid date time specification")
+    # optional values
+    for k in ["kids", "babies"]:
+        if k not in record:
+            record[k] = 0
+        record[k] = int(record[k])
+    if "rooms" not in record:
+        record["rooms"] = None
+    else:
+        record["rooms"] = int(record["rooms"])
+    if "price" not in record:
+        record["price"] = None
+    else:
+        record["price"] = float(record["price"])
+    return { k : record[k] for k in ["hotelId", "visitorId", "checkin", "checkout", "adults", "kids", "babies", "rooms", "price", "bookingId"] }
+
+def _parse_hotel_record(record, requireId : bool) -> dict:
+    # the returned keys are the parameter names of dblayer.create_hotel / dblayer.update_hotel
+    if "hotelId" in record:
+        if record["hotelId"] is not None:
+            record["hotelId"] = int(record["hotelId"])
+    else:
+        record["hotelId"] = None
+    if record["hotelId"] is None and requireId:
+        raise InvalidRecordError("hotelId is required")
+    if "pricePerNight" in record:
+        record["pricePerNight"] = float(record["pricePerNight"])
+    else:
+        raise InvalidRecordError("pricePerNight is required")
+    if "totalRooms" in record:
+        record["totalRooms"] = int(record["totalRooms"])
+    else:
+        raise InvalidRecordError("totalRooms is required")
+    if "hotelname" in record:
+        record["hotelname"] = str(record["hotelname"])
+    else:
+        raise InvalidRecordError("hotelname is required")
+    if "country" in record:
+        record["country"] = str(record["country"])
+    else:
+        record["country"] = None
+    for k in _hotelAmenities:
+        if k not in record:
+            record[k] = None
+        elif not (record[k] is None):
+            record[k] = str(record[k]).strip().lower() in ['true', '1', 'yes', 'y', 't']
+    return { k : record[k] for k in ["hotelname", "pricePerNight", "totalRooms", "hotelId", "country"] + _hotelAmenities }
+
+def _parse_visitor_record(record, requireId : bool) -> dict:
+    # the returned keys are the parameter names of dblayer.create_visitor / dblayer.update_visitor
+    if "visitorId" in record:
+        if record["visitorId"] is not None:
+            record["visitorId"] = int(record["visitorId"])
+    else:
+        record["visitorId"] = None
+    if record["visitorId"] is None and requireId:
+        raise InvalidRecordError("visitorId is required")
+    for k in ["firstname", "lastname"]:
+        if k not in record:
+            raise InvalidRecordError(f"{k} is required")
+        record[k] = str(record[k])
+    return { k : record[k] for k in ["firstname", "lastname", "visitorId"] }
+
+def _stream_json_array(items) -> Response:
+    # the first item is fetched upfront, so failing queries still end up in a proper error response
+    iterator = iter(items)
+    try:
+        first = next(iterator)
+    except StopIteration:
+        return Response("[]", mimetype="application/json")
+    def generate():
+        try:
+            parts = ["[", app.json.dumps(first)]
+            size = len(parts[1])
+            for item in iterator:
+                part = app.json.dumps(item)
+                parts.append(",")
+                parts.append(part)
+                size += len(part) + 1
+                if size >= STREAM_CHUNK_SIZE:
+                    yield "".join(parts)
+                    parts = []
+                    size = 0
+            parts.append("]")
+            yield "".join(parts)
+        finally:
+            # hands the database connection back even when the client goes away mid stream
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                close()
+    return Response(generate(), mimetype="application/json")
+
+def _conditional_json(tableNames, load) -> Response:
+    # the ETag is made of the data versions of the tables the response is built from, they are read before the data,
+    # so a write committed in between costs another full response but never an outdated ETag on new data,
+    # the cached versions lag behind the writes of other workers by up to DATA_VERSION_TTL_SECONDS (a 304 can be that stale)
+    versions = dblayer.get_data_versions()
+    if versions is None:
+        response = jsonify(load())
+    else:
+        etag = "-".join(str(versions[tableName]) for tableName in tableNames)
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = jsonify(load())
+        response.set_etag(etag)
+    # clients have to revalidate every time, they just do not get the body again while nothing changed
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
 @app.route("/api/setup", methods=["POST"])
 def api_setup():
     try:
@@ -20,10 +175,20 @@ def api_setup():
             if k not in record:
                 record[k] = v
             record[k] = int(record[k])
+        # a fixed seed generates the same demo data on every call
+        if record.get("seed") is not None:
+            record["seed"] = int(record["seed"])
+        else:
+            record["seed"] = None
+        # an omitted target occupancy means 1.0, the bookings are still generated within the rooms of the hotels
+        if record.get("target_occupancy") is not None:
+            record["target_occupancy"] = float(record["target_occupancy"])
+        else:
+            record["target_occupancy"] = None
     except Exception as e:
         return jsonify({ "success" : False, "error" : str(e) }), 400
     try:
-        return jsonify(dblayer.setupDb(record["drop_schema"], record["create_schema"], record["populate_data"], record["number_of_visitors"], record["min_bookings_per_visitor"], record["max_bookings_per_visitor"])), 201
+        return jsonify(dblayer.setupDb(record["drop_schema"], record["create_schema"], record["populate_data"], record["number_of_visitors"], record["min_bookings_per_visitor"], record["max_bookings_per_visitor"], record["seed"], record["target_occupancy"])), 201
     except Exception as e:
         return jsonify({ "success" : False, "error" : str(e) }), 500
 
@@ -34,6 +199,13 @@ def api_longsqlrequest():
     except Exception as e:
         return jsonify({ "success" : False, "error" : str(e) }), 500
 
+@app.route("/api/poolstats", methods=["GET"])
+def api_poolstats():
+    try:
+        return jsonify(dblayer.get_pool_stats()), 200
+    except Exception as e:
+        return jsonify({ "success" : False, "error" : str(e) }), 500
+
 @app.route("/api/chat", methods=["POST"])
 def api_chat():
     conf = config.get_layout_configuration()
@@ -73,53 +245,11 @@ def api_manage_booking():
             deleted = dblayer.delete_booking(bookingId)
             return jsonify({"success" : True, "deleted": deleted, "bookingId" : bookingId}), 200
         elif request.method == "PUT":
-            record = json.loads(request.data)
-            if "bookingId" in record:
-                record["bookingId"] = int(record["bookingId"])
-            else:
-                record["bookingId"] = None
-            # required values
-            for k in ["visitorId", "hotelId", "adults"]:
-                if k not in record:
-                    return jsonify({ "success" : False, "error" : f"{k} is required" }), 400
-                record[k] = int(record[k])
-            for k in ["checkin", "checkout"]:
-                if k not in record:
-                    return jsonify({ "success" : False, "error" : f"{k} is required" }), 400
-                try:
-                    record[k] = datetime.fromisoformat(record[k])
-                except ValueError:
-                    # regex string starts with month/day/year
-                    m = re.match(r"^(\d{1,2})/(\d{1,2})/(\d{4})", str(record[k]).strip())
-                    if m:
-                        record[k] = datetime.fromisoformat(f"{m.group(3)}-{m.group(1).zfill(2)}-{m.group(2).zfill(2)}")
-                    else:
-                        return jsonify({ "success" : False, "error" : f"{k} has an invalid date time specification" }), 400
-            # optional values
-            for k in ["kids", "babies"]:
-                if k not in record:
-                    record[k] = 0
-                record[k] = int(record[k])
-            if "rooms" not in record:
-                record["rooms"] = None
-            else:
-                record["rooms"] = int(record["rooms"])
-            if "price" not in record:
-                record["price"] = None
-            else:
-                record["price"] = float(record["price"])
-            return jsonify(dblayer.create_booking(
-                record["hotelId"],
-                record["visitorId"],
-                record["checkin"],
-                record["checkout"],
-                record["adults"],
-                record["kids"],
-                record["babies"],
-                record["rooms"],
-                record["price"],
-                record["bookingId"]
-            )), 200
+            try:
+                record = _parse_booking_record(json.loads(request.data))
+            except InvalidRecordError as e:
+                return jsonify({ "success" : False, "error" : str(e) }), 400
+            return jsonify(dblayer.create_booking(**record)), 200
         elif request.method == "POST":
             return jsonify({ "success" : False, "error" : "Method not allowed" }), 405
         else:
@@ -135,8 +265,7 @@ def api_get_booking():
             bookingId = int(bookingId)
         else:
             return jsonify({ "success" : False, "error" : "bookingId is required" }), 400
-        booking = dblayer.get_booking(bookingId)
-        return jsonify(booking), 200
+        return _conditional_json(["bookings"], lambda: dblayer.get_booking(bookingId))
     except Exception as e:
         return jsonify({ "success" : False, "error" : str(e) }), 500
 
@@ -155,8 +284,253 @@ def api_get_bookings():
         untildate = request.args.get("untildate", None)
         if untildate is not None:
             untildate = datetime.fromisoformat(untildate)
-        bookings = dblayer.get_bookings(visitorId, hotelId, fromdate, untildate)
-        return jsonify(bookings), 200
+        limit = request.args.get("limit", None)
+        if limit is not None:
+            limit = int(limit)
+        cursor = request.args.get("cursor", None)
+        if request.args.get("stream", "false", str).lower() == "true":
+            if limit is not None or cursor is not None:
+                return jsonify({ "success" : False, "error" : "stream cannot be combined with limit or cursor" }), 400
+            return _stream_json_array(dblayer.stream_bookings(visitorId, hotelId, fromdate, untildate))
+        # the bookings contain the names of the hotels and visitors
+        return _conditional_json(["bookings", "hotels", "visitors"], lambda: dblayer.get_bookings(visitorId, hotelId, fromdate, untildate, limit, cursor))
+    except Exception as e:
+        return jsonify({ "success" : False, "error" : str(e) }), 500
+
+@app.route("/api/bookings/changes", methods=["GET"])
+def api_get_booking_changes():
+    try:
+        # since is the next token of the previous response, without it all bookings are returned
+        return jsonify(dblayer.get_booking_changes(request.args.get("since", None))), 200
+    except Exception as e:
+        return jsonify({ "success" : False, "error" : str(e) }), 500
+
+def _sse_event(event : str, data) -> str:
+    return "event: " + event + "\ndata: " + app.json.dumps(data) + "\n\n"
+
+# (snapshot, event) of the latest booking snapshot of the change hub, the clients connecting in between share the encoded event
+_snapshotEvent = (None, None)
+
+def _snapshot_event(bookings) -> str:
+    global _snapshotEvent
+    snapshot, event = _snapshotEvent
+    if snapshot is not bookings:
+        event = _sse_event("reset", { "reset" : True, "changes" : [{ "operation" : "insert", "bookingId" : b["bookingId"], "booking" : b } for b in bookings] })
+        _snapshotEvent = (bookings, event)
+    return event
+
+# every open stream holds a thread of its worker, the number of streams per worker is limited (BOOKING_STREAM_MAX_CLIENTS),
+# so the other requests keep threads of their own
+_streamClients = 0
+_streamClientsLock = threading.Lock()
+
+def _acquire_stream_slot() -> bool:
+    global _streamClients
+    with _streamClientsLock:
+        if _streamClients >= config.get_int_configuration("BOOKING_STREAM_MAX_CLIENTS", 16):
+            return False
+        _streamClients += 1
+        return True
+
+def _release_stream_slot():
+    global _streamClients
+    with _streamClientsLock:
+        _streamClients -= 1
+
+@app.route("/api/bookings/stream", methods=["GET"])
+def api_stream_booking_changes():
+    # the bookings and their changes come from the change hub of this worker, connecting clients do not query the database
+    if not _acquire_stream_slot():
+        # EventSource gives up on a 503, the booking list falls back to polling /api/bookings/changes
+        response = jsonify({ "success" : False, "error" : "Too many booking streams, poll /api/bookings/changes instead" })
+        response.headers["Retry-After"] = str(SSE_RETRY_AFTER_SECONDS)
+        return response, 503
+    hub = dblayer.get_booking_change_hub()
+    try:
+        # a reconnecting client continues after the last event it got, as long as the hub still buffers the changes after it
+        sequence, bookings = hub.subscribe(lastEventId=request.headers.get("Last-Event-ID", None))
+    except Exception as e:
+        _release_stream_slot()
+        return jsonify({ "success" : False, "error" : str(e) }), 500
+    # the stream ends after a while and the browser reconnects, so every connection only holds a worker thread for a limited time
+    maxSeconds = config.get_float_configuration("BOOKING_STREAM_MAX_SECONDS", 300.0)
+    def generate():
+        nonlocal sequence
+        if bookings is None:
+            yield "retry: 1000\n\n"
+        else:
+            yield "retry: 1000\nid: " + hub.event_id(sequence) + "\n" + _snapshot_event(bookings)
+        endAt = time.monotonic() + maxSeconds
+        while time.monotonic() < endAt:
+            sequence, events, lost = hub.wait(sequence, min(SSE_HEARTBEAT_SECONDS, max(0.0, endAt - time.monotonic())))
+            if lost:
+                # the client reconnects and starts over with a new snapshot
+                return
+            if len(events) == 0:
+                yield ": heartbeat\n\n"
+            for eventSequence, changes in events:
+                yield "id: " + hub.event_id(eventSequence) + "\n" + _sse_event("reset" if changes["reset"] else "changes", changes)
+    def close():
+        hub.unsubscribe()
+        _release_stream_slot()
+    response = Response(generate(), mimetype="text/event-stream", headers={ "Cache-Control" : "no-cache", "X-Accel-Buffering" : "no" })
+    # runs when the server closes the response, even when the client went away before the stream started
+    response.call_on_close(close)
+    return response
+
+def _read_import_records(format : str):
+    # yields (line number, record, error) while the body is read line by line, the csv format needs a header line
+    lines = (line.decode("utf-8-sig") for line in request.stream)
+    if format == "csv":
+        reader = csv.reader(lines)
+        header = [column.strip() for column in next(reader, [])]
+        for row in reader:
+            if not any(value.strip() for value in row):
+                continue
+            try:
+                # empty cells are missing values
+                yield reader.line_num, _parse_booking_record({ k : v for k, v in zip(header, row) if v.strip() != "" }), None
+            except Exception as e:
+                yield reader.line_num, None, str(e)
+    else:
+        for number, line in enumerate(lines, start=1):
+            if line.strip() == "":
+                continue
+            try:
+                record = json.loads(line)
+                if not isinstance(record, dict):
+                    raise InvalidRecordError("line must be a JSON object")
+                yield number, _parse_booking_record(record), None
+            except Exception as e:
+                yield number, None, str(e)
+
+def _import_error(number : int, error : str) -> str:
+    return app.json.dumps({ "line" : number, "success" : False, "error" : error }) + "\n"
+
+@app.route("/api/bookings/import", methods=["POST"])
+def api_import_bookings():
+    # the report (one line per failed booking and a summary) is streamed while the body is read,
+    # so only one batch of bookings is held in memory
+    format = request.args.get("format", None)
+    if format is None:
+        format = "csv" if request.mimetype in ["text/csv", "application/csv"] else "ndjson"
+    if format not in ["csv", "ndjson"]:
+        return jsonify({ "success" : False, "error" : "format must be csv or ndjson" }), 400
+    batchSize = max(1, config.get_int_configuration("BOOKING_IMPORT_BATCH_SIZE", 1000))
+    def generate():
+        counts = { "lines" : 0, "imported" : 0, "failed" : 0 }
+        batch = []
+        report = []
+        def import_batch():
+            # every batch is committed on its own
+            for (number, record), result in zip(batch, dblayer.import_bookings([record for number, record in batch])):
+                if "error" in result:
+                    counts["failed"] += 1
+                    report.append(_import_error(number, result["error"]))
+                else:
+                    counts["imported"] += 1
+            batch.clear()
+        try:
+            for number, record, error in _read_import_records(format):
+                counts["lines"] += 1
+                if error is None:
+                    batch.append((number, record))
+                else:
+                    counts["failed"] += 1
+                    report.append(_import_error(number, error))
+                if len(batch) >= batchSize:
+                    import_batch()
+                if len(report) >= batchSize or (len(batch) == 0 and len(report) > 0):
+                    yield "".join(report)
+                    report.clear()
+            if len(batch) > 0:
+                import_batch()
+        except Exception as e:
+            # the batches before were committed, the rest of the body is not imported
+            report.append(app.json.dumps({ "success" : False, "error" : str(e), **counts }) + "\n")
+            yield "".join(report)
+            return
+        report.append(app.json.dumps({ "success" : counts["failed"] == 0, **counts }) + "\n")
+        yield "".join(report)
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson", headers={ "X-Accel-Buffering" : "no" })
+
+def _gzip_chunks(chunks, level : int):
+    # compresses on the fly, every chunk is flushed so the client gets the data as soon as it is exported
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    try:
+        for chunk in chunks:
+            yield compressor.compress(chunk.encode("utf-8")) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+    finally:
+        chunks.close()
+
+@app.route("/api/export/<tableName>", methods=["GET"])
+def api_export(tableName : str):
+    # the table is streamed from the database to the client in chunks, so the export needs constant memory
+    if tableName not in dblayer.EXPORT_COLUMNS:
+        return jsonify({ "success" : False, "error" : "table must be one of " + ", ".join(dblayer.EXPORT_COLUMNS.keys()) }), 404
+    format = request.args.get("format", "csv")
+    if format not in dblayer.EXPORT_FORMATS:
+        return jsonify({ "success" : False, "error" : "format must be csv or ndjson" }), 400
+    try:
+        filters = {}
+        for name in request.args.keys():
+            if name == "format":
+                continue
+            if name not in dblayer.EXPORT_FILTERS[tableName]:
+                raise InvalidRecordError("the " + tableName + " export does not support the filter " + name)
+            if name in ["fromdate", "untildate"]:
+                filters[name] = datetime.fromisoformat(request.args.get(name))
+            else:
+                filters[name] = int(request.args.get(name))
+        if "fromdate" in filters and "untildate" in filters and filters["fromdate"] > filters["untildate"]:
+            raise InvalidRecordError("fromdate must not be after untildate")
+    except Exception as e:
+        return jsonify({ "success" : False, "error" : str(e) }), 400
+    try:
+        chunks = dblayer.export_table(tableName, format, **filters)
+        # the first chunk is fetched right away, so a failing query still gets an error response
+        first = next(chunks, "")
+    except Exception as e:
+        return jsonify({ "success" : False, "error" : str(e) }), 500
+    def generate():
+        try:
+            yield first
+            for chunk in chunks:
+                yield chunk
+        finally:
+            chunks.close()
+    body = generate()
+    headers = {
+        "Content-Disposition" : "attachment; filename=" + tableName + "." + format,
+        "Vary" : "Accept-Encoding",
+        "X-Accel-Buffering" : "no"
+    }
+    if "gzip" in request.accept_encodings:
+        body = _gzip_chunks(body, max(0, min(9, config.get_int_configuration("EXPORT_GZIP_LEVEL", 1))))
+        headers["Content-Encoding"] = "gzip"
+    return Response(body, mimetype="text/csv" if format == "csv" else "application/x-ndjson", headers=headers)
+
+@app.route("/api/availability", methods=["GET"])
+def api_get_availability():
+    try:
+        hotelId = request.args.get("hotelId", None)
+        if hotelId is None:
+            return jsonify({ "success" : False, "error" : "hotelId is required" }), 400
+        hotelId = int(hotelId)
+        fromdate = request.args.get("from", None)
+        untildate = request.args.get("until", None)
+        if fromdate is None or untildate is None:
+            return jsonify({ "success" : False, "error" : "from and until are required" }), 400
+        fromdate = datetime.fromisoformat(fromdate)
+        untildate = datetime.fromisoformat(untildate)
+    except Exception as e:
+        return jsonify({ "success" : False, "error" : str(e) }), 400
+    try:
+        return jsonify(dblayer.get_availability(hotelId, fromdate, untildate)), 200
+    except ValueError as e:
+        # an unknown hotel or a time span that is too long or outside of the bookable range
+        return jsonify({ "success" : False, "error" : str(e) }), 404 if str(e) == "Hotel does not exist" else 400
     except Exception as e:
         return jsonify({ "success" : False, "error" : str(e) }), 500
 
@@ -172,56 +546,14 @@ def api_manage_hotel():
             deleted = dblayer.delete_hotel(hotelId)
             return jsonify({"success" : True, "deleted": deleted, "hotelId" : hotelId}), 200
         elif request.method == "PUT" or request.method == "POST":
-            record = json.loads(request.data)
-            if "hotelId" in record:
-                if record["hotelId"] is not None:
-                    record["hotelId"] = int(record["hotelId"])
-            else:
-                record["hotelId"] = None
-            if record["hotelId"] is None and request.method == "POST":
-                return jsonify({ "success" : False, "error" : "hotelId is required" }), 400
-            if "pricePerNight" in record:
-                record["pricePerNight"] = float(record["pricePerNight"])
-            else:
-                return jsonify({ "success" : False, "error" : "pricePerNight is required" }), 400
-            if "totalRooms" in record:
-                record["totalRooms"] = int(record["totalRooms"])
-            else:
-                return jsonify({ "success" : False, "error" : "totalRooms is required" }), 400
-            if "hotelname" in record:
-                record["hotelname"] = str(record["hotelname"])
-            else:
-                return jsonify({ "success" : False, "error" : "hotelname is required" }), 400
-            if "country" in record:
-                record["country"] = str(record["country"])
-            else:
-                record["country"] = None
-            for k in [
-                "skiing", "suites", "inRoomEntertainment", "conciergeServices", "housekeeping", "petFriendlyOptions", "laundryServices",
-                "roomService", "indoorPool", "outdoorPool", "fitnessCenter", "complimentaryBreakfast", "businessCenter", "freeGuestParking",
-                "complimentaryCoffeaAndTea", "climateControl", "bathroomEssentials"
-            ]:
-                if k not in record:
-                    record[k] = None
-                elif not (record[k] is None):
-                    record[k] = str(record[k]).strip().lower() in ['true', '1', 'yes', 'y', 't']
-            
+            try:
+                record = _parse_hotel_record(json.loads(request.data), request.method == "POST")
+            except InvalidRecordError as e:
+                return jsonify({ "success" : False, "error" : str(e) }), 400
             if request.method == "PUT":
-                return jsonify(dblayer.create_hotel(
-                    record["hotelname"], record["pricePerNight"], record["totalRooms"], record["hotelId"], record["country"],
-                    record["skiing"], record["suites"], record["inRoomEntertainment"], record["conciergeServices"], record["housekeeping"],
-                    record["petFriendlyOptions"], record["laundryServices"], record["roomService"], record["indoorPool"], record["outdoorPool"],
-                    record["fitnessCenter"], record["complimentaryBreakfast"], record["businessCenter"], record["freeGuestParking"],
-                    record["complimentaryCoffeaAndTea"], record["climateControl"], record["bathroomEssentials"]
-                )), 200
+                return jsonify(dblayer.create_hotel(**record)), 200
             else:
-                return jsonify(dblayer.update_hotel(
-                    record["hotelname"], record["pricePerNight"], record["totalRooms"], record["hotelId"], record["country"],
-                    record["skiing"], record["suites"], record["inRoomEntertainment"], record["conciergeServices"], record["housekeeping"],
-                    record["petFriendlyOptions"], record["laundryServices"], record["roomService"], record["indoorPool"], record["outdoorPool"],
-                    record["fitnessCenter"], record["complimentaryBreakfast"], record["businessCenter"], record["freeGuestParking"],
-                    record["complimentaryCoffeaAndTea"], record["climateControl"], record["bathroomEssentials"]
-                )), 200
+                return jsonify(dblayer.update_hotel(**record)), 200
         else:
             return jsonify({ "success" : False, "error" : "Method not allowed" }), 405 
     except Exception as e:
@@ -235,8 +567,7 @@ def api_get_hotel():
             hotelId = int(hotelId)
         else:
             return jsonify({ "success" : False, "error" : "hotelId is required" }), 400
-        hotel = dblayer.get_hotel(hotelId)
-        return jsonify(hotel), 200
+        return _conditional_json(["hotels"], lambda: dblayer.get_hotel(hotelId))
     except Exception as e:
         return jsonify({ "success" : False, "error" : str(e) }), 500
 
@@ -245,8 +576,37 @@ def api_get_hotels():
     try:
         exactMatch = request.args.get("exactMatch", "false", str).lower() == "true"
         hotelname = request.args.get("hotelname", "", str)
-        hotels = dblayer.get_hotels(hotelname, exactMatch)
-        return jsonify(hotels), 200
+        limit = request.args.get("limit", None)
+        if limit is not None:
+            limit = int(limit)
+        cursor = request.args.get("cursor", None)
+        if request.args.get("stream", "false", str).lower() == "true":
+            if limit is not None or cursor is not None:
+                return jsonify({ "success" : False, "error" : "stream cannot be combined with limit or cursor" }), 400
+            return _stream_json_array(dblayer.stream_hotels(hotelname, exactMatch))
+        return _conditional_json(["hotels"], lambda: dblayer.get_hotels(hotelname, exactMatch, limit, cursor))
+    except Exception as e:
+        return jsonify({ "success" : False, "error" : str(e) }), 500
+
+
+@app.route("/api/hotels/available", methods=["GET"])
+def api_get_available_hotels():
+    try:
+        checkin = request.args.get("checkin", None)
+        checkout = request.args.get("checkout", None)
+        if checkin is None or checkout is None:
+            return jsonify({ "success" : False, "error" : "checkin and checkout are required" }), 400
+        checkin = datetime.fromisoformat(checkin)
+        checkout = datetime.fromisoformat(checkout)
+        rooms = int(request.args.get("rooms", "1"))
+        amenities = request.args.get("amenities", "", str)
+    except Exception as e:
+        return jsonify({ "success" : False, "error" : str(e) }), 400
+    try:
+        return jsonify(dblayer.get_available_hotels(checkin, checkout, rooms, amenities)), 200
+    except ValueError as e:
+        # rooms <= 0 or a stay that is too long or outside of the bookable range
+        return jsonify({ "success" : False, "error" : str(e) }), 400
     except Exception as e:
         return jsonify({ "success" : False, "error" : str(e) }), 500
 
@@ -262,22 +622,14 @@ def api_manage_visitor():
             deleted = dblayer.delete_visitor(visitorId)
             return jsonify({"success" : True, "deleted": deleted, "visitorId" : visitorId}), 200
         elif request.method == "PUT" or request.method == "POST":
-            record = json.loads(request.data)
-            if "visitorId" in record:
-                if record["visitorId"] is not None:
-                    record["visitorId"] = int(record["visitorId"])
-            else:
-                record["visitorId"] = None
-            if record["visitorId"] is None and request.method == "POST":
-                return jsonify({ "success" : False, "error" : "visitorId is required" }), 400
-            for k in ["firstname", "lastname"]:
-                if k not in record:
-                    return jsonify({ "success" : False, "error" : f"{k} is required" }), 400
-                record[k] = str(record[k])
+            try:
+                record = _parse_visitor_record(json.loads(request.data), request.method == "POST")
+            except InvalidRecordError as e:
+                return jsonify({ "success" : False, "error" : str(e) }), 400
             if request.method == "PUT":
-                return jsonify(dblayer.create_visitor(record["firstname"], record["lastname"], record["visitorId"])), 200
+                return jsonify(dblayer.create_visitor(**record)), 200
             else:
-                return jsonify(dblayer.update_visitor(record["firstname"], record["lastname"], record["visitorId"])), 200
+                return jsonify(dblayer.update_visitor(**record)), 200
         else:
             return jsonify({ "success" : False, "error" : "Method not allowed" }), 405 
     except Exception as e:
@@ -291,8 +643,7 @@ def api_get_visitor():
             visitorId = int(visitorId)
         else:
             return jsonify({ "success" : False, "error" : "visitorId is required" }), 400
-        visitor = dblayer.get_visitor(visitorId)
-        return jsonify(visitor), 200
+        return _conditional_json(["visitors"], lambda: dblayer.get_visitor(visitorId))
     except Exception as e:
         return jsonify({ "success" : False, "error" : str(e) }), 500
 
@@ -301,8 +652,75 @@ def api_get_visitors(name : str = ""):
     try:
         exactMatch = request.args.get("exactMatch", "false", str).lower() == "true"
         name = request.args.get("name", "", str)
-        visitors = dblayer.get_visitors(name, exactMatch)
-        return jsonify(visitors), 200
+        limit = request.args.get("limit", None)
+        if limit is not None:
+            limit = int(limit)
+        cursor = request.args.get("cursor", None)
+        if request.args.get("stream", "false", str).lower() == "true":
+            if limit is not None or cursor is not None:
+                return jsonify({ "success" : False, "error" : "stream cannot be combined with limit or cursor" }), 400
+            return _stream_json_array(dblayer.stream_visitors(name, exactMatch))
+        return _conditional_json(["visitors"], lambda: dblayer.get_visitors(name, exactMatch, limit, cursor))
+    except Exception as e:
+        return jsonify({ "success" : False, "error" : str(e) }), 500
+
+def _parse_batch_operation(operation) -> dict:
+    if not isinstance(operation, dict):
+        raise InvalidRecordError("operation must be an object")
+    action = str(operation.get("action", "")).strip().lower()
+    if action not in dblayer.BATCH_ACTIONS:
+        raise InvalidRecordError("action must be one of " + ", ".join(dblayer.BATCH_ACTIONS))
+    entity = str(operation.get("entity", "")).strip().lower()
+    if entity not in dblayer.BATCH_ENTITIES:
+        raise InvalidRecordError("entity must be one of " + ", ".join(dblayer.BATCH_ENTITIES))
+    record = operation.get("data", None)
+    if not isinstance(record, dict):
+        raise InvalidRecordError("data must be an object")
+    # same rules as the single record endpoints
+    if action == "delete":
+        if record.get(entity + "Id") is None:
+            raise InvalidRecordError(f"{entity}Id is required")
+        record = { entity + "Id" : int(record[entity + "Id"]) }
+    elif entity == "booking":
+        if action == "update":
+            raise InvalidRecordError("bookings can not be updated")
+        record = _parse_booking_record(record)
+    elif entity == "hotel":
+        record = _parse_hotel_record(record, action == "update")
+    else:
+        record = _parse_visitor_record(record, action == "update")
+    return { "action" : action, "entity" : entity, "data" : record }
+
+@app.route("/api/batch", methods=["POST"])
+def api_batch():
+    # either an array of operations or { "operations" : [...], "atomic" : true }
+    try:
+        record = json.loads(request.data)
+        atomic = True
+        if isinstance(record, dict):
+            atomic = bool(record.get("atomic", True))
+            record = record.get("operations", None)
+        # (the list view below shadows the builtin)
+        if not isinstance(record, MutableSequence) or len(record) == 0:
+            return jsonify({ "success" : False, "error" : "operations must be a non empty array" }), 400
+        maxOperations = config.get_int_configuration("BATCH_MAX_OPERATIONS", 1000)
+        if len(record) > maxOperations:
+            return jsonify({ "success" : False, "error" : f"at most {maxOperations} operations are allowed" }), 400
+    except Exception as e:
+        return jsonify({ "success" : False, "error" : str(e) }), 400
+    # nothing is executed unless all operations are valid
+    operations = []
+    errors = []
+    for index, operation in enumerate(record):
+        try:
+            operations.append(_parse_batch_operation(operation))
+        except Exception as e:
+            errors.append({ "index" : index, "success" : False, "error" : str(e) })
+    if len(errors) > 0:
+        return jsonify({ "success" : False, "error" : "Invalid operations", "atomic" : atomic, "committed" : False, "results" : errors }), 400
+    try:
+        batch = dblayer.execute_batch(operations, atomic)
+        return jsonify(batch), (200 if batch["committed"] else 500)
     except Exception as e:
         return jsonify({ "success" : False, "error" : str(e) }), 500
 
@@ -1,9 +1,20 @@
+DROP TABLE IF EXISTS visitors_trigrams, hotels_trigrams, hotel_day_usage, booking_changes;
 DROP TABLE IF EXISTS bookings, hotels, visitors;
+DROP FUNCTION IF EXISTS GetTrigrams;
+DROP SEQUENCE IF EXISTS bookings_seq, hotels_seq, visitors_seq;
+
+CREATE SEQUENCE hotels_seq AS INT START WITH 1 INCREMENT BY 1 CACHE 50;
+CREATE SEQUENCE visitors_seq AS INT START WITH 1 INCREMENT BY 1 CACHE 50;
+CREATE SEQUENCE bookings_seq AS INT START WITH 1 INCREMENT BY 1 CACHE 50;
+-- data versions behind the ETags of the API, they are kept when the tables are dropped
+IF OBJECT_ID('data_version_hotels', 'SO') IS NULL CREATE SEQUENCE data_version_hotels AS BIGINT START WITH 1 INCREMENT BY 1 NO CACHE;
+IF OBJECT_ID('data_version_visitors', 'SO') IS NULL CREATE SEQUENCE data_version_visitors AS BIGINT START WITH 1 INCREMENT BY 1 NO CACHE;
+IF OBJECT_ID('data_version_bookings', 'SO') IS NULL CREATE SEQUENCE data_version_bookings AS BIGINT START WITH 1 INCREMENT BY 1 NO CACHE;
 
 
 
 CREATE TABLE hotels (
-    hotelId INT NOT NULL PRIMARY KEY,
+    hotelId INT NOT NULL PRIMARY KEY DEFAULT (NEXT VALUE FOR hotels_seq),
     hotelname VARCHAR(200) NOT NULL,
     pricePerNight FLOAT NOT NULL CHECK (pricePerNight > 0),
     totalRooms INT NOT NULL CHECK (totalRooms > 0),
@@ -29,14 +40,14 @@ CREATE TABLE hotels (
 );
 
 CREATE TABLE visitors (
-    visitorId INT NOT NULL PRIMARY KEY,
+    visitorId INT NOT NULL PRIMARY KEY DEFAULT (NEXT VALUE FOR visitors_seq),
     firstname VARCHAR(200) NOT NULL,
     lastname VARCHAR(200) NOT NULL,
     CONSTRAINT visitornameUq UNIQUE(firstname, lastname)
 );
 
 CREATE TABLE bookings (
-    bookingId INT NOT NULL PRIMARY KEY,
+    bookingId INT NOT NULL PRIMARY KEY DEFAULT (NEXT VALUE FOR bookings_seq),
     hotelId INT NOT NULL,
     visitorId INT NOT NULL,
     checkin date NOT NULL,
@@ -58,51 +69,165 @@ CREATE TABLE bookings (
     FOREIGN KEY (visitorId) REFERENCES visitors(visitorId) ON DELETE CASCADE
 );
 
+CREATE INDEX ix_bookings_order ON bookings (checkin DESC, checkout DESC, bookingId DESC);
+CREATE INDEX ix_bookings_visitor ON bookings (visitorId, checkin DESC, checkout DESC, bookingId DESC);
+CREATE INDEX ix_bookings_hotel ON bookings (hotelId, checkin DESC, checkout DESC, bookingId DESC) INCLUDE (rooms);
+
 
 
 
 
 DROP FUNCTION IF EXISTS GetRoomsUsageWithinTimeSpan
 
-CREATE FUNCTION GetRoomsUsageWithinTimeSpan (@StartDate DATE, @EndDate DATE)
-RETURNS @RoomUsageTable TABLE (
-    hotelId INT,
-    hotelname VARCHAR(200),
-    country VARCHAR(200),
-    date DATE,
-    usedRooms INT,
-    freeRooms INT
-)
-AS
+-- used rooms per hotel and night (checkin..checkout-1), maintained by a trigger on bookings
+CREATE TABLE hotel_day_usage (
+    hotelId INT NOT NULL,
+    usageDate DATE NOT NULL,
+    usedRooms INT NOT NULL,
+    CONSTRAINT pk_hotel_day_usage PRIMARY KEY (hotelId, usageDate),
+    FOREIGN KEY (hotelId) REFERENCES hotels(hotelId) ON DELETE CASCADE
+);
+
+CREATE TRIGGER trg_bookings_day_usage ON bookings AFTER INSERT, UPDATE, DELETE AS
 BEGIN
-    -- Generate the dates in the range using a recursive CTE
-    WITH DateSeries AS (
-        SELECT @StartDate AS Date
-        UNION ALL
-        SELECT DATEADD(DAY, 1, Date)
-        FROM DateSeries
-        WHERE Date < @EndDate
+    SET NOCOUNT ON;
+    -- deleted bookings of a deleted hotel are skipped, its rows are already gone by the cascade
+    MERGE hotel_day_usage WITH (HOLDLOCK) AS u
+    USING (
+        SELECT s.hotelId, DATEADD(DAY, n.n, s.checkin) AS usageDate, SUM(s.rooms) AS usedRooms
+        FROM (
+            SELECT i.hotelId, i.checkin, i.checkout, i.rooms FROM inserted AS i
+            UNION ALL
+            SELECT d.hotelId, d.checkin, d.checkout, -d.rooms FROM deleted AS d WHERE EXISTS (SELECT 1 FROM hotels AS h WHERE h.hotelId = d.hotelId)
+        ) AS s
+        CROSS APPLY (
+            SELECT TOP (DATEDIFF(DAY, s.checkin, s.checkout)) CAST(ROW_NUMBER() OVER (ORDER BY (SELECT NULL)) - 1 AS INT) AS n
+            FROM sys.all_columns AS a CROSS JOIN sys.all_columns AS b
+        ) AS n
+        GROUP BY s.hotelId, DATEADD(DAY, n.n, s.checkin)
+    ) AS c
+    ON u.hotelId = c.hotelId AND u.usageDate = c.usageDate
+    WHEN MATCHED THEN UPDATE SET usedRooms = u.usedRooms + c.usedRooms
+    WHEN NOT MATCHED THEN INSERT (hotelId, usageDate, usedRooms) VALUES (c.hotelId, c.usageDate, c.usedRooms);
+    -- rejects bookings that do not fit into the remaining rooms, only bookings sharing a night lock the same rows
+    IF EXISTS (
+        SELECT 1 FROM inserted AS i
+        JOIN hotels AS h ON h.hotelId = i.hotelId
+        JOIN hotel_day_usage AS u ON u.hotelId = i.hotelId AND u.usageDate >= i.checkin AND u.usageDate < i.checkout
+        WHERE u.usedRooms > h.totalRooms
     )
-    -- Calculate room usage for each hotel and date
-    INSERT INTO @RoomUsageTable (hotelId, hotelname, country, date, usedRooms, freeRooms)
+        THROW 50001, 'Not enough rooms available', 1;
+END;
+
+-- change log behind /api/bookings/changes, the rowversion orders the rows by the time they were written
+CREATE TABLE booking_changes (
+    changeId BIGINT IDENTITY(1,1) PRIMARY KEY,
+    changeVersion ROWVERSION,
+    bookingId INT NULL,
+    operation CHAR(1) NOT NULL,
+    changedAt DATETIME2 NOT NULL DEFAULT SYSUTCDATETIME()
+);
+CREATE INDEX ix_booking_changes_changeversion ON booking_changes (changeVersion);
+CREATE INDEX ix_booking_changes_changedat ON booking_changes (changedAt);
+
+CREATE TRIGGER trg_bookings_changes ON bookings AFTER INSERT, UPDATE, DELETE AS
+BEGIN
+    SET NOCOUNT ON;
+    INSERT INTO booking_changes (bookingId, operation)
+    SELECT i.bookingId, CASE WHEN EXISTS (SELECT 1 FROM deleted) THEN 'U' ELSE 'I' END FROM inserted AS i;
+    INSERT INTO booking_changes (bookingId, operation)
+    SELECT d.bookingId, 'D' FROM deleted AS d WHERE NOT EXISTS (SELECT 1 FROM inserted);
+END;
+
+-- the bookings contain the names of the hotel and the visitor
+CREATE TRIGGER trg_hotels_booking_changes ON hotels AFTER UPDATE AS
+BEGIN
+    SET NOCOUNT ON;
+    INSERT INTO booking_changes (bookingId, operation)
+    SELECT b.bookingId, 'U' FROM inserted AS i
+    JOIN deleted AS d ON d.hotelId = i.hotelId
+    JOIN bookings AS b ON b.hotelId = i.hotelId
+    WHERE i.hotelname <> d.hotelname;
+END;
+
+CREATE TRIGGER trg_visitors_booking_changes ON visitors AFTER UPDATE AS
+BEGIN
+    SET NOCOUNT ON;
+    INSERT INTO booking_changes (bookingId, operation)
+    SELECT b.bookingId, 'U' FROM inserted AS i
+    JOIN deleted AS d ON d.visitorId = i.visitorId
+    JOIN bookings AS b ON b.visitorId = i.visitorId
+    WHERE i.firstname <> d.firstname OR i.lastname <> d.lastname;
+END;
+
+CREATE FUNCTION GetRoomsUsageWithinTimeSpan (@StartDate DATE, @EndDate DATE)
+RETURNS TABLE
+AS
+RETURN (
     SELECT 
         h.hotelId,
         h.hotelname,
         h.country,
-        d.Date,
-        ISNULL(SUM(b.rooms), 0) AS usedRooms,
-        h.totalRooms - ISNULL(SUM(b.rooms), 0) AS freeRooms
+        d.date,
+        ISNULL(u.usedRooms, 0) AS usedRooms,
+        h.totalRooms - ISNULL(u.usedRooms, 0) AS freeRooms
     FROM 
         hotels h
-    CROSS JOIN 
-        DateSeries d
+    CROSS JOIN (
+        SELECT TOP (CASE WHEN @EndDate >= @StartDate THEN DATEDIFF(DAY, @StartDate, @EndDate) + 1 ELSE 0 END)
+            DATEADD(DAY, CAST(ROW_NUMBER() OVER (ORDER BY (SELECT NULL)) - 1 AS INT), @StartDate) AS date
+        FROM sys.all_columns AS a CROSS JOIN sys.all_columns AS b
+    ) d
     LEFT JOIN 
-        bookings b ON h.hotelId = b.hotelId AND d.Date BETWEEN b.checkin AND b.checkout
-    GROUP BY 
-        h.hotelId, h.hotelname, h.country, d.Date, h.totalRooms
-    OPTION (MAXRECURSION 0);
+        hotel_day_usage u ON u.hotelId = h.hotelId AND u.usageDate = d.date
+);
+
+
 
-    RETURN;
+-- substring search (get_visitors / get_hotels): every distinct lower case trigram of the searchable columns
+CREATE FUNCTION GetTrigrams (@value NVARCHAR(200))
+RETURNS TABLE
+AS
+RETURN (
+    SELECT DISTINCT SUBSTRING(LOWER(@value), n.n, 3) AS trigram
+    FROM (
+        SELECT TOP (CASE WHEN LEN(@value) >= 3 THEN LEN(@value) - 2 ELSE 0 END) ROW_NUMBER() OVER (ORDER BY (SELECT NULL)) AS n
+        FROM sys.all_columns
+    ) AS n
+);
+
+CREATE TABLE visitors_trigrams (
+    trigram NVARCHAR(3) NOT NULL,
+    visitorId INT NOT NULL,
+    CONSTRAINT pk_visitors_trigrams PRIMARY KEY (trigram, visitorId),
+    FOREIGN KEY (visitorId) REFERENCES visitors(visitorId) ON DELETE CASCADE
+);
+CREATE INDEX ix_visitors_trigrams_key ON visitors_trigrams (visitorId);
+
+CREATE TRIGGER trg_visitors_trigrams ON visitors AFTER INSERT, UPDATE AS
+BEGIN
+    SET NOCOUNT ON;
+    DELETE t FROM visitors_trigrams AS t INNER JOIN inserted AS i ON i.visitorId = t.visitorId;
+    INSERT INTO visitors_trigrams (trigram, visitorId)
+    SELECT g.trigram, s.visitorId FROM inserted AS s CROSS APPLY dbo.GetTrigrams(s.firstname) AS g
+    UNION
+    SELECT g.trigram, s.visitorId FROM inserted AS s CROSS APPLY dbo.GetTrigrams(s.lastname) AS g;
+END;
+
+CREATE TABLE hotels_trigrams (
+    trigram NVARCHAR(3) NOT NULL,
+    hotelId INT NOT NULL,
+    CONSTRAINT pk_hotels_trigrams PRIMARY KEY (trigram, hotelId),
+    FOREIGN KEY (hotelId) REFERENCES hotels(hotelId) ON DELETE CASCADE
+);
+CREATE INDEX ix_hotels_trigrams_key ON hotels_trigrams (hotelId);
+
+CREATE TRIGGER trg_hotels_trigrams ON hotels AFTER INSERT, UPDATE AS
+BEGIN
+    SET NOCOUNT ON;
+    DELETE t FROM hotels_trigrams AS t INNER JOIN inserted AS i ON i.hotelId = t.hotelId;
+    INSERT INTO hotels_trigrams (trigram, hotelId)
+    SELECT g.trigram, s.hotelId FROM inserted AS s CROSS APPLY dbo.GetTrigrams(s.hotelname) AS g;
 END;
 
 
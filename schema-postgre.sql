@@ -1,4 +1,11 @@
-DROP TABLE IF EXISTS bookings, hotels, visitors;
+DROP TABLE IF EXISTS booking_changes, hotel_day_usage, bookings, hotels, visitors;
+DROP FUNCTION IF EXISTS bookings_day_usage;
+DROP FUNCTION IF EXISTS bookings_changes, hotels_booking_changes, visitors_booking_changes, booking_changes_notify;
+
+-- data versions behind the ETags of the API, they are kept when the tables are dropped
+CREATE SEQUENCE IF NOT EXISTS data_version_hotels;
+CREATE SEQUENCE IF NOT EXISTS data_version_visitors;
+CREATE SEQUENCE IF NOT EXISTS data_version_bookings;
 
 
 
@@ -58,6 +65,109 @@ CREATE TABLE bookings (
     FOREIGN KEY (visitorId) REFERENCES visitors(visitorId) ON DELETE CASCADE
 );
 
+CREATE INDEX ix_bookings_order ON bookings (checkin DESC, checkout DESC, bookingId DESC);
+CREATE INDEX ix_bookings_visitor ON bookings (visitorId, checkin DESC, checkout DESC, bookingId DESC);
+CREATE INDEX ix_bookings_hotel ON bookings (hotelId, checkin DESC, checkout DESC, bookingId DESC) INCLUDE (rooms);
+
+-- substring search (get_visitors / get_hotels), requires the pg_trgm extension
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX ix_visitors_firstname_trgm ON visitors USING gin (firstname gin_trgm_ops);
+CREATE INDEX ix_visitors_lastname_trgm ON visitors USING gin (lastname gin_trgm_ops);
+CREATE INDEX ix_hotels_hotelname_trgm ON hotels USING gin (hotelname gin_trgm_ops);
+
+-- used rooms per hotel and night (checkin..checkout-1), maintained by a trigger on bookings
+CREATE TABLE hotel_day_usage (
+    hotelId INT NOT NULL,
+    usageDate DATE NOT NULL,
+    usedRooms INT NOT NULL,
+    PRIMARY KEY (hotelId, usageDate),
+    FOREIGN KEY (hotelId) REFERENCES hotels(hotelId) ON DELETE CASCADE
+);
+
+-- rejects bookings that do not fit into the remaining rooms, only bookings sharing a night lock the same rows
+CREATE OR REPLACE FUNCTION bookings_day_usage() RETURNS trigger AS $$
+DECLARE
+    maxUsedRooms INT;
+    hotelRooms INT;
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE hotel_day_usage SET usedRooms = usedRooms - OLD.rooms
+        WHERE hotelId = OLD.hotelId AND usageDate >= OLD.checkin AND usageDate < OLD.checkout;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        WITH upserted AS (
+            INSERT INTO hotel_day_usage (hotelId, usageDate, usedRooms)
+            SELECT NEW.hotelId, d.night::date, NEW.rooms
+            FROM generate_series(NEW.checkin, NEW.checkout - 1, '1 day'::interval) AS d(night)
+            ORDER BY d.night
+            ON CONFLICT (hotelId, usageDate) DO UPDATE SET usedRooms = hotel_day_usage.usedRooms + EXCLUDED.usedRooms
+            RETURNING usedRooms
+        )
+        SELECT max(usedRooms) INTO maxUsedRooms FROM upserted;
+        SELECT totalRooms INTO hotelRooms FROM hotels WHERE hotelId = NEW.hotelId;
+        IF maxUsedRooms > hotelRooms THEN
+            RAISE EXCEPTION 'Not enough rooms available' USING ERRCODE = 'check_violation', CONSTRAINT = 'hotel_capacity';
+        END IF;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_bookings_day_usage AFTER INSERT OR UPDATE OR DELETE ON bookings FOR EACH ROW EXECUTE PROCEDURE bookings_day_usage();
+
+-- change log behind /api/bookings/changes, txId orders the rows by the transaction that wrote them
+CREATE TABLE booking_changes (
+    changeId BIGSERIAL PRIMARY KEY,
+    txId BIGINT NOT NULL DEFAULT txid_current(),
+    bookingId INT NULL,
+    operation CHAR(1) NOT NULL,
+    changedAt TIMESTAMP NOT NULL DEFAULT now()
+);
+CREATE INDEX ix_booking_changes_txid ON booking_changes (txId);
+CREATE INDEX ix_booking_changes_changedat ON booking_changes (changedAt);
+
+CREATE OR REPLACE FUNCTION bookings_changes() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        INSERT INTO booking_changes (bookingId, operation) VALUES (OLD.bookingId, 'D');
+    ELSE
+        INSERT INTO booking_changes (bookingId, operation) VALUES (NEW.bookingId, LEFT(TG_OP, 1));
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_bookings_changes AFTER INSERT OR UPDATE OR DELETE ON bookings FOR EACH ROW EXECUTE PROCEDURE bookings_changes();
+
+-- the bookings contain the names of the hotel and the visitor
+CREATE OR REPLACE FUNCTION hotels_booking_changes() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO booking_changes (bookingId, operation) SELECT bookingId, 'U' FROM bookings WHERE hotelId = NEW.hotelId;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_hotels_booking_changes AFTER UPDATE ON hotels FOR EACH ROW WHEN (OLD.hotelname IS DISTINCT FROM NEW.hotelname) EXECUTE PROCEDURE hotels_booking_changes();
+
+CREATE OR REPLACE FUNCTION visitors_booking_changes() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO booking_changes (bookingId, operation) SELECT bookingId, 'U' FROM bookings WHERE visitorId = NEW.visitorId;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_visitors_booking_changes AFTER UPDATE ON visitors FOR EACH ROW WHEN (OLD.firstname IS DISTINCT FROM NEW.firstname OR OLD.lastname IS DISTINCT FROM NEW.lastname) EXECUTE PROCEDURE visitors_booking_changes();
+
+-- wakes up the /api/bookings/stream listeners of all workers, a transaction sends a single notification at its commit
+CREATE OR REPLACE FUNCTION booking_changes_notify() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('booking_changes', '');
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_booking_changes_notify AFTER INSERT ON booking_changes FOR EACH STATEMENT EXECUTE PROCEDURE booking_changes_notify();
+
 
 
 
@@ -79,16 +189,14 @@ BEGIN
         h.hotelname,
         h.country,
         d.Date::date,
-        COALESCE(SUM(b.rooms), 0)::int AS usedRooms,
-        (h.totalRooms - COALESCE(SUM(b.rooms), 0))::int AS freeRooms
+        COALESCE(u.usedRooms, 0)::int AS usedRooms,
+        (h.totalRooms - COALESCE(u.usedRooms, 0))::int AS freeRooms
     FROM 
         hotels h
     CROSS JOIN 
         generate_series(StartDate, EndDate, '1 day'::interval) AS d(Date)
     LEFT JOIN 
-        bookings b ON h.hotelId = b.hotelId AND d.Date::date BETWEEN b.checkin AND b.checkout
-    GROUP BY 
-        h.hotelId, h.hotelname, h.country, d.Date::date, h.totalRooms;
+        hotel_day_usage u ON u.hotelId = h.hotelId AND u.usageDate = d.Date::date;
 END;
 $$ LANGUAGE plpgsql;
 
@@ -1,2 +1,2 @@
 cd /app
-gunicorn --bind=0.0.0.0 --workers=4 startup:app --timeout 180
+gunicorn --bind=0.0.0.0 --workers=4 --worker-class=gthread --threads=32 startup:app --timeout 180
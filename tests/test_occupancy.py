@@ -0,0 +1,46 @@
+import os
+from datetime import date, timedelta
+
+import pytest
+
+# the db layer picks its backend on import, the engine itself never connects
+os.environ.setdefault("POSTGRES_CONNECTION_STRING", "host=localhost;port=5432;database=postgres;user=postgres;password=postgres;")
+
+from contoso_hotel.dblayer.bookingimport import check_booking_values
+from contoso_hotel.dblayer.occupancy import BOOKING_HORIZON_DAYS, OccupancyEngine, day_number
+
+
+def _engine(bookings):
+    load = lambda: ([(1, 10)], bookings, None)
+    changes = lambda position: ([], [], position)
+    return OccupancyEngine(load, changes, refreshSeconds=0)
+
+
+def test_booking_outside_of_the_horizon_is_rejected():
+    today = date.today()
+    with pytest.raises(ValueError):
+        check_booking_values(today, date(9999, 12, 31), 1, 0, 0)
+    with pytest.raises(ValueError):
+        check_booking_values(date(1, 1, 1), today, 1, 0, 0)
+    assert check_booking_values(today, today + timedelta(days=BOOKING_HORIZON_DAYS), 1, 0, 0) == 1
+
+
+def test_engine_holds_only_the_nights_of_the_horizon():
+    today = date.today()
+    engine = _engine([(1, 1, day_number(today), day_number(date(9999, 12, 31)), 2)])
+    availability = engine.get_availability(1, today, today + timedelta(days=3))
+    assert [day["usedRooms"] for day in availability["days"]] == [2, 2, 2]
+    engine.add_booking(2, 1, date(1, 1, 1), date(9999, 12, 31), 3)
+    assert engine._usedRooms.shape[1] <= 2 * BOOKING_HORIZON_DAYS
+    assert engine.find_available_hotels(today, today + timedelta(days=1), 5) == { 1 : 5 }
+    engine.remove_booking(2)
+    assert engine.find_available_hotels(today, today + timedelta(days=1), 8) == { 1 : 8 }
+
+
+def test_time_span_outside_of_the_horizon_is_rejected():
+    engine = _engine([])
+    farAway = date.today() + timedelta(days=BOOKING_HORIZON_DAYS + 1)
+    with pytest.raises(ValueError):
+        engine.get_availability(1, farAway, farAway + timedelta(days=1))
+    with pytest.raises(ValueError):
+        engine.find_available_hotels(farAway, farAway + timedelta(days=1))